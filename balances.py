@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import math
+from array import array
+from itertools import islice
+from operator import itemgetter
+
+import numpy as np
+
+from config import BALANCE_CHECKPOINT_FILE
+from storage import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("settled", "pending")
+
+
+# (from, currency_sent, to, currency_received, status), and where each leg's key sits in it
+_legs = itemgetter("from", "currency_sent", "to", "currency_received", "status")
+_sent_key = itemgetter(0, 1, 4)
+_received_key = itemgetter(2, 3, 4)
+_sent_amount = itemgetter("amount_sent")
+_received_amount = itemgetter("amount_received")
+
+
+def _codes(keys):
+    """Codes for the hashable `keys`, and the distinct keys they index."""
+    index = {key: code for code, key in enumerate(dict.fromkeys(keys))}
+    return np.fromiter(map(index.__getitem__, keys), np.intp, len(keys)), list(index)
+
+
+class LegColumns:
+    """The ledger's transactions as the columns balances are summed from, kept as it grows.
+
+    Each transaction's (from, currency_sent, to, currency_received, status)
+    is coded once, when it's added, by looking it up among the distinct
+    combinations seen so far, and its amounts are appended to float columns.
+    Summing balances then never goes back to the transaction dicts. The
+    columns are only ever appended to, so balances() can read a prefix of
+    them from another thread.
+    """
+
+    def __init__(self, transactions=()):
+        self.combinations = []
+        self._code_of = {}
+        self.codes = array("q")
+        self.sent = array("d")
+        self.received = array("d")
+        self.extend(transactions)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def add(self, trans):
+        self.extend((trans,))
+
+    def extend(self, transactions):
+        code_of = self._code_of
+        # New combinations get the next code, and keep their order in the dict
+        self.codes.extend([code_of.setdefault(key, len(code_of)) for key in map(_legs, transactions)])
+        self.combinations.extend(islice(code_of, len(self.combinations), None))
+        self.sent.extend(map(_sent_amount, transactions))
+        self.received.extend(map(_received_amount, transactions))
+
+    def balances(self, start=0, stop=None):
+        """Settled and pending balances produced by the transactions from `start` to `stop`.
+
+        Each row is split into a sent leg on its source account and, for
+        rows with a destination and a received amount, a received leg on the
+        destination. The combinations are mapped to each leg's (account,
+        currency, status) group and the rows summed per group with
+        np.bincount; only the handful of groups is then folded into balances
+        in Python, matching what update_balances() does row by row.
+        """
+        balances = {}
+        # Slicing copies the rows, so appends during the sums don't matter
+        row_codes = np.frombuffer(self.codes[start:stop], np.int64)
+        if not len(row_codes):
+            return balances
+        sent = np.frombuffer(self.sent[start:stop])
+        received = np.frombuffer(self.received[start:stop])
+        combinations = self.combinations[:int(row_codes.max()) + 1]
+        sent_of, sent_groups = _codes(list(map(_sent_key, combinations)))
+        received_of, received_groups = _codes(list(map(_received_key, combinations)))
+        sent_codes = sent_of[row_codes]
+        received_codes = received_of[row_codes]
+
+        sent_totals = np.bincount(sent_codes, weights=sent, minlength=len(sent_groups))
+        # update_balances() only moves received amounts > 0
+        receives = received > 0
+        received_totals = np.bincount(received_codes[receives], weights=received[receives], minlength=len(received_groups))
+        received_counts = np.bincount(received_codes[receives], minlength=len(received_groups))
+        # Groups whose rows all lie outside start:stop
+        sent_counts = np.bincount(sent_codes, minlength=len(sent_groups))
+        any_received = np.bincount(received_codes, minlength=len(received_groups))
+
+        for (account, currency, status), total, count in zip(sent_groups, sent_totals.tolist(), sent_counts.tolist()):
+            if not count:
+                continue
+            kind = "settled" if status == "closed" else "pending"
+            amounts = balances.setdefault(account, {"settled": {}, "pending": {}})[kind]
+            amounts[currency] = amounts.get(currency, 0) - total
+        for (account, currency, status), total, count, rows in zip(
+            received_groups, received_totals.tolist(), received_counts.tolist(), any_received.tolist()
+        ):
+            if not account or not rows:
+                continue
+            # Every destination gets an entry, even if nothing was received
+            amounts = balances.setdefault(account, {"settled": {}, "pending": {}})
+            if count:
+                kind = "settled" if status == "closed" else "pending"
+                amounts[kind][currency] = amounts[kind].get(currency, 0) + total
+        return balances
+
+
+def aggregate_balances(transactions):
+    """Settled and pending balances produced by `transactions`, computed column-wise (see LegColumns)."""
+    return LegColumns(transactions).balances()
+
+
+def merge_balances(base, delta):
+    """A new balances dict holding `base` plus `delta`."""
+    merged = {name: {kind: dict(b.get(kind, {})) for kind in KINDS} for name, b in base.items()}
+    for name, b in delta.items():
+        target = merged.setdefault(name, {"settled": {}, "pending": {}})
+        for kind in KINDS:
+            for currency, amount in b.get(kind, {}).items():
+                target[kind][currency] = target[kind].get(currency, 0) + amount
+    return merged
+
+
+def _fingerprint(transactions, position):
+    """Identifies the ledger prefix a checkpoint covers, so one taken before a reset isn't reused."""
+    if position == 0:
+        return ""
+    last = json.dumps(transactions[position - 1], sort_keys=True)
+    return hashlib.sha256(last.encode()).hexdigest()
+
+
+def load_checkpoint(path=BALANCE_CHECKPOINT_FILE):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError as e:
+        # Only costs a full rebuild
+        logger.warning(f"Ignoring unreadable balance checkpoint {path}: {e}")
+        return None
+
+
+def save_checkpoint(transactions, balances, path=BALANCE_CHECKPOINT_FILE):
+    """Record `balances` as the result of replaying all of `transactions`."""
+    checkpoint = {
+        "position": len(transactions),
+        "fingerprint": _fingerprint(transactions, len(transactions)),
+        "balances": balances,
+    }
+    write_snapshot(json.dumps(checkpoint), path)
+
+
+def rebuild_balances(data, checkpoint=None, columns=None):
+    """Recompute every account's balances from the transaction log.
+
+    With a checkpoint that still matches the log, only the transactions
+    after it are replayed. `columns`, the LegColumns kept for the log (it
+    may have grown past it since), saves coding the transactions again.
+    Returns the balances and the number of transactions replayed.
+    """
+    transactions = data["transactions"]
+    base, start = {}, 0
+    if checkpoint is not None:
+        position = checkpoint["position"]
+        if position <= len(transactions) and checkpoint["fingerprint"] == _fingerprint(transactions, position):
+            base, start = checkpoint["balances"], position
+        else:
+            logger.info("Balance checkpoint doesn't match the ledger; rebuilding from the start")
+    if columns is None:
+        delta = aggregate_balances(transactions[start:])
+    else:
+        delta = columns.balances(start, len(transactions))
+    return merge_balances(base, delta), len(transactions) - start
+
+
+def compare_balances(stored, rebuilt):
+    """(account, kind, currency, stored, rebuilt) for every amount that differs.
+
+    Missing amounts count as zero, and sums that differ only by floating point
+    rounding match.
+    """
+    differences = []
+    for name in sorted(set(stored) | set(rebuilt)):
+        for kind in KINDS:
+            stored_kind = stored.get(name, {}).get(kind, {})
+            rebuilt_kind = rebuilt.get(name, {}).get(kind, {})
+            for currency in sorted(set(stored_kind) | set(rebuilt_kind)):
+                a = stored_kind.get(currency, 0)
+                b = rebuilt_kind.get(currency, 0)
+                if not math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6):
+                    differences.append((name, kind, currency, a, b))
+    return differences
+
+
+def rebuild_from_checkpoint(transactions, columns=None, path=BALANCE_CHECKPOINT_FILE):
+    """Rebuild balances from the last checkpoint and save a new one covering `transactions`.
+
+    Blocking; run it in a thread with a snapshot of the transaction list
+    (and the ledger's LegColumns, which may keep growing meanwhile).
+    Returns the balances and the number of transactions replayed.
+    """
+    balances, replayed = rebuild_balances({"transactions": transactions}, load_checkpoint(path), columns)
+    save_checkpoint(transactions, balances, path)
+    return balances, replayed
@@ -0,0 +1,596 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from config import (
+    CURRENCIES, TRANSACTION_TYPES, TRANSACTION_STATUSES, SIMPLE_TRANSACTION_TYPES, LEDGER_CACHE_SIZE, OUTBOUND_CHAT_BURST,
+    BTN_MANAGE_ACCOUNTS, BTN_LIST_TRANSACTIONS, BTN_GENERATE_REPORT,
+)
+from storage import default_data, apply_record, update_balances, JsonStorage, JournalStorage, SqliteStorage
+from reports import build_report, render_text, render_markdown, render_html
+
+
+def synthetic_ledger(n_transactions, n_accounts=10, seed=0):
+    """Build a ledger of `n_transactions` random transactions through apply_record()."""
+    rng = random.Random(seed)
+    data = default_data()
+    accounts = [f"Account{i}" for i in range(n_accounts)]
+    for account in accounts:
+        apply_record(data, {"op": "add_account", "account": account})
+
+    start = date(2020, 1, 1)
+    for i in range(n_transactions):
+        trans_type = rng.choice(TRANSACTION_TYPES)
+        simple = trans_type in SIMPLE_TRANSACTION_TYPES
+        currency_sent = rng.choice(CURRENCIES)
+        trans = {
+            "date": (start + timedelta(days=i * 2000 // max(n_transactions, 1))).isoformat(),
+            "type": trans_type,
+            "amount_sent": round(rng.uniform(1, 500), 2),
+            "currency_sent": currency_sent,
+            "from": rng.choice(accounts),
+            "amount_received": 0.0 if simple else round(rng.uniform(1, 500), 2),
+            "currency_received": "" if simple else rng.choice(CURRENCIES),
+            "to": "" if simple else rng.choice(accounts),
+            "status": "closed" if simple else rng.choice(TRANSACTION_STATUSES),
+            "info": f"note {i}" if rng.random() < 0.3 else "",
+            "description": f"{trans_type.capitalize()} - {currency_sent}",
+        }
+        apply_record(data, {"op": "transaction", "trans": trans})
+    return data
+
+
+def timed(func, *args, repeat=3):
+    """Best wall-clock time of `repeat` calls, in seconds.
+
+    The cyclic GC is paused while timing: its full collections scan the whole
+    synthetic ledger and would hide how the code itself scales.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            func(*args)
+            best = min(best, time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return best
+
+
+def timed_async(loop, make_coro, repeat=3):
+    """timed() for a coroutine; `make_coro` returns a fresh one for every run."""
+    return timed(lambda: loop.run_until_complete(make_coro()), repeat=repeat)
+
+
+def bench_reports(sizes, n_accounts):
+    print(f"{'transactions':>12} {'build':>9} {'text':>9} {'markdown':>9} {'html':>9} {'us/row':>8}")
+    for n in sizes:
+        data = synthetic_ledger(n, n_accounts)
+        report = build_report(data)
+        build = timed(build_report, data)
+        text = timed(render_text, report)
+        md = timed(render_markdown, report)
+        html = timed(render_html, report)
+        per_row = (build + text) / n * 1e6
+        print(f"{n:>12} {build:>8.3f}s {text:>8.3f}s {md:>8.3f}s {html:>8.3f}s {per_row:>8.2f}")
+
+
+# Fakes standing in for python-telegram-bot objects, so handlers run without a network
+
+class FakeMessage:
+    def __init__(self, text=""):
+        self.text = text
+        self.sent = 0
+
+    async def reply_text(self, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(text)
+
+    async def reply_photo(self, photo=None, **kwargs):
+        self.sent += 1
+
+    async def reply_document(self, document=None, **kwargs):
+        self.sent += 1
+
+    async def reply_media_group(self, media=None, **kwargs):
+        self.sent += 1
+
+    async def edit_text(self, text, **kwargs):
+        self.sent += 1
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, text="", chat_id=1):
+        self.message = FakeMessage(text)
+        self.callback_query = None
+        self.effective_chat = FakeChat(chat_id)
+
+
+class FakeApplication:
+    def __init__(self, bot_data):
+        self.bot_data = bot_data
+        self.tasks = set()
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self):
+        """Wait for the tasks handlers started, such as a report being sent."""
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+class FakeContext:
+    def __init__(self, application, args=None):
+        self.application = application
+        self.bot_data = application.bot_data
+        self.user_data = {}
+        self.chat_data = {}
+        self.args = args or []
+
+
+STORAGES = {
+    "json": lambda d: JsonStorage(os.path.join(d, "data.json")),
+    "journal": lambda d: JournalStorage(os.path.join(d, "data.json"), os.path.join(d, "data.journal")),
+    "sqlite": lambda d: SqliteStorage(os.path.join(d, "data.db"), os.path.join(d, "data.json")),
+}
+
+
+def bench_storage(data, workdir):
+    """What load_data() and save_data() do, for each storage backend, in a scratch directory."""
+    results = {}
+    for mode, make in STORAGES.items():
+        os.makedirs(os.path.join(workdir, mode))
+        storage = make(os.path.join(workdir, mode))
+        results[f"save_{mode}"] = timed(storage.save, data)
+        results[f"load_{mode}"] = timed(storage.load)
+    return results
+
+
+def bench_update_balances(data):
+    """Replaying every transaction through update_balances() into empty balances."""
+    def replay():
+        scratch = {"balances": {}, "spending_categories": {}}
+        for trans in data["transactions"]:
+            update_balances(scratch, trans)
+    return timed(replay)
+
+
+def bench_handlers(data, workdir, image_max):
+    """list_transactions, generate_report and generate_image_report driven through fake updates."""
+    try:
+        import maBot
+    except (ImportError, OSError) as e:
+        print(f"Skipping handler benchmarks, the bot can't be imported: {e}", file=sys.stderr)
+        return {}
+    from rendering import RenderService
+
+    # Reports are sent as fast as the fakes accept them
+    maBot.REPORT_CHUNK_DELAY_SECONDS = 0
+    storage = JsonStorage(os.path.join(workdir, "handlers.json"))
+    storage.save(data)
+    # Loaded from the file, like the bot does at startup
+    ledger = maBot.Ledger(storage)
+    render_service = RenderService(maBot.RENDER_WORKERS, maBot.RENDER_QUEUE_LIMIT, maBot.IMAGE_PAGE_CACHE_MAX_BYTES)
+    ledgers = maBot.LedgerCache(1, lambda chat_id: ledger)
+    context = FakeContext(FakeApplication({"ledgers": ledgers, "render_service": render_service}))
+    loop = asyncio.new_event_loop()
+
+    async def handle(handler):
+        await handler(FakeUpdate(), context)
+        # Reports are sent from a background task; time them to the last message
+        await context.application.drain()
+
+    def cold(handler):
+        # Every run starts without cached report sections or pages
+        async def run():
+            ledger.report_cache.clear()
+            render_service.clear_cache()
+            await handle(handler)
+        return run
+
+    results = {}
+    try:
+        results["list_transactions"] = timed_async(loop, lambda: maBot.list_transactions(FakeUpdate(), context))
+        results["generate_report_cold"] = timed_async(loop, cold(maBot.generate_report))
+        results["generate_report_warm"] = timed_async(loop, lambda: handle(maBot.generate_report))
+        if len(data["transactions"]) <= image_max:
+            # The first render also starts the worker pool; don't count it
+            loop.run_until_complete(maBot.generate_image_report(FakeUpdate(), context))
+            results["generate_image_report"] = timed_async(loop, cold(maBot.generate_image_report))
+            results["generate_image_report_warm"] = timed_async(
+                loop, lambda: maBot.generate_image_report(FakeUpdate(), context)
+            )
+    finally:
+        render_service.shutdown()
+        loop.close()
+    return results
+
+
+def bench_chats(n_chats, cache_size, per_chat, workdir, concurrency=50):
+    """Load test for per-chat ledgers, printing traced memory as chats come in.
+
+    Every chat adds an account and `per_chat` transactions through a
+    LedgerCache of `cache_size`, `concurrency` chats at a time, then a
+    second round revisits random chats. Memory should level off once the
+    cache is full, however many chats there are.
+    """
+    try:
+        import maBot
+    except (ImportError, OSError) as e:
+        print(f"Skipping the chat load test, the bot can't be imported: {e}", file=sys.stderr)
+        return
+    from metrics import METRICS
+
+    template = synthetic_ledger(per_chat, 1)["transactions"]
+
+    def open_ledger(chat_id):
+        directory = os.path.join(workdir, str(chat_id))
+        os.makedirs(directory, exist_ok=True)
+        return maBot.Ledger(JournalStorage(os.path.join(directory, "data.json"), os.path.join(directory, "data.journal")))
+
+    async def chat(ledgers, chat_id):
+        ledger = ledgers.get(chat_id)
+        if not ledger.data["accounts"]:
+            await ledger.commit({"op": "add_account", "account": "Account0"})
+        transactions = [{k: v for k, v in t.items() if k != "id"} for t in template]
+        await ledger.commit({"op": "transactions", "trans": transactions})
+
+    async def run():
+        ledgers = maBot.LedgerCache(cache_size, open_ledger)
+        rng = random.Random(0)
+        print(f"{'round':>7} {'chats':>7} {'cached':>7} {'traced MB':>10} {'peak MB':>8}")
+        for label, chat_ids in (("new", list(range(n_chats))), ("revisit", rng.sample(range(n_chats), min(n_chats, 1000)))):
+            for i in range(0, len(chat_ids), concurrency):
+                await asyncio.gather(*(chat(ledgers, chat_id) for chat_id in chat_ids[i:i + concurrency]))
+                done = i + concurrency
+                if done % (concurrency * 10) == 0 or done >= len(chat_ids):
+                    await ledgers.flush_all()
+                    gc.collect()
+                    current, peak = tracemalloc.get_traced_memory()
+                    print(f"{label:>7} {min(done, len(chat_ids)):>7} {len(ledgers):>7} {current / 1e6:>10.1f} {peak / 1e6:>8.1f}")
+        await ledgers.flush_all()
+        lookups = {result: METRICS.counter("ledger_cache_lookups_total", result=result) for result in ("hit", "miss", "revived")}
+        print(f"lookups: {lookups}, evictions: {METRICS.counter_total('ledger_cache_evictions_total')}")
+
+    tracemalloc.start()
+    try:
+        asyncio.run(run())
+    finally:
+        tracemalloc.stop()
+
+
+def synthetic_updates(n_chats, script):
+    """Message updates sending each text of `script` from `n_chats` chats, interleaved as concurrent users would."""
+    updates = []
+    now = int(time.time())
+    for step, text in enumerate(script, 1):
+        for chat_id in range(1, n_chats + 1):
+            message = {
+                "message_id": step,
+                "date": now,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+                "text": text,
+            }
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            updates.append({"update_id": len(updates) + 1, "message": message})
+    return updates
+
+
+async def post_updates(port, path, secret_token, updates, connections):
+    """POST `updates` to a local webhook the way Telegram does: over `connections` keep-alive
+    connections, one request at a time on each, a chat always on the same one. Returns the refused count."""
+    from telegram import Update
+
+    lanes = [[] for _ in range(connections)]
+    for update in updates:
+        chat = Update.de_json(update, None).effective_chat
+        lanes[(chat.id if chat else update["update_id"]) % connections].append(update)
+
+    async def send(lane):
+        refused = 0
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for update in lane:
+                body = json.dumps(update).encode()
+                writer.write(
+                    f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                    f"X-Telegram-Bot-Api-Secret-Token: {secret_token}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                head = await reader.readuntil(b"\r\n\r\n")
+                if head.split(b" ", 2)[1] != b"200":
+                    refused += 1
+        finally:
+            writer.close()
+        return refused
+
+    return sum(await asyncio.gather(*(send(lane) for lane in lanes if lane)))
+
+
+def bench_updates(updates, latency, connections, workdir, check=None):
+    """Updates per second through polling and through the webhook, with the Bot API replaced by OfflineBotApi.
+
+    Every Bot API call (getUpdates, and every reply the handlers send)
+    takes `latency` seconds. `check(ledgers, chat_id)` tells whether a
+    chat's ledger ended up as its updates in order would leave it.
+    """
+    try:
+        import maBot
+    except (ImportError, OSError) as e:
+        print(f"Skipping the update replay, the bot can't be imported: {e}", file=sys.stderr)
+        return
+    from webhook import OfflineBotApi, WebhookServer
+
+    # Jobs and handlers log at INFO; only the results matter here
+    logging.getLogger().setLevel(logging.WARNING)
+    maBot.REPORT_CHUNK_DELAY_SECONDS = 0
+    chat_ids = sorted({u["message"]["chat"]["id"] for u in updates if "message" in u})
+
+    async def polling(app, api):
+        await app.updater.start_polling(poll_interval=0)
+        # Fetched updates are confirmed by the offset of the next getUpdates, which follows their queueing
+        while api.pending:
+            await asyncio.sleep(0.01)
+        await app.update_queue.join()
+        await app.updater.stop()
+        return 0
+
+    async def webhook(app, api):
+        server = WebhookServer(app, "/telegram", "benchmark")
+        port = await server.start("127.0.0.1", 0)
+        refused = await post_updates(port, "/telegram", "benchmark", updates, connections)
+        await app.update_queue.join()
+        await server.stop()
+        return refused
+
+    async def run(mode, deliver):
+        api = OfflineBotApi(updates if mode == "polling" else (), latency)
+        # Intake is measured, not the outbound flood limits, which would cap the replies at 30 a second
+        app = maBot.build_application(api, limit_outbound=False)
+        async with app:
+            await app.start()
+            started = time.perf_counter()
+            refused = await deliver(app, api)
+            elapsed = time.perf_counter() - started
+            await app.stop()
+            ledgers = app.bot_data["ledgers"]
+            in_order = sum(1 for chat_id in chat_ids if check(ledgers, chat_id)) if check else None
+        await app.post_shutdown(app)
+        replies = sum(count for method, count in api.calls.items() if method != "getUpdates")
+        order = f"{in_order}/{len(chat_ids)}" if check else "-"
+        print(f"{mode:>8} {len(updates):>8} {elapsed:>8.2f}s {len(updates) / elapsed:>10.0f} "
+              f"{api.calls['getUpdates']:>10} {replies:>8} {refused:>8} {order:>9}")
+
+    print(f"{'mode':>8} {'updates':>8} {'time':>9} {'updates/s':>10} {'getUpdates':>10} {'replies':>8} {'refused':>8} {'in order':>9}")
+    cwd = os.getcwd()
+    try:
+        for mode, deliver in (("polling", polling), ("webhook", webhook)):
+            # Each run starts with no ledgers; they live under LEDGER_DIR, relative to the working directory
+            os.makedirs(os.path.join(workdir, mode))
+            os.chdir(os.path.join(workdir, mode))
+            asyncio.run(run(mode, deliver))
+    finally:
+        os.chdir(cwd)
+
+
+def bench_outbound(n_chats, chunks, latency, workdir):
+    """A burst of reports with a /cancel behind each, fed through the bot with and without OutboundQueue.
+
+    Every chat asks for a report of about `chunks` messages and, just after,
+    sends /cancel; the updates go through the application's update queue
+    and processor like fetched ones. The reply latency is from queueing the
+    /cancel to its reply being accepted. OfflineBotApi refuses what goes
+    beyond Telegram's flood limits with a 429, as Telegram would; without
+    the queue those sends fail.
+    """
+    try:
+        import maBot
+    except (ImportError, OSError) as e:
+        print(f"Skipping the outbound benchmark, the bot can't be imported: {e}", file=sys.stderr)
+        return
+    from telegram import Update
+    from telegram.constants import MessageLimit
+    from webhook import OfflineBotApi
+
+    class RecordingBotApi(OfflineBotApi):
+        """Notes when each chat's /cancel reply is accepted."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.replied = {}
+
+        def _answer(self, api_method, parameters):
+            if api_method == "sendMessage" and parameters.get("text") == maBot.MSG_CANCELLED:
+                self.replied[parameters["chat_id"]] = time.perf_counter()
+            return super()._answer(api_method, parameters)
+
+    # Sized from a small ledger's report, so each chat's report runs to about `chunks` messages
+    sample = synthetic_ledger(200)
+    per_transaction = len(render_text(build_report(sample))) / len(sample["transactions"])
+    data = synthetic_ledger(max(1, int(chunks * MessageLimit.MAX_TEXT_LENGTH / per_transaction)))
+    updates = synthetic_updates(n_chats, [BTN_GENERATE_REPORT, "/cancel"])
+    reports, cancels = updates[:n_chats], updates[n_chats:]
+
+    async def run(label, limit_outbound):
+        # Telegram's documented limits: about 30 messages a second, 1 a second to a chat with short bursts allowed
+        api = RecordingBotApi(latency=latency, flood_limits=((30, 30), (1, OUTBOUND_CHAT_BURST)))
+        app = maBot.build_application(api, limit_outbound=limit_outbound)
+        async with app:
+            ledgers = app.bot_data["ledgers"]
+            for chat_id in range(1, n_chats + 1):
+                ledger = ledgers.get(chat_id)
+                for account in data["accounts"]:
+                    await ledger.commit({"op": "add_account", "account": account})
+                await ledger.commit({"op": "transactions", "trans": data["transactions"]})
+            await app.start()
+            started = time.perf_counter()
+            for update in reports:
+                await app.update_queue.put(Update.de_json(update, app.bot))
+            await asyncio.sleep(0.05)
+            queued = time.perf_counter()
+            for update in cancels:
+                await app.update_queue.put(Update.de_json(update, app.bot))
+            await app.update_queue.join()
+            # Waits for the reports still being sent
+            await app.stop()
+            elapsed = time.perf_counter() - started
+        await app.post_shutdown(app)
+        latencies = sorted(replied - queued for replied in api.replied.values())
+        p50, p95 = (latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0 for q in (0.5, 0.95))
+        failed = n_chats - len(latencies)
+        print(f"{label:>10} {elapsed:>8.2f}s {p50 * 1000:>10.0f} {p95 * 1000:>10.0f} {api.flooded:>8} {failed:>7}")
+
+    # Flood warnings and failed sends would drown the table
+    logging.getLogger().setLevel(logging.CRITICAL)
+    print(f"{'limiter':>10} {'time':>9} {'reply p50':>10} {'reply p95':>10} {'429s':>8} {'failed':>7}")
+    cwd = os.getcwd()
+    try:
+        for label, limit_outbound in (("none", False), ("outbound", True)):
+            # Each run starts with no ledgers; they live under LEDGER_DIR, relative to the working directory
+            os.makedirs(os.path.join(workdir, label))
+            os.chdir(os.path.join(workdir, label))
+            asyncio.run(run(label, limit_outbound))
+    finally:
+        os.chdir(cwd)
+
+
+def run_suite(sizes, n_accounts, image_max):
+    results = {}
+    for n in sizes:
+        data = synthetic_ledger(n, n_accounts)
+        with tempfile.TemporaryDirectory() as workdir:
+            timings = bench_storage(data, workdir)
+            timings["update_balances"] = bench_update_balances(data)
+            timings.update(bench_handlers(data, workdir, image_max))
+        results[str(n)] = timings
+        print(f"{n:>9} " + "  ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in timings.items()))
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "accounts": n_accounts,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline_path, current_path, threshold, min_delta):
+    """Print current vs baseline timings; returns the number of regressions.
+
+    A regression is a slowdown beyond `threshold` (relative) and `min_delta`
+    seconds, so noise on sub-millisecond timings isn't flagged.
+    """
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+    with open(current_path) as file:
+        current = json.load(file)["results"]
+    regressions = 0
+    print(f"{'size':>9} {'benchmark':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for size, timings in current.items():
+        for name, seconds in timings.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            change = seconds / before - 1
+            flag = ""
+            if change > threshold and seconds - before > min_delta:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{size:>9} {name:<24} {before * 1000:>8.1f}ms {seconds * 1000:>8.1f}ms {change:>+7.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot on synthetic ledgers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None)
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--suite", action="store_true",
+                        help="time storage, update_balances and the report handlers instead of the report engine alone")
+    parser.add_argument("--output", help="write the suite results to this JSON file")
+    parser.add_argument("--image-max", type=int, default=100_000,
+                        help="largest ledger to time the image report on")
+    parser.add_argument("--chats", type=int,
+                        help="load test per-chat ledgers with this many chats instead")
+    parser.add_argument("--cache-size", type=int, default=LEDGER_CACHE_SIZE, help="ledgers held in memory for --chats")
+    parser.add_argument("--chat-transactions", type=int, default=50, help="transactions added by each chat for --chats")
+    parser.add_argument("--updates", metavar="FILE",
+                        help="replay these recorded updates (one JSON update per line, see RECORD_UPDATES_FILE) "
+                             "through polling and the webhook instead")
+    parser.add_argument("--update-chats", type=int,
+                        help="replay a synthetic session of this many chats through polling and the webhook instead")
+    parser.add_argument("--api-latency-ms", type=float, default=50.0,
+                        help="simulated round trip of each Bot API call for --updates/--update-chats/--outbound")
+    parser.add_argument("--webhook-connections", type=int, default=40,
+                        help="connections Telegram delivers webhook updates over (its default is 40)")
+    parser.add_argument("--outbound", type=int, metavar="CHATS",
+                        help="feed a burst of reports, each followed by /cancel, from this many chats "
+                             "with and without the outbound queue instead")
+    parser.add_argument("--report-chunks", type=int, default=5, help="messages per report for --outbound")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two suite result files and exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown counted as a regression by --compare (0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="smallest absolute slowdown counted as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold, args.min_delta_ms / 1000)
+        print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+    if args.chats:
+        with tempfile.TemporaryDirectory() as workdir:
+            bench_chats(args.chats, args.cache_size, args.chat_transactions, workdir)
+        return
+    if args.outbound:
+        with tempfile.TemporaryDirectory() as workdir:
+            bench_outbound(args.outbound, args.report_chunks, args.api_latency_ms / 1000, workdir)
+        return
+    if args.updates or args.update_chats:
+        check = None
+        if args.updates:
+            with open(args.updates) as file:
+                updates = [json.loads(line) for line in file if line.strip()]
+        else:
+            # Adds an account, so a chat whose updates ran out of order ends up without it
+            script = [BTN_MANAGE_ACCOUNTS, "Cash", BTN_LIST_TRANSACTIONS, "/query account=Cash", BTN_GENERATE_REPORT]
+            updates = synthetic_updates(args.update_chats, script)
+            check = lambda ledgers, chat_id: ledgers.get(chat_id).data["accounts"] == ["Cash"]
+        with tempfile.TemporaryDirectory() as workdir:
+            bench_updates(updates, args.api_latency_ms / 1000, args.webhook_connections, workdir, check)
+        return
+    if args.suite:
+        results = run_suite(args.sizes or [1_000, 10_000, 100_000], args.accounts, args.image_max)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        return
+    # A flat us/row column means build + render time grows linearly with the ledger
+    bench_reports(args.sizes or [10_000, 50_000, 100_000, 200_000], args.accounts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import zlib
+from datetime import timedelta
+
+from telegram.error import Forbidden, TelegramError
+
+from config import (
+    DIGEST_SUBSCRIPTIONS_FILE, DIGEST_STAGGER_SECONDS, DIGEST_RETRY_SECONDS, DIGEST_MAX_ATTEMPTS,
+    MSG_DIGEST_HEADER, MSG_DIGEST_SPENDING, MSG_DIGEST_NO_SPENDING, MSG_DIGEST_BALANCES, MSG_DIGEST_LINE,
+)
+from metrics import METRICS
+from outbound import NOTICE, priority
+from reports import format_amounts
+from storage import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIES = ("daily", "weekly", "monthly")
+
+
+def digest_period(frequency, today):
+    """The period a digest sent on `today` covers, the one that has just ended: (first day, last day)."""
+    end = today - timedelta(days=1)
+    if frequency == "daily":
+        return end, end
+    if frequency == "weekly":
+        return today - timedelta(days=7), end
+    end = today.replace(day=1) - timedelta(days=1)
+    return end.replace(day=1), end
+
+
+def spending_between(spending_categories, frequency, start, end):
+    """{category: {currency: amount}} spent from `start` to `end`, from the per-day or per-month totals.
+
+    At most seven lookups per category, however long the ledger is.
+    """
+    if frequency == "monthly":
+        keys, period = [start.isoformat()[:7]], "months"
+    else:
+        keys, period = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)], "days"
+    spending = {}
+    for cat_name, cat in sorted(spending_categories.items()):
+        amounts = {}
+        for key in keys:
+            for currency, amount in cat[period].get(key, {}).items():
+                amounts[currency] = amounts.get(currency, 0) + amount
+        if any(amounts.values()):
+            spending[cat_name] = amounts
+    return spending
+
+
+def build_digest(data, frequency, start, end):
+    """The digest text: spending per category over the period and the current balances per account."""
+    period = start.isoformat() if start == end else f"{start.isoformat()} - {end.isoformat()}"
+    lines = [MSG_DIGEST_HEADER.format(frequency=frequency, period=period), "", MSG_DIGEST_SPENDING]
+    spending = spending_between(data["spending_categories"], frequency, start, end)
+    for cat_name, amounts in spending.items():
+        lines.append(MSG_DIGEST_LINE.format(name=cat_name.capitalize(), amounts=format_amounts(amounts)))
+    if not spending:
+        lines.append(MSG_DIGEST_NO_SPENDING)
+    lines += ["", MSG_DIGEST_BALANCES]
+    for account in data["accounts"]:
+        settled = data["balances"].get(account, {}).get("settled", {})
+        lines.append(MSG_DIGEST_LINE.format(name=account, amounts=format_amounts(settled) or "0"))
+    return "\n".join(lines)
+
+
+class DigestService:
+    """Sends daily, weekly and monthly digests to the chats subscribed to them.
+
+    Subscriptions are kept in `path`. When digests fall due, the chats get
+    theirs spread over `stagger_seconds`, each at the same offset every time,
+    so ledgers are loaded and messages queued a few at a time rather than all
+    at once. A digest is built once per chat and period, from the ledger's
+    per-period spending totals, and kept until the next period's run; sends
+    go through the bot's outbound queue as notices. A failed send is retried
+    with the text already built, after `retry_seconds`, doubling each time,
+    for `max_attempts` sends in all. Chats that blocked the bot are
+    unsubscribed.
+    """
+
+    def __init__(self, path=DIGEST_SUBSCRIPTIONS_FILE, stagger_seconds=DIGEST_STAGGER_SECONDS,
+                 retry_seconds=DIGEST_RETRY_SECONDS, max_attempts=DIGEST_MAX_ATTEMPTS):
+        self.path = path
+        self.stagger_seconds = stagger_seconds
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        # chat id -> the frequencies it is subscribed to
+        self.subscriptions = {}
+        # (chat id, frequency, first day) -> digest text
+        self._digests = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                stored = json.load(file)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            logger.error(f"{self.path} is corrupt ({e}); starting without digest subscriptions")
+            return
+        self.subscriptions = {int(chat_id): set(frequencies) for chat_id, frequencies in stored.items()}
+
+    def save(self):
+        stored = {str(chat_id): sorted(frequencies) for chat_id, frequencies in self.subscriptions.items()}
+        write_snapshot(json.dumps(stored, indent=4), self.path)
+
+    def subscribe(self, chat_id, frequencies):
+        self.subscriptions.setdefault(chat_id, set()).update(frequencies)
+        self.save()
+
+    def unsubscribe(self, chat_id):
+        if self.subscriptions.pop(chat_id, None) is not None:
+            self.save()
+
+    def offset(self, chat_id):
+        """Seconds into the stagger window at which `chat_id` gets its digests."""
+        return zlib.crc32(str(chat_id).encode()) % 1000 / 1000 * self.stagger_seconds
+
+    def digest(self, chat_id, ledger, frequency, today):
+        start, end = digest_period(frequency, today)
+        key = (chat_id, frequency, start)
+        text = self._digests.get(key)
+        if text is None:
+            text = self._digests[key] = build_digest(ledger.data, frequency, start, end)
+            METRICS.inc("digests_total", frequency=frequency, result="built")
+        return text
+
+    async def send_due(self, app, frequency, today):
+        """Build and send the `frequency` digests due on `today`, staggered over the window."""
+        start, _ = digest_period(frequency, today)
+        # Digests of earlier periods won't be sent again
+        self._digests = {key: text for key, text in self._digests.items() if key[1] != frequency or key[2] >= start}
+        chats = sorted((c for c, f in self.subscriptions.items() if frequency in f), key=self.offset)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for chat_id in chats:
+            delay = started + self.offset(chat_id) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if frequency not in self.subscriptions.get(chat_id, ()):
+                # Unsubscribed while waiting for its turn
+                continue
+            try:
+                text = self.digest(chat_id, app.bot_data["ledgers"].get(chat_id), frequency, today)
+            except Exception as e:
+                logger.error(f"Couldn't build the {frequency} digest for chat {chat_id}: {e}")
+                continue
+            app.create_task(self._deliver(app, chat_id, frequency, text, 1))
+        if chats:
+            logger.info(f"{len(chats)} {frequency} digest(s) queued")
+
+    async def _deliver(self, app, chat_id, frequency, text, attempt):
+        try:
+            # Ignored when the bot has no outbound queue, where rate_limit_args would be refused
+            with priority(NOTICE):
+                await app.bot.send_message(chat_id=chat_id, text=text)
+        except Forbidden:
+            # Blocked, or removed from the group
+            logger.info(f"Chat {chat_id} can't be sent digests any more; unsubscribed")
+            self.unsubscribe(chat_id)
+            METRICS.inc("digests_total", frequency=frequency, result="unsubscribed")
+        except TelegramError as e:
+            if attempt >= self.max_attempts:
+                logger.error(f"Giving up on the {frequency} digest for chat {chat_id} after {attempt} attempts: {e}")
+                METRICS.inc("digests_total", frequency=frequency, result="failed")
+                return
+            delay = self.retry_seconds * 2 ** (attempt - 1)
+            logger.warning(f"Sending the {frequency} digest to chat {chat_id} failed ({e}); retrying in {delay}s")
+            METRICS.inc("digests_total", frequency=frequency, result="retried")
+            app.job_queue.run_once(
+                self._retry, when=delay, data=(chat_id, frequency, text, attempt + 1), name=f"digest_retry_{chat_id}"
+            )
+        else:
+            METRICS.inc("digests_total", frequency=frequency, result="sent")
+
+    async def _retry(self, context):
+        chat_id, frequency, text, attempt = context.job.data
+        await self._deliver(context.application, chat_id, frequency, text, attempt)
@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+import tempfile
+
+from config import EXPORT_SPOOL_MAX_BYTES
+from storage import TRANSACTION_FIELDS
+
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ["id"] + TRANSACTION_FIELDS
+FILTER_KEYS = ("from", "to", "account", "type", "format")
+
+
+def parse_filters(tokens):
+    """Filters for export_transactions() from `key=value` command arguments.
+
+    Keys are from/to (ISO dates, inclusive), account, type (comma separated)
+    and format. Raises ValueError for anything else.
+    """
+    filters = {}
+    for token in tokens:
+        key, sep, value = token.partition("=")
+        key = key.lower()
+        if not sep or key not in FILTER_KEYS or not value:
+            raise ValueError(f"can't use {token!r}")
+        filters[key] = value
+    return make_filters(
+        start=filters.get("from"),
+        end=filters.get("to"),
+        account=filters.get("account"),
+        types=filters["type"].split(",") if "type" in filters else None,
+        fmt=filters.get("format", "csv"),
+    )
+
+
+def is_iso_date(value):
+    # ISO dates compare correctly as strings; check they are dates
+    return len(value) == 10 and value[4] == value[7] == "-" and value.replace("-", "").isdigit()
+
+
+def make_filters(start=None, end=None, account=None, types=None, fmt="csv"):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown format {fmt!r}, use one of {', '.join(EXPORT_FORMATS)}")
+    for date in (start, end):
+        if date is not None and not is_iso_date(date):
+            raise ValueError(f"dates must be YYYY-MM-DD, not {date!r}")
+    return {"start": start, "end": end, "account": account, "types": set(types) if types else None, "fmt": fmt}
+
+
+def matching(transactions, start=None, end=None, account=None, types=None):
+    """Yield the transactions within the date range, touching `account` and of one of `types`."""
+    for t in transactions:
+        if start is not None and t["date"] < start:
+            continue
+        if end is not None and t["date"] > end:
+            continue
+        if account is not None and account not in (t["from"], t["to"]):
+            continue
+        if types is not None and t["type"] not in types:
+            continue
+        yield t
+
+
+def iter_csv(transactions):
+    """Yield the CSV export line by line, starting with the header."""
+    line = io.StringIO()
+    writer = csv.writer(line)
+    writer.writerow(EXPORT_COLUMNS)
+    for t in transactions:
+        writer.writerow([t.get(column, "") for column in EXPORT_COLUMNS])
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+    # The header was written first but only yielded with the first row; an empty export still gets it
+    if line.tell():
+        yield line.getvalue()
+
+
+def iter_jsonl(transactions):
+    for t in transactions:
+        yield json.dumps({column: t.get(column, "") for column in EXPORT_COLUMNS}, ensure_ascii=False) + "\n"
+
+
+def export_transactions(transactions, out, start=None, end=None, account=None, types=None, fmt="csv"):
+    """Stream the matching transactions to the binary file `out`. Returns how many were written."""
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    lines = iter_csv if fmt == "csv" else iter_jsonl
+    for line in lines(counted(matching(transactions, start, end, account, types))):
+        out.write(line.encode())
+    return count
+
+
+def spooled_export(transactions, **filters):
+    """export_transactions() into a buffer that moves to a temporary file beyond EXPORT_SPOOL_MAX_BYTES.
+
+    Returns the rewound buffer and the number of transactions in it.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    count = export_transactions(transactions, out, **filters)
+    out.seek(0)
+    return out, count
@@ -0,0 +1,157 @@
+import json
+import logging
+import math
+
+import numpy as np
+
+from config import FX_RATES_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class FxRates:
+    """Dated exchange rates, loaded from a local JSON file.
+
+    The file holds the value of one unit of each currency in a quote
+    currency, per date:
+
+        {"quote": "USD", "rates": {"2025-01-01": {"CHF": 1.10, "EUR": 1.04, "BTC": 94000}, ...}}
+
+    Dates need not list every currency. A conversion on a given date uses the
+    latest rate on or before it, or the earliest known rate for dates before
+    the first one. Currencies without any rate convert to NaN.
+    """
+
+    def __init__(self, quote, dates, currencies, values):
+        self.quote = quote
+        self.dates = np.array(dates)
+        self.currencies = list(currencies)
+        self.index = {currency: i for i, currency in enumerate(self.currencies)}
+        # values[d, c]: one unit of currency c in the quote currency on dates[d]
+        self.values = values
+        self._matrices = {}
+        self._lookups = {}
+
+    @classmethod
+    def from_json(cls, raw):
+        quote = raw["quote"]
+        dates = sorted(raw["rates"])
+        currencies = sorted({c for day in raw["rates"].values() for c in day} | {quote})
+        index = {currency: i for i, currency in enumerate(currencies)}
+        values = np.full((len(dates), len(currencies)), np.nan)
+        for row, day in enumerate(dates):
+            for currency, value in raw["rates"][day].items():
+                values[row, index[currency]] = value
+        values[:, index[quote]] = 1.0
+        # Carry each rate forward to later dates, then the first known rate back to earlier ones
+        for column in values.T:
+            known = np.flatnonzero(~np.isnan(column))
+            if len(known):
+                column[:] = column[known[np.clip(np.searchsorted(known, np.arange(len(column)), side="right") - 1, 0, None)]]
+        return cls(quote, dates, currencies, values)
+
+    @classmethod
+    def load(cls, path=FX_RATES_FILE):
+        """The rates in `path`, or None if there is no rates file."""
+        try:
+            with open(path, "r") as file:
+                raw = json.load(file)
+        except FileNotFoundError:
+            return None
+        if not raw.get("rates"):
+            logger.warning(f"{path} has no rates; amounts won't be converted")
+            return None
+        rates = cls.from_json(raw)
+        logger.info(f"Loaded FX rates for {len(rates.currencies)} currencies on {len(rates.dates)} dates from {path}")
+        return rates
+
+    def _row(self, date):
+        if date is None:
+            return len(self.dates) - 1
+        return max(int(np.searchsorted(self.dates, date, side="right")) - 1, 0)
+
+    def _column(self, currency):
+        return self.index.get(currency)
+
+    def matrix(self, date=None):
+        """The conversion matrix for `date` (the latest rates if None): matrix[i, j] converts currency i to j."""
+        row = self._row(date)
+        matrix = self._matrices.get(row)
+        if matrix is None:
+            values = self.values[row]
+            matrix = self._matrices[row] = np.divide.outer(values, values)
+        return matrix
+
+    def rate(self, date, from_currency, to_currency):
+        """One unit of `from_currency` in `to_currency` on `date`, cached per (date, pair)."""
+        key = (date, from_currency, to_currency)
+        rate = self._lookups.get(key)
+        if rate is None:
+            i, j = self._column(from_currency), self._column(to_currency)
+            rate = math.nan if i is None or j is None else float(self.matrix(date)[i, j])
+            self._lookups[key] = rate
+        return rate
+
+    def _to_base(self, base, date=None):
+        """A column converting each of self.currencies to `base`."""
+        j = self._column(base)
+        if j is None:
+            return np.full(len(self.currencies), np.nan)
+        return self.matrix(date)[:, j]
+
+    def _amount_matrix(self, rows):
+        """Stack amount dicts into a (len(rows), n_currencies) array; unknown currencies make their row NaN."""
+        amounts = np.zeros((len(rows), len(self.currencies)))
+        for r, row in enumerate(rows):
+            for currency, amount in row.items():
+                c = self._column(currency)
+                if c is None:
+                    if amount:
+                        amounts[r, 0] = np.nan
+                    continue
+                amounts[r, c] += amount
+        return amounts
+
+    def convert_totals(self, totals, base, date=None):
+        """{name: {currency: amount}} to {name: amount in base}, in one matrix product."""
+        names = list(totals)
+        values = self._amount_matrix([totals[name] for name in names]) @ self._to_base(base, date)
+        return dict(zip(names, values.tolist()))
+
+    def net_worth(self, balances, accounts, base, date=None):
+        """Settled plus pending balance of each account in `base`, and their total."""
+        totals = {}
+        for name in accounts:
+            merged = {}
+            for kind in ("settled", "pending"):
+                for currency, amount in balances.get(name, {}).get(kind, {}).items():
+                    merged[currency] = merged.get(currency, 0) + amount
+            totals[name] = merged
+        per_account = self.convert_totals(totals, base, date)
+        return per_account, math.fsum(per_account.values())
+
+    def historical_values(self, amounts, currencies, dates, base):
+        """Each amount in `base` at the rate of its own date, vectorized over the rows."""
+        rows = np.clip(np.searchsorted(self.dates, np.asarray(dates), side="right") - 1, 0, None)
+        columns = np.fromiter((self.index.get(c, -1) for c in currencies), np.intp, len(currencies))
+        j = self._column(base)
+        if j is None:
+            return np.full(len(amounts), np.nan)
+        values = self.values[rows, columns] / self.values[rows, j]
+        values[columns < 0] = np.nan
+        return np.asarray(amounts, dtype=float) * values
+
+    def spending_values(self, transactions, base):
+        """The amount sent in each of `transactions`, in `base` at its date's rate."""
+        if not transactions:
+            return np.zeros(0)
+        return self.historical_values(
+            [t["amount_sent"] for t in transactions],
+            [t["currency_sent"] for t in transactions],
+            [t["date"] for t in transactions],
+            base,
+        )
+
+
+def format_value(value):
+    return "n/a" if math.isnan(value) else f"{value:,.2f}"
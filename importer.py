@@ -0,0 +1,130 @@
+import csv
+import io
+from datetime import datetime
+from functools import lru_cache
+
+from config import (
+    CURRENCIES, TRANSACTION_TYPES, TRANSACTION_STATUSES, SIMPLE_TRANSACTION_TYPES,
+    CSV_COLUMN_MAP, CSV_DEFAULTS, CSV_DATE_FORMAT, DESC_TEMPLATE_SIMPLE, DESC_TEMPLATE_COMPLEX,
+)
+from storage import TRANSACTION_FIELDS
+
+AMOUNT_FIELDS = ("amount_sent", "amount_received")
+
+
+def read_rows(stream, column_map=CSV_COLUMN_MAP, encoding="utf-8-sig"):
+    """Yield (line number, {field: value}) for each row of a CSV byte stream, one row at a time.
+
+    `column_map` maps transaction fields to CSV column names; fields without
+    a column are left out and filled from the defaults during validation.
+    """
+    text = io.TextIOWrapper(stream, encoding=encoding, newline="")
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        return
+    positions = {name.strip(): i for i, name in enumerate(header)}
+    missing = [column for column in column_map.values() if column not in positions]
+    if missing:
+        raise ValueError(f"CSV is missing the column(s): {', '.join(missing)}")
+    columns = [(field, positions[column]) for field, column in column_map.items()]
+    for row in reader:
+        if not any(row):
+            continue
+        yield reader.line_num, {field: row[i].strip() if i < len(row) else "" for field, i in columns}
+
+
+def read_batches(stream, batch_size, column_map=CSV_COLUMN_MAP):
+    """read_rows(), grouped into lists of at most `batch_size` rows."""
+    batch = []
+    for row in read_rows(stream, column_map):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value, date_format):
+    """`value` as an ISO date. Cached: history files repeat the same dates many times, and strptime is slow."""
+    return datetime.strptime(value, date_format).strftime("%Y-%m-%d")
+
+
+def parse_amount(value):
+    """`value` as a float, with a decimal point or a decimal comma, as the conversation accepts.
+
+    Amounts with both, or with several of either ("1,234.50", "1.234,50",
+    "1,234,567"), are refused: which is the thousands separator can't be told.
+    """
+    value = str(value)
+    if value.count(",") + value.count(".") > 1:
+        raise ValueError(f"ambiguous amount {value!r}: use one decimal point or comma, no thousands separators")
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        raise ValueError(f"amount must be a number, not {value!r}") from None
+
+
+def describe(trans):
+    if trans["type"] in SIMPLE_TRANSACTION_TYPES:
+        return DESC_TEMPLATE_SIMPLE.format(
+            type=trans["type"].capitalize(), amount=trans["amount_sent"], currency=trans["currency_sent"]
+        )
+    return DESC_TEMPLATE_COMPLEX.format(type=trans["type"].capitalize())
+
+
+def validate_batch(rows, accounts, defaults=CSV_DEFAULTS, date_format=CSV_DATE_FORMAT):
+    """Turn parsed rows into transactions.
+
+    Returns the valid transactions and a list of (line number, reason) for
+    the rows that were skipped. Rows are checked the way the add transaction
+    conversation restricts its choices.
+    """
+    accounts = set(accounts)
+    transactions = []
+    errors = []
+    for line, row in rows:
+        values = {**defaults, **{field: value for field, value in row.items() if value != ""}}
+        try:
+            trans_type = values.get("type", "").lower()
+            if trans_type not in TRANSACTION_TYPES:
+                raise ValueError(f"unknown type {values.get('type')!r}")
+            trans = {"type": trans_type}
+            trans["date"] = parse_date(values["date"], date_format)
+            for field in AMOUNT_FIELDS:
+                trans[field] = parse_amount(values.get(field, 0))
+            if trans["amount_sent"] <= 0:
+                raise ValueError("amount_sent must be positive")
+            trans["currency_sent"] = values.get("currency_sent", "").upper()
+            trans["from"] = values.get("from", "")
+            trans["info"] = values.get("info", "")
+            if trans_type in SIMPLE_TRANSACTION_TYPES:
+                # Same defaults as the simplified conversation flow
+                trans.update(amount_received=0.0, currency_received="", to="", status="closed")
+            else:
+                trans["currency_received"] = values.get("currency_received", "").upper()
+                trans["to"] = values.get("to", "")
+                trans["status"] = values.get("status", "").lower()
+                if trans["amount_received"] < 0:
+                    raise ValueError("amount_received can't be negative")
+                if trans["to"] not in accounts:
+                    raise ValueError(f"unknown account {trans['to']!r}")
+                if trans["currency_received"] not in CURRENCIES:
+                    raise ValueError(f"unknown currency {trans['currency_received']!r}")
+                if trans["status"] not in TRANSACTION_STATUSES:
+                    raise ValueError(f"unknown status {trans['status']!r}")
+            if trans["from"] not in accounts:
+                raise ValueError(f"unknown account {trans['from']!r}")
+            if trans["currency_sent"] not in CURRENCIES:
+                raise ValueError(f"unknown currency {trans['currency_sent']!r}")
+        except KeyError as e:
+            errors.append((line, f"missing {e.args[0]}"))
+            continue
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        trans["description"] = describe(trans)
+        transactions.append({field: trans[field] for field in TRANSACTION_FIELDS})
+    return transactions, errors
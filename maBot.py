@@ -1,22 +1,47 @@
+import argparse
+import asyncio
+import bisect
+import csv
+import io
 import json
 import logging
 import os
-from datetime import datetime, timedelta
-import markdown2
-import weasyprint
+import re
+import subprocess
+import sys
+import time
+import weakref
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from itertools import chain
 
 from telegram import (
     Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
-    InlineKeyboardMarkup, InlineKeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto,
 )
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, CallbackContext,
-    ConversationHandler, CallbackQueryHandler,
+    ConversationHandler, CallbackQueryHandler, TypeHandler,
 )
+from telegram.constants import MessageLimit, MediaGroupLimit
 from telegram.error import TelegramError
 
-from markdown2 import markdown
-from weasyprint import HTML
+from storage import (
+    TRANSACTION_FIELDS, LEGACY_MIGRATED_MARKER, SqliteStorage, default_data, apply_record, get_storage, open_storage,
+    chat_directory,
+)
+from reports import ReportCache, TEXT_RENDERER, MARKDOWN_RENDERER, HTML_RENDERER, chunk_parts, build_report, iter_parts
+from rendering import RenderService, RenderQueueFull
+from fx import FxRates
+from metrics import METRICS, instrument_handlers
+from importer import read_batches, validate_batch
+from exporter import parse_filters, make_filters, spooled_export, export_transactions, EXPORT_FORMATS
+from balances import LegColumns, merge_balances, compare_balances, rebuild_from_checkpoint
+from partitions import MonthIndex, period_data, current_month, add_months, parse_month, month_over_month
+from query import TransactionIndex, parse_query, totals_by_currency
+from webhook import ChatOrderedUpdateProcessor, run_webhook
+from outbound import OutboundQueue, priority, NOTICE, BULK
+from digests import DigestService, FREQUENCIES
 
 # Set up logging
 logging.basicConfig(
@@ -29,7 +54,27 @@ try:
     from config import (
         TOKEN, BOT_HANDLER_ID, CURRENCIES, TRANSACTION_TYPES, TRANSACTION_STATUSES,
         SIMPLE_TRANSACTION_TYPES, SPENDING_CATEGORIES, TRANSACTION_LIST_LIMIT,
-        CONVERSATION_TIMEOUT, HEARTBEAT_INTERVAL_HOURS, DATA_FILE,
+        CONVERSATION_TIMEOUT, HEARTBEAT_INTERVAL_HOURS, DATA_FILE, STORAGE_MODE, BALANCE_CHECKPOINT_FILE,
+        LEDGER_CACHE_SIZE, LEGACY_LEDGER_CHAT_ID, JOURNAL_FILE, SQLITE_FILE, PARTITION_DIR,
+        UPDATE_MODE, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN,
+        MAX_CONCURRENT_UPDATES, RECORD_UPDATES_FILE,
+        JOURNAL_COMPACT_INTERVAL_MINUTES, GROUP_COMMIT_WINDOW_SECONDS, REPORT_CACHE_MAX_BYTES,
+        RENDER_WORKERS, RENDER_QUEUE_LIMIT, RENDER_WARM_UP_DELAY_SECONDS, MSG_RENDER_BUSY, MSG_IMAGE_REPORT,
+        MSG_IMAGE_REPORT_PAGES, MSG_IMAGE_REPORT_TRUNCATED,
+        IMAGE_REPORT_ROWS_PER_PAGE, IMAGE_REPORT_LOG_PAGES, IMAGE_PAGE_CACHE_MAX_BYTES,
+        REPORT_CHUNK_DELAY_SECONDS, REPORT_FILE_NAME, BTN_GENERATE_REPORT_FILE, MSG_REPORT_FILE,
+        BTN_OLDER, BTN_NEWER,
+        BASE_CURRENCY, ADMIN_USER_IDS, BALANCE_CHECKPOINT_INTERVAL_HOURS, MSG_ADMIN_ONLY, MSG_BALANCES_MATCH,
+        MSG_BALANCES_DIFFER, MSG_BALANCE_DIFFERENCE, MSG_BALANCES_APPLY_HINT, MSG_BALANCES_APPLIED,
+        CSV_IMPORT_BATCH_SIZE, CSV_IMPORT_PROGRESS_INTERVAL_SECONDS, CSV_IMPORT_MAX_ERRORS_SHOWN,
+        MSG_IMPORT_STARTED, MSG_IMPORT_PROGRESS, MSG_IMPORT_DONE, MSG_IMPORT_FAILED, MSG_IMPORT_SKIPPED_ROW,
+        MSG_EXPORT_USAGE, MSG_EXPORT_EMPTY, MSG_EXPORT_DONE,
+        BTN_GENERATE_PERIOD_REPORT, BTN_THIS_MONTH, BTN_LAST_3_MONTHS, MSG_PERIOD_CHOOSE, MSG_PERIOD_USAGE,
+        REPORT_HEADER_PERIOD, QUERY_RESULT_LIMIT, QUERY_KEYBOARD_SIZE, QUERY_HISTORY_SIZE,
+        MSG_QUERY_USAGE, MSG_QUERY_EMPTY, MSG_QUERY_RESULT, MSG_QUERY_TOTAL, MSG_QUERY_FREQUENT, MSG_QUERY_EXPIRED,
+        MSG_SUMMARY_HEADER, MSG_SUMMARY_LINE, MSG_SUMMARY_NEW, MSG_SUMMARY_EMPTY,
+        DIGEST_FREQUENCIES, DIGEST_TIME, DIGEST_WEEKDAY, DIGEST_MONTH_DAY, MSG_DIGEST_STATUS, MSG_DIGEST_NONE,
+        MSG_DIGEST_USAGE,
         BTN_ADD_TRANSACTION, BTN_LIST_TRANSACTIONS, BTN_GENERATE_REPORT,
         BTN_MANAGE_ACCOUNTS, BTN_DELETE_ALL_DATA, BTN_GENERATE_IMAGE_REPORT, BTN_CANCEL, BTN_BACK, BTN_DONE,
         BTN_YES, BTN_NONE, MSG_BOT_ACTIVE, MSG_CANCELLED, MSG_SESSION_TIMEOUT,
@@ -58,20 +103,279 @@ if not TOKEN or TOKEN == "YOUR_ACTUAL_BOT_TOKEN":
     exit(1)
 
 
-def load_data():
-    try:
-        with open(DATA_FILE, "r") as file:
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        default_data = {"transactions": [], "accounts": [], "balances": {}, "spending_categories": {}}
-        with open(DATA_FILE, "w") as file:
-            json.dump(default_data, file, indent=4)
-        return default_data
+class Ledger:
+    """The finance data, loaded once at startup and shared by all handlers.
+
+    Changes are applied in memory on the event loop, so handlers never
+    overwrite each other. They are then persisted by group commit: all changes
+    made within GROUP_COMMIT_WINDOW_SECONDS go to the storage in one atomic
+    write, and commit() returns once that write is durable.
+    """
+
+    def __init__(self, storage, fx=None, balance_checkpoint_file=BALANCE_CHECKPOINT_FILE):
+        self.storage = storage
+        self.balance_checkpoint_file = balance_checkpoint_file
+        with METRICS.timer("storage_seconds", op="load"):
+            self.data = storage.load()
+        # Transactions by month, for period reports, and secondary indexes for /query
+        self.months = MonthIndex(self.data["transactions"])
+        self.index = TransactionIndex(self.data["transactions"])
+        # The transactions' amounts and balance keys column by column, for /rebuild_balances
+        self.legs = LegColumns(self.data["transactions"])
+        # Bumped on every change; rendered reports are cached per version
+        self.version = 0
+        # The SQLite storage answers the report's account and category sections from its indexes
+        source = storage if isinstance(storage, SqliteStorage) else None
+        self.report_cache = ReportCache(REPORT_CACHE_MAX_BYTES, fx, BASE_CURRENCY, source)
+        # Changes not yet folded into a checkpoint (journal/sqlite)
+        self.dirty = False
+        self._pending = []
+        self._commit_task = None
+        self._write_lock = asyncio.Lock()
+        self._needs_full_save = False
+        self.commit_stats = {"batches": 0, "records": 0, "last_batch_size": 0, "last_latency_ms": 0.0, "max_latency_ms": 0.0}
+
+    async def commit(self, record):
+        apply_record(self.data, record)
+        if record["op"] == "transaction":
+            self.months.add(record["trans"])
+            self.index.add(record["trans"])
+            self.legs.add(record["trans"])
+        elif record["op"] == "transactions":
+            self.months.extend(record["trans"])
+            self.index.extend(record["trans"])
+            self.legs.extend(record["trans"])
+        self.version += 1
+        self.dirty = True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((record, future, time.perf_counter()))
+        if self._commit_task is None:
+            self._commit_task = loop.create_task(self._group_commit())
+        await future
+
+    async def reset(self):
+        async with self._write_lock:
+            # Anything still queued is superseded by the empty ledger
+            batch, self._pending = self._pending, []
+            self.data = default_data()
+            self.months = MonthIndex()
+            self.index = TransactionIndex()
+            self.legs = LegColumns()
+            self.version += 1
+            self.dirty = False
+            with METRICS.timer("storage_seconds", op="save"):
+                self.storage.save(self.data)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def render_report(self, renderer):
+        """The full report for the current version, re-rendering only what changed."""
+        return self.report_cache.render(self.data, self.version, renderer)
+
+    def report_pages(self):
+        """The report as standalone HTML pages for the image report, and whether it leaves out older rows."""
+        return self.report_cache.pages(
+            self.data, self.version, HTML_RENDERER, IMAGE_REPORT_ROWS_PER_PAGE, IMAGE_REPORT_LOG_PAGES
+        )
 
+    def report_parts(self, renderer):
+        """The report as an iterable of rendered rows, for sending it piece by piece."""
+        return self.report_cache.parts(self.data, self.version, renderer)
+
+    def period_report_parts(self, start, end, renderer):
+        """The report on the months `start` to `end` (YYYY-MM), built from those months alone."""
+        view = period_data(self.data, self.months, start, end)
+        report = build_report(view, self.report_cache.fx, self.report_cache.base)
+        return chain([REPORT_HEADER_PERIOD.format(start=start, end=end) + "\n\n"], iter_parts(report, renderer))
+
+    async def _group_commit(self):
+        await asyncio.sleep(GROUP_COMMIT_WINDOW_SECONDS)
+        self._commit_task = None
+        async with self._write_lock:
+            await self._write_pending()
+
+    async def _write_pending(self):
+        # Caller must hold _write_lock
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            if self._needs_full_save:
+                # An earlier batch failed, so the storage is missing changes; rewrite it from memory
+                with METRICS.timer("storage_seconds", op="save"):
+                    self.storage.save(self.data)
+                self._needs_full_save = False
+            else:
+                with METRICS.timer("storage_seconds", op="commit"):
+                    await self.storage.commit([record for record, _, _ in batch], self.data)
+        except Exception as e:
+            logger.error(f"Failed to commit {len(batch)} change(s): {e}")
+            METRICS.inc("storage_errors_total", op="commit")
+            self._needs_full_save = True
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        done = time.perf_counter()
+        latency_ms = (done - batch[0][2]) * 1000
+        stats = self.commit_stats
+        stats["batches"] += 1
+        stats["records"] += len(batch)
+        stats["last_batch_size"] = len(batch)
+        stats["last_latency_ms"] = latency_ms
+        stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+        METRICS.observe("ledger_commit_latency_seconds", latency_ms / 1000)
+        logger.debug(f"Committed {len(batch)} change(s) in {(done - started) * 1000:.1f} ms, latency {latency_ms:.1f} ms")
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def flush(self):
+        """Commit queued changes and checkpoint the storage if it has unsaved changes.
+
+        Returns True if a checkpoint was written.
+        """
+        async with self._write_lock:
+            # Loop until nothing is queued, then checkpoint without yielding, so the
+            # checkpoint covers exactly the changes that were committed
+            while self._pending:
+                await self._write_pending()
+            if not self.dirty:
+                return False
+            self.dirty = False
+            try:
+                if self._needs_full_save:
+                    # A failed batch left the storage missing changes, and an SQLite
+                    # checkpoint only folds in what was committed; rewrite it from memory
+                    with METRICS.timer("storage_seconds", op="save"):
+                        self.storage.save(self.data)
+                    self._needs_full_save = False
+                else:
+                    with METRICS.timer("storage_seconds", op="checkpoint"):
+                        await self.storage.checkpoint(self.data)
+            except Exception as e:
+                logger.error(f"Failed to flush ledger: {e}")
+                METRICS.inc("storage_errors_total", op="checkpoint")
+                self.dirty = True
+                return False
+            return True
+
+
+class LedgerCache:
+    """One Ledger per chat, the LEDGER_CACHE_SIZE most recently used held in memory.
+
+    Evicted ledgers are flushed in the background. Until they are written,
+    and for as long as a handler still holds one, get() hands out the same
+    object again rather than loading a second copy from storage.
+    """
+
+    def __init__(self, max_ledgers, open_ledger):
+        self.max_ledgers = max_ledgers
+        self.open_ledger = open_ledger
+        self.ledgers = OrderedDict()
+        # Every ledger still referenced anywhere, cached or not
+        self.live = weakref.WeakValueDictionary()
+        # Evicted ledgers whose flush failed; retried by flush_all()
+        self.unflushed = {}
+        self._flushing = set()
+
+    def get(self, chat_id):
+        ledger = self.ledgers.get(chat_id)
+        if ledger is not None:
+            self.ledgers.move_to_end(chat_id)
+            METRICS.inc("ledger_cache_lookups_total", result="hit")
+            return ledger
+        ledger = self.unflushed.pop(chat_id, None) or self.live.get(chat_id)
+        if ledger is not None:
+            METRICS.inc("ledger_cache_lookups_total", result="revived")
+        else:
+            METRICS.inc("ledger_cache_lookups_total", result="miss")
+            ledger = self.live[chat_id] = self.open_ledger(chat_id)
+        self.ledgers[chat_id] = ledger
+        while len(self.ledgers) > self.max_ledgers:
+            evicted_id, evicted = self.ledgers.popitem(last=False)
+            METRICS.inc("ledger_cache_evictions_total")
+            task = asyncio.get_running_loop().create_task(self._flush_evicted(evicted_id, evicted))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+        return ledger
+
+    async def _flush_evicted(self, chat_id, ledger):
+        await ledger.flush()
+        if ledger.dirty and chat_id not in self.ledgers:
+            # Kept until a later flush_all() gets it written
+            self.unflushed[chat_id] = ledger
+
+    def __len__(self):
+        return len(self.ledgers)
+
+    def values(self):
+        return list(self.ledgers.values())
+
+    async def flush_all(self):
+        """Flush every cached ledger and wait for evicted ones. Returns how many wrote a checkpoint."""
+        written = 0
+        for chat_id, ledger in list(self.unflushed.items()):
+            written += await ledger.flush()
+            if not ledger.dirty:
+                self.unflushed.pop(chat_id, None)
+        for ledger in self.values():
+            written += await ledger.flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing)
+        return written
+
+
+def open_chat_ledger(chat_id, fx=None):
+    directory = chat_directory(chat_id)
+    is_new = not os.path.exists(directory)
+    storage = open_storage(STORAGE_MODE, directory)
+    if is_new and chat_id == LEGACY_LEDGER_CHAT_ID:
+        # The ledger from before per-chat ledgers becomes this chat's
+        storage.save(get_storage().load())
+        # The shared files stay as a backup; this tells check_legacy_ledger() they've been taken over
+        with open(LEGACY_MIGRATED_MARKER, "w") as file:
+            file.write(f"{chat_id}\n")
+        logger.info(f"Moved the shared ledger to chat {chat_id}")
+    return Ledger(storage, fx, os.path.join(directory, os.path.basename(BALANCE_CHECKPOINT_FILE)))
+
+
+def check_legacy_ledger():
+    """Refuse to start while the shared ledger from before per-chat ledgers has no chat to go to.
+
+    Without LEGACY_LEDGER_CHAT_ID every chat starts an empty ledger, and the
+    shared one would be left on disk where nothing reads it. Only checks
+    which files exist, so starting costs nothing however big that ledger is.
+    """
+    if LEGACY_LEDGER_CHAT_ID is not None or os.path.exists(LEGACY_MIGRATED_MARKER):
+        return
+    legacy_files = [path for path in (DATA_FILE, JOURNAL_FILE, SQLITE_FILE, PARTITION_DIR) if os.path.exists(path)]
+    if legacy_files:
+        raise RuntimeError(
+            f"The shared ledger ({', '.join(legacy_files)}) has no chat to move to; set LEGACY_LEDGER_CHAT_ID "
+            "in config.py to the chat that takes it over, or move its files away (see README)"
+        )
 
-def save_data(data):
-    with open(DATA_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+
+def get_ledger(update: Update, context: CallbackContext) -> Ledger:
+    return context.application.bot_data["ledgers"].get(update.effective_chat.id)
+
+
+async def compact_journal(context: CallbackContext) -> None:
+    """Checkpoint the ledger: fold the journal into DATA_FILE or the SQLite WAL into the database."""
+    written = await context.application.bot_data["ledgers"].flush_all()
+    if written:
+        logger.info(f"Ledger checkpoints written for {written} chat(s)")
+
+
+async def on_shutdown(app: Application) -> None:
+    """Flush pending changes and stop the render workers when the bot shuts down."""
+    await app.bot_data["ledgers"].flush_all()
+    app.bot_data["render_service"].shutdown()
 
 
 # Callback data prefixes
@@ -86,6 +390,9 @@ CB_DONE = "done"
 CB_BACK = "back"
 CB_CANCEL = "cancel"
 CB_DELETE_ALL = "delete_all"
+CB_PAGE_PREFIX = "page:"
+CB_PERIOD_PREFIX = "period:"
+CB_QUERY_PREFIX = "query:"
 
 # States for conversation handler
 TRANS_TYPE, TRANS_AMOUNT_SENT, TRANS_CURRENCY_SENT, TRANS_FROM, \
@@ -109,8 +416,13 @@ def get_main_keyboard():
                 KeyboardButton(BTN_DELETE_ALL_DATA),
                 KeyboardButton(BTN_CANCEL),
             ],
-            [KeyboardButton(BTN_GENERATE_IMAGE_REPORT)
-            ]
+            [
+                KeyboardButton(BTN_GENERATE_IMAGE_REPORT),
+                KeyboardButton(BTN_GENERATE_REPORT_FILE),
+            ],
+            [
+                KeyboardButton(BTN_GENERATE_PERIOD_REPORT),
+            ],
         ],
         resize_keyboard=True,
     )
@@ -171,8 +483,7 @@ async def confirm_delete(update: Update, context: CallbackContext) -> int:
     text = update.message.text.strip()
     if text == CONFIRM_DELETE_TEXT:
         # Delete all data
-        default_data = {"transactions": [], "accounts": [], "balances": {}, "spending_categories": {}}
-        save_data(default_data)
+        await get_ledger(update, context).reset()
         await update.message.reply_text(
             MSG_DATA_DELETED, reply_markup=get_main_keyboard()
         )
@@ -189,7 +500,7 @@ async def confirm_delete(update: Update, context: CallbackContext) -> int:
 
 # Manage Accounts
 async def manage_accounts(update: Update, context: CallbackContext) -> int:
-    data = load_data()
+    data = get_ledger(update, context).data
     if data["accounts"]:
         accounts_list = ", ".join(data["accounts"])
         txt = MSG_ACCOUNTS_CURRENT.format(accounts=accounts_list)
@@ -204,7 +515,8 @@ async def manage_accounts(update: Update, context: CallbackContext) -> int:
 
 
 async def modify_accounts(update: Update, context: CallbackContext) -> int:
-    data = load_data()
+    ledger = get_ledger(update, context)
+    data = ledger.data
     text = update.message.text.strip()
     if text.lower() == BTN_BACK.lower():
         await update.message.reply_text(
@@ -217,16 +529,14 @@ async def modify_accounts(update: Update, context: CallbackContext) -> int:
         (i for i, m in enumerate(data["accounts"]) if m.lower() == name_ci), None
     )
     if existing_index is not None:
-        removed = data["accounts"].pop(existing_index)
-        # Also remove from balances if exists
-        data["balances"].pop(removed, None)
+        removed = data["accounts"][existing_index]
+        # Also removes the account from balances
+        await ledger.commit({"op": "remove_account", "account": removed})
         response = MSG_ACCOUNT_REMOVED.format(account=removed)
     else:
-        data["accounts"].append(text)
-        data["balances"][text] = {"settled": {}, "pending": {}}
+        await ledger.commit({"op": "add_account", "account": text})
         response = MSG_ACCOUNT_ADDED.format(account=text)
 
-    save_data(data)
     await update.message.reply_text(response, reply_markup=get_main_keyboard())
     return ConversationHandler.END
 
@@ -281,7 +591,7 @@ async def trans_currency_sent_cb(update: Update, context: CallbackContext) -> in
         currency = query.data[len(CB_CURRENCY_SENT_PREFIX):]
         context.user_data["currency_sent"] = currency
         
-        data = load_data()
+        data = get_ledger(update, context).data
         if not data.get("accounts"):
             await query.edit_message_text(MSG_NO_ACCOUNTS)
             await update.callback_query.message.reply_text(
@@ -356,7 +666,7 @@ async def trans_currency_received_cb(update: Update, context: CallbackContext) -
         currency = query.data[len(CB_CURRENCY_RECEIVED_PREFIX):]
         context.user_data["currency_received"] = currency
         
-        data = load_data()
+        data = get_ledger(update, context).data
         await query.edit_message_text(MSG_SELECT_TO_ACCOUNT)
         await update.callback_query.message.reply_text(
             MSG_SELECT_TO_ACCOUNT, 
@@ -438,13 +748,10 @@ async def finalize_transaction(update, context):
     
     context.user_data["description"] = description
 
-    data = load_data()
-    trans = {k: context.user_data[k] for k in ["date", "type", "amount_sent", "currency_sent", "from", "amount_received", "currency_received", "to", "status", "info", "description"]}
-    data["transactions"].append(trans)
+    trans = {k: context.user_data[k] for k in TRANSACTION_FIELDS}
 
-    # Update balances
-    await update_balances(data, trans)
-    save_data(data)
+    # Appends the transaction and updates balances
+    await get_ledger(update, context).commit({"op": "transaction", "trans": trans})
 
     # Format response message using config templates
     if trans_type in SIMPLE_TRANSACTION_TYPES:
@@ -478,104 +785,511 @@ async def finalize_transaction(update, context):
     return ConversationHandler.END
 
 
-async def update_balances(data, trans):
-    status = trans["status"]
-    from_acc = trans["from"]
-    to_acc = trans["to"]
-    sent_curr = trans["currency_sent"]
-    recv_curr = trans["currency_received"]
-    sent_amt = trans["amount_sent"]
-    recv_amt = trans["amount_received"]
-    trans_type = trans["type"]
-
-    if from_acc not in data["balances"]:
-        data["balances"][from_acc] = {"settled": {}, "pending": {}}
-    if to_acc and to_acc not in data["balances"]:
-        data["balances"][to_acc] = {"settled": {}, "pending": {}}
-
-    if status == "closed":
-        # Subtract sent from from_acc settled
-        data["balances"][from_acc]["settled"][sent_curr] = data["balances"][from_acc]["settled"].get(sent_curr, 0) - sent_amt
-        # Add received to to_acc settled (if there's a destination account)
-        if to_acc and recv_amt > 0:
-            data["balances"][to_acc]["settled"][recv_curr] = data["balances"][to_acc]["settled"].get(recv_curr, 0) + recv_amt
-    else:
-        # Pending
-        data["balances"][from_acc]["pending"][sent_curr] = data["balances"][from_acc]["pending"].get(sent_curr, 0) - sent_amt
-        if to_acc and recv_amt > 0:
-            data["balances"][to_acc]["pending"][recv_curr] = data["balances"][to_acc]["pending"].get(recv_curr, 0) + recv_amt
+# List transactions
+def transaction_row(t):
+    return f"| {t.get('date', '?')} | {t.get('type', '?')} | {t.get('amount_sent', 0)} | {t.get('currency_sent', '?')} | {t.get('from', '?')} | {t.get('amount_received', 0)} | {t.get('currency_received', '?')} | {t.get('to', '?')} | {t.get('status', '?')} | {t.get('info', '?')} |"
 
-    # Update spending categories using config
-    if trans_type in SPENDING_CATEGORIES:
-        cat = data["spending_categories"].get(trans_type, {"transactions": [], "total": {}})
-        cat["transactions"].append(trans)
-        cat["total"][sent_curr] = cat["total"].get(sent_curr, 0) + sent_amt
-        data["spending_categories"][trans_type] = cat
+
+def transactions_page(data, cursor=None):
+    """Text and inline keyboard for the page ending at transaction ID `cursor`.
+
+    Transactions are kept in ID order, so the page is located by bisecting
+    the in-memory list and sliced directly; no page costs more than its own
+    rows. The latest page is shown when `cursor` is None. Cursors are IDs
+    rather than offsets so pages stay put while new transactions arrive.
+    """
+    transactions = data["transactions"]
+    if cursor is None:
+        end = len(transactions)
+    else:
+        end = bisect.bisect_right(transactions, cursor, key=lambda t: t["id"])
+    # A cursor older than every transaction (e.g. after a reset) shows the first page
+    end = max(end, min(TRANSACTION_LIST_LIMIT, len(transactions)))
+    start = max(0, end - TRANSACTION_LIST_LIMIT)
+    lines = [TABLE_HEADER, TABLE_SEPARATOR]
+    for t in reversed(transactions[start:end]):
+        lines.append(transaction_row(t))
+    text = REPORT_HEADER_TRANSACTIONS + "\n" + "\n".join(lines)
+    buttons = []
+    if start > 0:
+        buttons.append(InlineKeyboardButton(
+            BTN_OLDER, callback_data=f"{CB_PAGE_PREFIX}{transactions[start - 1]['id']}"
+        ))
+    if end < len(transactions):
+        newer_end = min(end + TRANSACTION_LIST_LIMIT, len(transactions))
+        buttons.append(InlineKeyboardButton(
+            BTN_NEWER, callback_data=f"{CB_PAGE_PREFIX}{transactions[newer_end - 1]['id']}"
+        ))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
 
 
-# List transactions
 async def list_transactions(update: Update, context: CallbackContext) -> None:
-    data = load_data()
+    data = get_ledger(update, context).data
     if not data.get("transactions"):
         await update.message.reply_text(
             MSG_NO_TRANSACTIONS, reply_markup=get_main_keyboard()
         )
         return
-    items = data["transactions"][-TRANSACTION_LIST_LIMIT:][::-1]
-    lines = [TABLE_HEADER, TABLE_SEPARATOR]
-    for t in items:
-        lines.append(
-            f"| {t.get('date', '?')} | {t.get('type', '?')} | {t.get('amount_sent', 0)} | {t.get('currency_sent', '?')} | {t.get('from', '?')} | {t.get('amount_received', 0)} | {t.get('currency_received', '?')} | {t.get('to', '?')} | {t.get('status', '?')} | {t.get('info', '?')} |"
+    text, keyboard = transactions_page(data)
+    await update.message.reply_text(text, reply_markup=keyboard or get_main_keyboard())
+
+
+async def transactions_page_cb(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    data = get_ledger(update, context).data
+    if not data.get("transactions"):
+        await query.edit_message_text(MSG_NO_TRANSACTIONS)
+        return
+    try:
+        cursor = int(query.data[len(CB_PAGE_PREFIX):])
+    except ValueError:
+        return
+    text, keyboard = transactions_page(data, cursor)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except TelegramError as e:
+        # Pressing a button twice asks for the page already shown
+        logger.debug(f"Transactions page not updated: {e}")
+
+
+async def reply_chunks(message, parts, reply_markup):
+    """Reply with `parts` joined into as few messages as fit, `reply_markup` on the last."""
+    chunks = list(chunk_parts(parts, MessageLimit.MAX_TEXT_LENGTH))
+    for chunk in chunks[:-1]:
+        await message.reply_text(chunk)
+    await message.reply_text(chunks[-1], reply_markup=reply_markup)
+
+
+# Query transactions
+def remember_query(chat_data, text):
+    """Count a use of query `text`. The chat keeps its QUERY_HISTORY_SIZE most recently used queries."""
+    queries = chat_data.setdefault("queries", OrderedDict())
+    if text in queries:
+        queries.move_to_end(text)
+    else:
+        # Buttons refer to a query by its id, which stays the same while others are dropped
+        chat_data["last_query_id"] = chat_data.get("last_query_id", 0) + 1
+        queries[text] = {"id": chat_data["last_query_id"], "count": 0}
+        if len(queries) > QUERY_HISTORY_SIZE:
+            queries.popitem(last=False)
+    queries[text]["count"] += 1
+
+
+def build_query_inline_kb(chat_data):
+    """One button per frequent query of the chat, most used first, or None before the first query."""
+    queries = chat_data.get("queries", {})
+    frequent = sorted(queries, key=lambda text: queries[text]["count"], reverse=True)[:QUERY_KEYBOARD_SIZE]
+    if not frequent:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text, callback_data=f"{CB_QUERY_PREFIX}{queries[text]['id']}")] for text in frequent]
+    )
+
+
+def query_result_lines(matches):
+    """The latest QUERY_RESULT_LIMIT matches, then the count and sum of every currency sent."""
+    shown = matches[-QUERY_RESULT_LIMIT:]
+    lines = [MSG_QUERY_RESULT.format(count=len(matches), shown=len(shown)), TABLE_HEADER, TABLE_SEPARATOR]
+    lines.extend(transaction_row(t) for t in reversed(shown))
+    for currency, (count, total) in sorted(totals_by_currency(matches).items()):
+        lines.append(MSG_QUERY_TOTAL.format(currency=currency, count=count, total=total))
+    return lines
+
+
+async def run_query(update, context, message, tokens):
+    try:
+        query, text = parse_query(tokens)
+    except ValueError as e:
+        await message.reply_text(
+            MSG_QUERY_USAGE.format(error=e), reply_markup=build_query_inline_kb(context.chat_data) or get_main_keyboard()
         )
-    text = REPORT_HEADER_TRANSACTIONS + "\n" + "\n".join(lines)
-    await update.message.reply_text(text, reply_markup=get_main_keyboard())
+        return
+    remember_query(context.chat_data, text)
+    ledger = get_ledger(update, context)
+    matches = ledger.index.search(ledger.data["transactions"], query)
+    keyboard = build_query_inline_kb(context.chat_data)
+    if not matches:
+        await message.reply_text(MSG_QUERY_EMPTY.format(query=text), reply_markup=keyboard)
+        return
+    await reply_chunks(message, (line + "\n" for line in query_result_lines(matches)), keyboard)
+
+
+async def query_cmd(update: Update, context: CallbackContext) -> None:
+    """`/query [type=a,b] [account=NAME] [status=open] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [min=N] [max=N]`"""
+    if not context.args and build_query_inline_kb(context.chat_data):
+        await update.message.reply_text(MSG_QUERY_FREQUENT, reply_markup=build_query_inline_kb(context.chat_data))
+        return
+    await run_query(update, context, update.message, context.args or [])
+
+
+async def query_cb(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    query_id = query.data[len(CB_QUERY_PREFIX):]
+    saved = context.chat_data.get("queries", {})
+    text = next((text for text, entry in saved.items() if str(entry["id"]) == query_id), None)
+    if text is None:
+        # Dropped for more recent queries, or lost in a restart
+        await query.message.reply_text(MSG_QUERY_EXPIRED, reply_markup=get_main_keyboard())
+        return
+    await run_query(update, context, query.message, text.split())
+
+
+def change_text(this, last):
+    return MSG_SUMMARY_NEW if not last else f"{(this - last) / abs(last):+.0%}"
+
+
+async def summary_cmd(update: Update, context: CallbackContext) -> None:
+    """`/summary`: spending per category this month against last month, from the per-month totals."""
+    this_month = current_month()
+    last_month = add_months(this_month, -1)
+    rows = month_over_month(get_ledger(update, context).data["spending_categories"], this_month)
+    if not rows:
+        await update.message.reply_text(
+            MSG_SUMMARY_EMPTY.format(this=this_month, last=last_month), reply_markup=get_main_keyboard()
+        )
+        return
+    lines = [MSG_SUMMARY_HEADER.format(this=this_month, last=last_month)]
+    for cat_name, currency, this, last in rows:
+        lines.append(MSG_SUMMARY_LINE.format(
+            category=cat_name.capitalize(), currency=currency, this=this, last=last, change=change_text(this, last)
+        ))
+    await reply_chunks(update.message, (line + "\n" for line in lines), get_main_keyboard())
+
+
+async def digest_cmd(update: Update, context: CallbackContext) -> None:
+    """`/digest daily|weekly|monthly` subscribes the chat to digests, `/digest off` stops them all."""
+    digests = context.application.bot_data["digests"]
+    chat_id = update.effective_chat.id
+    args = [arg.lower() for arg in context.args or []]
+    if args == ["off"]:
+        digests.unsubscribe(chat_id)
+    elif args:
+        unknown = [arg for arg in args if arg not in DIGEST_FREQUENCIES]
+        if unknown:
+            await update.message.reply_text(
+                MSG_DIGEST_USAGE.format(error=f"can't use {unknown[0]!r}", frequencies="|".join(DIGEST_FREQUENCIES)),
+                reply_markup=get_main_keyboard(),
+            )
+            return
+        digests.subscribe(chat_id, args)
+    current = sorted(digests.subscriptions.get(chat_id, ()), key=FREQUENCIES.index)
+    await update.message.reply_text(
+        MSG_DIGEST_STATUS.format(current=", ".join(current) or MSG_DIGEST_NONE), reply_markup=get_main_keyboard()
+    )
+
+
+async def send_digests(context: CallbackContext) -> None:
+    """Send the digests of the job's frequency that are due today."""
+    await context.application.bot_data["digests"].send_due(context.application, context.job.data, date.today())
 
 
 # Generate Report
+def send_report(update, context, message, parts):
+    """Send a report from a background task, after any earlier report to the chat.
+
+    Its chunks go out at the chat's flood limit, about one a second. Sent
+    from the handler, they would hold the chat's place in the update
+    processor that long, and the chat's next message (a reply, /cancel)
+    would wait for the whole report.
+    """
+    previous = context.chat_data.get("report_task")
+    context.chat_data["report_task"] = context.application.create_task(
+        send_report_chunks(message, parts, previous), update=update
+    )
+
+
+async def send_report_chunks(message, parts, previous=None):
+    if previous is not None and not previous.done():
+        # A chat's reports arrive one after the other, not interleaved
+        await asyncio.wait([previous])
+    # Chunks are rendered as they are sent, so the first message goes out before
+    # the rest of the report exists. Each one is held back until the next is
+    # ready, so the keyboard can go on the last.
+    chunks = chunk_parts(parts, MessageLimit.MAX_TEXT_LENGTH)
+    with priority(BULK):
+        pending = next(chunks)
+        for chunk in chunks:
+            await message.reply_text(pending)
+            await asyncio.sleep(REPORT_CHUNK_DELAY_SECONDS)
+            pending = chunk
+        await message.reply_text(pending, reply_markup=get_main_keyboard())
+
+
 async def generate_report(update: Update, context: CallbackContext) -> None:
-    data = load_data()
-    transactions = data.get("transactions", [])
-
-    # Transactions Log using config header
-    log = f"{REPORT_HEADER_LOG}\n\n{TABLE_HEADER_FULL}\n"
-    for t in transactions:
-        log += f"| {t['date']} | {t['type']} | {t['amount_sent']} | {t['currency_sent']} | {t['from']} | {t['amount_received']} | {t['currency_received']} | {t['to']} | {t['status']} | {t['info']} |\n"
-
-    # Accounts using config header
-    accounts_str = f"\n---\n{REPORT_HEADER_ACCOUNTS}\n"
-    for acc in data.get("accounts", []):
-        accounts_str += f"## {acc}\n"
-        acc_trans = [t for t in transactions if t['from'] == acc or t['to'] == acc]
-        for t in acc_trans:
-            direction = "Sent" if t['from'] == acc else "Received"
-            opp_acc = t['to'] if t['from'] == acc else t['from']
-            accounts_str += f"- {t['date']} | {t['type']} | {direction} {t['amount_sent']} {t['currency_sent']} → {opp_acc} | {t['status']}  \n"
-        
-        settled_balances = data["balances"].get(acc, {"settled": {}}).get("settled", {})
-        pending_balances = data["balances"].get(acc, {"pending": {}}).get("pending", {})
-        
-        settled = ", ".join([f"{curr}: {amt}" for curr, amt in settled_balances.items() if amt != 0])
-        pending = ", ".join([f"{curr}: {amt}" for curr, amt in pending_balances.items() if amt != 0])
-        
-        accounts_str += f"**Balance:**  \n- {REPORT_BALANCE_SETTLED}: {settled or 'None'}  \n- {REPORT_BALANCE_PENDING}: {pending or 'None'}\n---\n"
+    send_report(update, context, update.message, get_ledger(update, context).report_parts(TEXT_RENDERER))
+
+
+def build_period_inline_kb():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(BTN_THIS_MONTH, callback_data=f"{CB_PERIOD_PREFIX}this_month"),
+        InlineKeyboardButton(BTN_LAST_3_MONTHS, callback_data=f"{CB_PERIOD_PREFIX}last_3_months"),
+    ]])
+
+
+async def period_report(update: Update, context: CallbackContext) -> None:
+    """`/report YYYY-MM [YYYY-MM]` reports on a range of months; without a range, offers the usual ones."""
+    if not context.args:
+        await update.message.reply_text(MSG_PERIOD_CHOOSE, reply_markup=build_period_inline_kb())
+        return
+    try:
+        if len(context.args) > 2:
+            raise ValueError("give at most two months")
+        start = parse_month(context.args[0])
+        end = parse_month(context.args[-1])
+        if end < start:
+            raise ValueError("the range ends before it starts")
+    except ValueError as e:
+        await update.message.reply_text(MSG_PERIOD_USAGE.format(error=e), reply_markup=get_main_keyboard())
+        return
+    send_report(update, context, update.message, get_ledger(update, context).period_report_parts(start, end, TEXT_RENDERER))
+
+
+async def period_report_cb(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await query.answer()
+    end = current_month()
+    choice = query.data[len(CB_PERIOD_PREFIX):]
+    if choice == "this_month":
+        start = end
+    elif choice == "last_3_months":
+        start = add_months(end, -2)
+    else:
+        return
+    send_report(update, context, query.message, get_ledger(update, context).period_report_parts(start, end, TEXT_RENDERER))
+
+
+async def generate_report_file(update: Update, context: CallbackContext) -> None:
+    buffer = io.BytesIO()
+    for part in get_ledger(update, context).report_parts(MARKDOWN_RENDERER):
+        buffer.write(part.encode())
+    buffer.seek(0)
+    await update.message.reply_document(
+        document=buffer,
+        filename=REPORT_FILE_NAME,
+        caption=MSG_REPORT_FILE,
+        reply_markup=get_main_keyboard(),
+    )
 
-    # Spending using config header
-    spending = f"\n{REPORT_HEADER_SPENDING}\n"
-    for cat_name, cat in data.get("spending_categories", {}).items():
-        if cat_name in SPENDING_CATEGORIES:  # Only show configured spending categories
-            spending += f"## {cat_name.capitalize()}\n"
-            for t in cat.get("transactions", []):
-                spending += f"{t['date']} | {t['amount_sent']} {t['currency_sent']} | {t['info']}\n"
-            totals = " ".join([f"{curr}: {amt}" for curr, amt in cat.get("total", {}).items()])
-            spending += f"Total | {totals}\n"
 
-    full_report = log + accounts_str + spending
-    await update.message.reply_text(full_report, reply_markup=get_main_keyboard())
+def _ms(seconds):
+    return f"{seconds * 1000:.1f}"
+
+
+def stats_summary():
+    """Rolling p50/p95/p99 latencies (over the last METRICS_WINDOW samples) and totals, one line each."""
+    lines = []
+    for labels, count, p50, p95, p99 in METRICS.summary("bot_handler_latency_seconds"):
+        name = labels["handler"]
+        if "conversation" in labels:
+            name += f" [{labels['conversation']}:{labels['state']}]"
+        errors = METRICS.counter("bot_handler_errors_total", **labels)
+        lines.append(f"{name}: {count} calls, p50/p95/p99 {_ms(p50)}/{_ms(p95)}/{_ms(p99)} ms, {errors} errors")
+    series = [
+        ("ledger_commit_latency_seconds", "commit latency", None),
+        ("storage_seconds", "storage", "op"),
+        ("report_render_seconds", "report render", "renderer"),
+        ("report_image_render_seconds", "image render", None),
+        ("outbound_queue_seconds", "outbound wait", "priority"),
+        ("startup_seconds", "startup", "phase"),
+    ]
+    for metric, title, label in series:
+        for labels, count, p50, p95, p99 in METRICS.summary(metric):
+            name = f"{title} {labels[label]}" if label else title
+            lines.append(f"{name}: {count} calls, p50/p95/p99 {_ms(p50)}/{_ms(p95)}/{_ms(p99)} ms")
+    read = sum(v for (m, labels), v in METRICS.counters.items() if m == "storage_bytes_total" and ("direction", "read") in labels)
+    written = METRICS.counter_total("storage_bytes_total") - read
+    lines.append(f"storage bytes: {read} read, {written} written, {METRICS.counter_total('storage_errors_total')} errors")
+    lines.append(f"image render errors: {METRICS.counter_total('report_image_errors_total')}")
+    lines.append(f"outbound flood limit hits: {METRICS.counter_total('outbound_retry_after_total')}")
+    digests = {
+        result: sum(v for (m, labels), v in METRICS.counters.items() if m == "digests_total" and ("result", result) in labels)
+        for result in ("built", "sent", "retried", "failed")
+    }
+    lines.append(
+        f"digests: {digests['built']} built, {digests['sent']} sent, {digests['retried']} retried, {digests['failed']} failed"
+    )
+    lines.append(
+        f"ledger cache: {METRICS.counter('ledger_cache_lookups_total', result='hit')} hits, "
+        f"{METRICS.counter('ledger_cache_lookups_total', result='miss')} misses, "
+        f"{METRICS.counter('ledger_cache_lookups_total', result='revived')} revived, "
+        f"{METRICS.counter_total('ledger_cache_evictions_total')} evictions"
+    )
+    return lines
+
+
+async def stats_cmd(update: Update, context: CallbackContext) -> None:
+    """`/stats` shows latency percentiles and totals; `/stats prometheus` sends them in the exposition format."""
+    if not is_admin(update):
+        await update.message.reply_text(MSG_ADMIN_ONLY, reply_markup=get_main_keyboard())
+        return
+    if context.args and context.args[0] == "prometheus":
+        await update.message.reply_document(
+            document=io.BytesIO(METRICS.prometheus().encode()),
+            filename="metrics.prom",
+            reply_markup=get_main_keyboard(),
+        )
+        return
+    cache = get_ledger(update, context).report_cache
+    lines = stats_summary() + [f"report cache: {cache.hits} hits, {cache.misses} misses, {cache.size()} chars"]
+    await reply_chunks(update.message, (line + "\n" for line in lines), get_main_keyboard())
 
 
 async def send_alive(context: CallbackContext) -> None:
     """Send a periodic heartbeat message to confirm the bot is running."""
     logger.info("Bot heartbeat - I'm alive!")
+    render_stats = context.application.bot_data["render_service"].stats
+    if render_stats["renders"]:
+        logger.info(
+            f"Image renders: {render_stats['renders']} ({render_stats['shared']} shared, {render_stats['cached']} pages cached, "
+            f"{render_stats['rejected']} rejected, {render_stats['failed']} failed), "
+            f"queue depth now {context.application.bot_data['render_service'].queue_depth}, "
+            f"max {render_stats['max_queue_depth']}"
+        )
+    for ledger in context.application.bot_data["ledgers"].values():
+        stats = ledger.commit_stats
+        if stats["batches"]:
+            logger.info(
+                f"Commits to {ledger.storage.path}: {stats['records']} changes in {stats['batches']} batches "
+                f"(avg batch {stats['records'] / stats['batches']:.1f}, last {stats['last_batch_size']}), "
+                f"latency last {stats['last_latency_ms']:.1f} ms, max {stats['max_latency_ms']:.1f} ms"
+            )
+    for line in stats_summary():
+        logger.info(line)
+
+
+async def import_csv(update: Update, context: CallbackContext) -> None:
+    """Import the transactions in an uploaded CSV document.
+
+    The file is parsed row by row and committed in batches of
+    CSV_IMPORT_BATCH_SIZE: each batch is one journal record and one balance
+    update, and the progress message is edited as batches go in.
+    """
+    document = update.message.document
+    name = document.file_name
+    ledger = get_ledger(update, context)
+    start = time.perf_counter()
+    progress = await update.message.reply_text(MSG_IMPORT_STARTED.format(name=name))
+    buffer = io.BytesIO()
+    file = await document.get_file()
+    await file.download_to_memory(buffer)
+    buffer.seek(0)
+
+    imported = 0
+    skipped = []
+    last_progress = time.monotonic()
+    try:
+        for batch in read_batches(buffer, CSV_IMPORT_BATCH_SIZE):
+            transactions, errors = validate_batch(batch, ledger.data["accounts"])
+            skipped.extend(errors)
+            if transactions:
+                await ledger.commit({"op": "transactions", "trans": transactions})
+                imported += len(transactions)
+            if time.monotonic() - last_progress >= CSV_IMPORT_PROGRESS_INTERVAL_SECONDS:
+                with priority(NOTICE):
+                    await progress.edit_text(MSG_IMPORT_PROGRESS.format(name=name, imported=imported, skipped=len(skipped)))
+                last_progress = time.monotonic()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        logger.warning(f"CSV import of {name} failed: {e}")
+        await update.message.reply_text(
+            MSG_IMPORT_FAILED.format(name=name, imported=imported, error=e), reply_markup=get_main_keyboard()
+        )
+        return
+
+    lines = [MSG_IMPORT_DONE.format(name=name, imported=imported, skipped=len(skipped), seconds=time.perf_counter() - start)]
+    for line, reason in skipped[:CSV_IMPORT_MAX_ERRORS_SHOWN]:
+        lines.append(MSG_IMPORT_SKIPPED_ROW.format(line=line, reason=reason))
+    await update.message.reply_text("\n".join(lines), reply_markup=get_main_keyboard())
+
+
+async def export_cmd(update: Update, context: CallbackContext) -> None:
+    """`/export [from=YYYY-MM-DD] [to=YYYY-MM-DD] [account=NAME] [type=a,b] [format=csv|jsonl]`"""
+    try:
+        export_filters = parse_filters(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(MSG_EXPORT_USAGE.format(error=e), reply_markup=get_main_keyboard())
+        return
+    # Written in a thread from a snapshot of the list; the rows themselves never change
+    transactions = list(get_ledger(update, context).data["transactions"])
+    out, count = await asyncio.to_thread(spooled_export, transactions, **export_filters)
+    with out:
+        if not count:
+            await update.message.reply_text(MSG_EXPORT_EMPTY, reply_markup=get_main_keyboard())
+            return
+        await update.message.reply_document(
+            document=out,
+            filename=f"transactions.{export_filters['fmt']}",
+            caption=MSG_EXPORT_DONE.format(count=count),
+            reply_markup=get_main_keyboard(),
+        )
+
+
+async def rebuild_ledger_balances(ledger):
+    """Rebuild the ledger's balances from its transactions, checkpointing the result.
+
+    The rebuild runs in a thread on a snapshot of the transaction list;
+    transactions added meanwhile are folded in afterwards.
+    """
+    transactions = ledger.data["transactions"][:]
+    legs = ledger.legs
+    rebuilt, replayed = await asyncio.to_thread(
+        rebuild_from_checkpoint, transactions, legs, ledger.balance_checkpoint_file
+    )
+    if legs is not ledger.legs:
+        # The ledger was reset meanwhile
+        return ledger.legs.balances(), len(ledger.legs)
+    newer = len(legs) - len(transactions)
+    if newer:
+        rebuilt = merge_balances(rebuilt, legs.balances(len(transactions)))
+    return rebuilt, replayed + newer
+
+
+async def checkpoint_balances(context: CallbackContext) -> None:
+    """Keep the balance checkpoint recent, so /rebuild_balances only replays the latest transactions."""
+    replayed = 0
+    ledgers = context.application.bot_data["ledgers"].values()
+    for ledger in ledgers:
+        replayed += (await rebuild_ledger_balances(ledger))[1]
+    logger.info(f"Balance checkpoints written for {len(ledgers)} chat(s) ({replayed} transactions replayed)")
+
+
+def is_admin(update: Update) -> bool:
+    # Nobody is an admin until ADMIN_USER_IDS names them
+    user = update.effective_user
+    return user is not None and user.id in ADMIN_USER_IDS
+
+
+async def rebuild_balances_cmd(update: Update, context: CallbackContext) -> None:
+    """Check the stored balances against the transaction log; `/rebuild_balances apply` replaces them."""
+    if not is_admin(update):
+        await update.message.reply_text(MSG_ADMIN_ONLY, reply_markup=get_main_keyboard())
+        return
+    ledger = get_ledger(update, context)
+    start = time.perf_counter()
+    rebuilt, replayed = await rebuild_ledger_balances(ledger)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    differences = compare_balances(ledger.data["balances"], rebuilt)
+    if not differences:
+        await update.message.reply_text(
+            MSG_BALANCES_MATCH.format(replayed=replayed, ms=elapsed_ms), reply_markup=get_main_keyboard()
+        )
+        return
+
+    if context.args and context.args[0] == "apply":
+        await ledger.commit({"op": "set_balances", "balances": rebuilt})
+        # Account footers are only re-rendered for accounts with new transactions
+        ledger.report_cache.clear()
+        footer = MSG_BALANCES_APPLIED
+    else:
+        footer = MSG_BALANCES_APPLY_HINT
+    lines = [MSG_BALANCES_DIFFER.format(count=len(differences), replayed=replayed, ms=elapsed_ms)]
+    for account, kind, currency, stored, rebuilt_amount in differences:
+        lines.append(MSG_BALANCE_DIFFERENCE.format(
+            account=account, kind=kind, currency=currency, stored=stored, rebuilt=rebuilt_amount
+        ))
+    lines.append(footer)
+    await reply_chunks(update.message, (line + "\n" for line in lines), get_main_keyboard())
 
 
 async def cancel(update: Update, context: CallbackContext) -> int:
@@ -588,110 +1302,122 @@ async def cancel(update: Update, context: CallbackContext) -> int:
 async def on_timeout(update: Update, context: CallbackContext) -> int:
     chat = update.effective_chat
     if chat:
-        await context.bot.send_message(
-            chat_id=chat.id,
-            text=MSG_SESSION_TIMEOUT,
-            reply_markup=get_main_keyboard(),
-        )
+        # Not rate_limit_args: the bot refuses those when built without the outbound queue
+        with priority(NOTICE):
+            await context.bot.send_message(
+                chat_id=chat.id,
+                text=MSG_SESSION_TIMEOUT,
+                reply_markup=get_main_keyboard(),
+            )
     return ConversationHandler.END
 
 
 
 async def generate_image_report(update: Update, context: CallbackContext) -> None:
-    data = load_data()
-    transactions = data.get("transactions", [])
-
-    # Reuse the same report generation logic as `generate_report`
-    log = f"{REPORT_HEADER_LOG}\n\n{TABLE_HEADER_FULL}\n"
-    for t in transactions:
-        log += f"| {t['date']} | {t['type']} | {t['amount_sent']} | {t['currency_sent']} | {t['from']} | {t['amount_received']} | {t['currency_received']} | {t['to']} | {t['status']} | {t['info']} |\n"
-
-    accounts_str = f"\n---\n{REPORT_HEADER_ACCOUNTS}\n"
-    for acc in data.get("accounts", []):
-        accounts_str += f"## {acc}\n"
-        acc_trans = [t for t in transactions if t['from'] == acc or t['to'] == acc]
-        for t in acc_trans:
-            direction = "Sent" if t['from'] == acc else "Received"
-            opp_acc = t['to'] if t['from'] == acc else t['from']
-            accounts_str += f"- {t['date']} | {t['type']} | {direction} {t['amount_sent']} {t['currency_sent']} → {opp_acc} | {t['status']}  \n"
-        
-        settled_balances = data["balances"].get(acc, {"settled": {}}).get("settled", {})
-        pending_balances = data["balances"].get(acc, {"pending": {}}).get("pending", {})
-        
-        settled = ", ".join([f"{curr}: {amt}" for curr, amt in settled_balances.items() if amt != 0])
-        pending = ", ".join([f"{curr}: {amt}" for curr, amt in pending_balances.items() if amt != 0])
-        
-        accounts_str += f"**Balance:** \n- {REPORT_BALANCE_SETTLED}: {settled or 'None'}  \n- {REPORT_BALANCE_PENDING}: {pending or 'None'}\n---\n"
-
-    spending = f"\n{REPORT_HEADER_SPENDING}\n"
-    for cat_name, cat in data.get("spending_categories", {}).items():
-        if cat_name in SPENDING_CATEGORIES:
-            spending += f"## {cat_name.capitalize()}\n"
-            for t in cat.get("transactions", []):
-                spending += f"{t['date']} | {t['amount_sent']} {t['currency_sent']} | {t['info']}\n"
-            totals = " ".join([f"{curr}: {amt}" for curr, amt in cat.get("total", {}).items()])
-            spending += f"Total | {totals}\n"
-
-    full_report = log + accounts_str + spending
-
-    # Convert Markdown to HTML with a basic stylesheet for readability
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Finance Report</title>
-        <style>
-            body {{ font-family: monospace; font-size: 14px; white-space: pre; }}
-            pre {{ margin: 0; }}
-            h1, h2 {{ margin-top: 20px; }}
-            table {{ border-collapse: collapse; }}
-            th, td {{ border: 1px solid black; padding: 5px; }}
-        </style>
-    </head>
-    <body>
-        <pre>{full_report}</pre>
-    </body>
-    </html>
-    """
-    
-    # Render HTML to image
-    image_path = "report.png"
+    pages, truncated = get_ledger(update, context).report_pages()
+
+    # Rendered in worker processes, so other chats stay responsive meanwhile
     try:
-        HTML(string=html_content).write_png(image_path)
-        await update.message.reply_photo(
-            photo=open(image_path, 'rb'),
-            reply_markup=get_main_keyboard(),
-            caption="Here is your report as an image."
-        )
+        pngs = await context.application.bot_data["render_service"].render_pages(pages)
+    except RenderQueueFull:
+        await update.message.reply_text(MSG_RENDER_BUSY, reply_markup=get_main_keyboard())
+        return
     except Exception as e:
         logger.error(f"Error generating image report: {e}")
         await update.message.reply_text(
             "Sorry, there was an error generating the image report. Please try again later.",
             reply_markup=get_main_keyboard()
         )
-    finally:
-        # Clean up the generated file
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        return
 
+    caption = MSG_IMAGE_REPORT if len(pngs) == 1 else MSG_IMAGE_REPORT_PAGES
+    if truncated:
+        # Older transactions and entries don't fit the pages; say where to find them
+        caption += "\n" + MSG_IMAGE_REPORT_TRUNCATED.format(button=BTN_GENERATE_REPORT)
+    if len(pngs) == 1:
+        await update.message.reply_photo(
+            photo=pngs[0],
+            reply_markup=get_main_keyboard(),
+            caption=caption
+        )
+        return
+    for start in range(0, len(pngs), MediaGroupLimit.MAX_MEDIA_LENGTH):
+        group = pngs[start:start + MediaGroupLimit.MAX_MEDIA_LENGTH]
+        if len(group) == 1:
+            # A media group needs at least two items
+            await update.message.reply_photo(photo=group[0])
+            continue
+        await update.message.reply_media_group(
+            [InputMediaPhoto(png, caption=caption if start == 0 and i == 0 else None) for i, png in enumerate(group)]
+        )
 
 
+async def warm_up_renderer(context: CallbackContext) -> None:
+    """Start the render workers and load WeasyPrint in them once the bot is up, instead of on the first image report."""
+    try:
+        await context.application.bot_data["render_service"].warm_up()
+    except Exception as e:
+        # The first image report starts them instead
+        logger.warning(f"Render warm-up failed: {e}")
+
+
+async def record_update(update: Update, context: CallbackContext) -> None:
+    """Append every incoming update to RECORD_UPDATES_FILE, for replaying it with benchmark.py --updates."""
+    with open(RECORD_UPDATES_FILE, "a") as file:
+        file.write(json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
 
-def main():
-    data = load_data()
-    app = Application.builder().token(TOKEN).build()
 
+def build_application(request=None, limit_outbound=True):
+    """The bot with its handlers and jobs.
+
+    `request` replaces the connection to the Bot API (see
+    webhook.OfflineBotApi); `limit_outbound` holds sends to the flood limits.
+    """
+    builder = (
+        Application.builder().token(TOKEN).post_shutdown(on_shutdown)
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if limit_outbound:
+        builder = builder.rate_limiter(OutboundQueue())
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    with METRICS.timer("startup_seconds", phase="application"):
+        app = builder.build()
+    with METRICS.timer("startup_seconds", phase="fx rates"):
+        fx = FxRates.load()
+    app.bot_data["ledgers"] = LedgerCache(LEDGER_CACHE_SIZE, lambda chat_id: open_chat_ledger(chat_id, fx))
+    app.bot_data["digests"] = DigestService()
+    app.bot_data["render_service"] = RenderService(RENDER_WORKERS, RENDER_QUEUE_LIMIT, IMAGE_PAGE_CACHE_MAX_BYTES)
+
+    started = time.perf_counter()
+    if RECORD_UPDATES_FILE:
+        # Its own group, so it sees every update before the handlers below
+        app.add_handler(TypeHandler(Update, record_update), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("cancel", cancel))
+    app.add_handler(CommandHandler("rebuild_balances", rebuild_balances_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("report", period_report))
+    app.add_handler(CommandHandler("query", query_cmd))
+    app.add_handler(CommandHandler("summary", summary_cmd))
+    app.add_handler(CommandHandler("digest", digest_cmd))
+    app.add_handler(CallbackQueryHandler(query_cb, pattern=f"^{CB_QUERY_PREFIX}"))
 
     # Use config button labels for message handlers
     app.add_handler(MessageHandler(filters.Regex(f"^{BTN_LIST_TRANSACTIONS}$"), list_transactions))
+    app.add_handler(CallbackQueryHandler(transactions_page_cb, pattern=f"^{CB_PAGE_PREFIX}"))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), import_csv))
     app.add_handler(MessageHandler(filters.Regex(f"^{BTN_GENERATE_REPORT}$"), generate_report))
-    app.add_handler(MessageHandler(filters.Regex(f"^{BTN_GENERATE_IMAGE_REPORT}$"), generate_image_report))
+    app.add_handler(MessageHandler(filters.Regex(f"^{re.escape(BTN_GENERATE_IMAGE_REPORT)}$"), generate_image_report))
+    app.add_handler(MessageHandler(filters.Regex(f"^{re.escape(BTN_GENERATE_REPORT_FILE)}$"), generate_report_file))
+    app.add_handler(MessageHandler(filters.Regex(f"^{re.escape(BTN_GENERATE_PERIOD_REPORT)}$"), period_report))
+    app.add_handler(CallbackQueryHandler(period_report_cb, pattern=f"^{CB_PERIOD_PREFIX}"))
     app.add_handler(MessageHandler(filters.Regex(f"^{BTN_CANCEL}$"), cancel))
 
     # Delete all data conversation handler
     delete_conv = ConversationHandler(
+        name="delete_data",
         entry_points=[MessageHandler(filters.Regex(f"^{BTN_DELETE_ALL_DATA}$"), delete_all_data)],
         states={
             CONFIRM_DELETE: [
@@ -711,6 +1437,7 @@ def main():
     app.add_handler(delete_conv)
 
     trans_conv = ConversationHandler(
+        name="add_transaction",
         entry_points=[MessageHandler(filters.Regex(f"^{BTN_ADD_TRANSACTION}$"), start_transaction)],
         states={
             TRANS_TYPE: [
@@ -755,6 +1482,7 @@ def main():
     app.add_handler(trans_conv)
 
     manage_conv = ConversationHandler(
+        name="manage_accounts",
         entry_points=[MessageHandler(filters.Regex(f"^{BTN_MANAGE_ACCOUNTS}$"), manage_accounts)],
         states={
             MANAGE_ACCOUNT: [
@@ -773,6 +1501,11 @@ def main():
     )
     app.add_handler(manage_conv)
 
+    # Latency and error metrics for every handler registered above
+    for handlers in app.handlers.values():
+        instrument_handlers(handlers)
+    METRICS.observe("startup_seconds", time.perf_counter() - started, phase="handlers")
+
     # Only add job queue if it's available
     try:
         if app.job_queue:
@@ -782,12 +1515,120 @@ def main():
                 first=0,
                 name="heartbeat",
             )
+            app.job_queue.run_repeating(
+                compact_journal,
+                interval=timedelta(minutes=JOURNAL_COMPACT_INTERVAL_MINUTES).total_seconds(),
+                first=0,
+                name="journal_compaction",
+            )
+            app.job_queue.run_repeating(
+                checkpoint_balances,
+                interval=timedelta(hours=BALANCE_CHECKPOINT_INTERVAL_HOURS).total_seconds(),
+                first=0,
+                name="balance_checkpoint",
+            )
+            # Local time, like the dates the digests cover
+            digest_time = datetime.strptime(DIGEST_TIME, "%H:%M").time().replace(tzinfo=datetime.now().astimezone().tzinfo)
+            if "daily" in DIGEST_FREQUENCIES:
+                app.job_queue.run_daily(send_digests, digest_time, data="daily", name="daily_digest")
+            if "weekly" in DIGEST_FREQUENCIES:
+                # The job queue counts days from Sunday
+                app.job_queue.run_daily(
+                    send_digests, digest_time, days=((DIGEST_WEEKDAY + 1) % 7,), data="weekly", name="weekly_digest"
+                )
+            if "monthly" in DIGEST_FREQUENCIES:
+                app.job_queue.run_monthly(send_digests, digest_time, DIGEST_MONTH_DAY, data="monthly", name="monthly_digest")
+            if RENDER_WARM_UP_DELAY_SECONDS is not None:
+                app.job_queue.run_once(warm_up_renderer, when=RENDER_WARM_UP_DELAY_SECONDS, name="render_warm_up")
     except Exception as e:
         logger.warning(f"JobQueue not available: {e}. Bot will run without heartbeat.")
+    return app
+
+
+def main():
+    check_legacy_ledger()
+    app = build_application()
+    if UPDATE_MODE == "webhook":
+        run_webhook(app, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN)
+    else:
+        logger.info("Bot running...")
+        app.run_polling()
 
-    logger.info("Bot running...")
-    app.run_polling()
+
+def profile_startup(top=15):
+    """Print where a cold start spends its time: the imports of maBot.py and the phases of build_application().
+
+    Imports are timed with `python -X importtime` in a fresh interpreter,
+    since this one has already done them. The render warm-up is timed too,
+    though it runs in the background after the bot has started.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import maBot"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    imports = []
+    total = 0
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            # A module is listed after what it imports: these are maBot's own imports, with everything they pull in
+            if name.strip() == "maBot":
+                total, imports = int(cumulative), children
+            children = []
+    print("Imports (cumulative ms, in a fresh interpreter):")
+    for micros, name in sorted(imports, reverse=True)[:top]:
+        print(f"  {name:<30} {micros / 1000:>9.1f}")
+    print(f"  {'total':<30} {total / 1000:>9.1f}")
+
+    app = build_application()
+    render_service = app.bot_data["render_service"]
+    try:
+        asyncio.run(render_service.warm_up())
+    except Exception as e:
+        print(f"Render warm-up failed: {e}", file=sys.stderr)
+    finally:
+        render_service.shutdown(wait=True)
+    print("Initialization (ms):")
+    for labels, count, p50, _, _ in METRICS.summary("startup_seconds"):
+        print(f"  {labels['phase']:<30} {p50 * 1000:>9.1f}")
+
+
+def export_cli(argv):
+    """Export transactions from the stored ledger without starting the bot."""
+    parser = argparse.ArgumentParser(prog="maBot.py export", description=export_cli.__doc__)
+    parser.add_argument("--from", dest="start", help="first date, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", help="last date, YYYY-MM-DD")
+    parser.add_argument("--account", help="only transactions from or to this account")
+    parser.add_argument("--type", dest="types", action="append", help="only this transaction type (repeatable)")
+    parser.add_argument("--format", dest="fmt", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--output", "-o", help="output file (default: stdout)")
+    parser.add_argument("--chat", type=int, help="the chat whose ledger to export (default: the shared ledger)")
+    args = parser.parse_args(argv)
+    try:
+        export_filters = make_filters(args.start, args.end, args.account, args.types, args.fmt)
+    except ValueError as e:
+        parser.error(str(e))
+    # Loaded through the configured storage, so journaled changes not yet folded into DATA_FILE are included
+    storage = get_storage() if args.chat is None else open_storage(STORAGE_MODE, chat_directory(args.chat))
+    data = storage.load()
+    if args.output:
+        with open(args.output, "wb") as out:
+            count = export_transactions(data["transactions"], out, **export_filters)
+    else:
+        count = export_transactions(data["transactions"], sys.stdout.buffer, **export_filters)
+    print(f"Exported {count} transactions", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ["export"]:
+        export_cli(sys.argv[2:])
+    elif sys.argv[1:2] == ["--profile-startup"]:
+        profile_startup()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import functools
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from config import METRICS_WINDOW
+
+# Upper bounds of the latency histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Cumulative bucket counts for export, plus the last `window` samples for percentiles."""
+
+    __slots__ = ("buckets", "count", "sum", "recent")
+
+    def __init__(self, window):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantiles(self, quantiles=QUANTILES):
+        """Nearest-rank percentiles over the recent samples."""
+        ordered = sorted(self.recent)
+        if not ordered:
+            return [0.0 for _ in quantiles]
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles]
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """Latency histograms and counters, keyed by metric name and labels."""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.window)
+        histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self, name):
+        """(labels dict, count, p50, p95, p99) for every series of histogram `name`, busiest first."""
+        rows = [
+            (dict(labels), histogram.count, *histogram.quantiles())
+            for (metric, labels), histogram in self.histograms.items()
+            if metric == name
+        ]
+        return sorted(rows, key=lambda row: -row[1])
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, _labels(labels)), 0)
+
+    def counter_total(self, name):
+        return sum(value for (metric, _), value in self.counters.items() if metric == name)
+
+    def prometheus(self):
+        """Everything recorded, in the Prometheus text exposition format."""
+        lines = []
+        for name in sorted({metric for metric, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for name in sorted({metric for metric, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(self.counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        lines.append("# TYPE bot_start_time_seconds gauge")
+        lines.append(f"bot_start_time_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def instrument(callback, handler, conversation=None, state=None):
+    """Wrap a handler callback to record its latency and errors."""
+    labels = {"handler": handler, "conversation": conversation, "state": state}
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            METRICS.inc("bot_handler_errors_total", **labels)
+            raise
+        finally:
+            METRICS.observe("bot_handler_latency_seconds", time.perf_counter() - start, **labels)
+
+    return wrapper
+
+
+def instrument_handlers(handlers, conversation=None, state=None):
+    """Wrap the callbacks of `handlers`, descending into conversation handlers."""
+    for handler in handlers:
+        if hasattr(handler, "states"):
+            # A ConversationHandler; its own handlers are labelled with the conversation state
+            name = handler.name or "conversation"
+            instrument_handlers(handler.entry_points, name, "entry")
+            for conv_state, state_handlers in handler.states.items():
+                label = "timeout" if conv_state == handler.TIMEOUT else str(conv_state)
+                instrument_handlers(state_handlers, name, label)
+            instrument_handlers(handler.fallbacks, name, "fallback")
+        else:
+            handler.callback = instrument(handler.callback, handler.callback.__name__, conversation, state)
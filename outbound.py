@@ -0,0 +1,223 @@
+import asyncio
+import contextvars
+import logging
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Best first: conversation prompts and replies, then notices nobody is waiting on, then reports and files
+PRIORITIES = ("interactive", "notice", "bulk")
+INTERACTIVE, NOTICE, BULK = PRIORITIES
+# Tokens a bucket keeps back from notices and bulk sends, so a reply right after a report chunk doesn't wait
+RESERVED = {INTERACTIVE: 0, NOTICE: 1, BULK: 1}
+BULK_ENDPOINTS = frozenset({"sendPhoto", "sendDocument", "sendMediaGroup", "sendVideo", "sendAudio"})
+# Chats without traffic have full buckets, which are dropped once there are this many
+MAX_IDLE_BUCKETS = 1024
+
+_priority = contextvars.ContextVar("outbound_priority", default=None)
+
+
+@contextmanager
+def priority(level):
+    """Send everything within the block (from this task) with priority `level`."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now, reserve=0):
+        """Seconds until a token is available beyond `reserve` (if the bucket holds that many)."""
+        self._refill(now)
+        needed = 1 + min(reserve, self.capacity - 1)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Request:
+    __slots__ = ("seq", "chat_id", "granted", "queued")
+
+    def __init__(self, seq, chat_id, granted, queued):
+        self.seq = seq
+        self.chat_id = chat_id
+        self.granted = granted
+        self.queued = queued
+
+
+class OutboundQueue(BaseRateLimiter):
+    """Rate limits the bot's requests to Telegram's flood limits, best priority first.
+
+    Every request to a chat waits for a token from the global bucket and
+    from the chat's own (groups get the slower OUTBOUND_GROUP_RATE). Queued
+    requests are let through in priority order, then in arrival order; a
+    request whose chat has no token doesn't hold up other chats. Notices and
+    bulk sends also leave a token in each bucket for interactive ones. The
+    priority is the call's `rate_limit_args`, else the one set with
+    priority() around it, else bulk for files and images and interactive
+    for everything else. Requests without a chat (getUpdates, callback query
+    answers) go straight through.
+
+    When Telegram answers 429 anyway, all sending pauses for the retry-after
+    it asks for and the request is queued again in its original place, up
+    to `max_retries` times.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, group_rate=OUTBOUND_GROUP_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic())
+        self._chats = {}
+        self._queues = {level: deque() for level in PRIORITIES}
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._wake = None
+        self._dispatcher = None
+
+    @property
+    def queued(self):
+        return sum(map(len, self._queues.values()))
+
+    async def initialize(self):
+        self._wake = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        # Whatever is still queued goes out unthrottled rather than never
+        for queue in self._queues.values():
+            while queue:
+                request = queue.popleft()
+                if not request.granted.done():
+                    request.granted.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+        level = rate_limit_args or _priority.get() or (BULK if endpoint in BULK_ENDPOINTS else INTERACTIVE)
+        seq = next(self._seq)
+        retries = 0
+        while True:
+            await self._wait_turn(seq, chat_id, level)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                METRICS.inc("outbound_retry_after_total", priority=level)
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f"Flood limit hit sending {endpoint} to chat {chat_id}; pausing sends for {delay}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    async def _wait_turn(self, seq, chat_id, level):
+        request = _Request(seq, chat_id, asyncio.get_running_loop().create_future(), time.perf_counter())
+        queue = self._queues[level]
+        if queue and queue[-1].seq > seq:
+            # A retry: back before everything that came after it, so a chat's messages stay in order
+            queue.insert(next(i for i, queued in enumerate(queue) if queued.seq > seq), request)
+        else:
+            queue.append(request)
+        self._wake.set()
+        await request.granted
+        METRICS.observe("outbound_queue_seconds", time.perf_counter() - request.queued, priority=level)
+
+    def _bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_BUCKETS:
+                self._chats = {chat: b for chat, b in self._chats.items() if not b.is_full(now)}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.group_rate if is_group else self.chat_rate, self.chat_burst, now
+            )
+        return bucket
+
+    def _grant(self, now):
+        """Let through every queued request the buckets allow.
+
+        Returns the seconds until the next one could go, or None when
+        nothing is queued.
+        """
+        wait = None
+        for level in PRIORITIES:
+            queue = self._queues[level]
+            reserve = RESERVED[level]
+            blocked = set()
+            i = 0
+            while i < len(queue):
+                request = queue[i]
+                if request.granted.done():
+                    # The sender was cancelled while waiting
+                    del queue[i]
+                    continue
+                if request.chat_id in blocked:
+                    i += 1
+                    continue
+                global_delay = self._global.delay(now, reserve)
+                if global_delay:
+                    return global_delay if wait is None else min(wait, global_delay)
+                bucket = self._bucket(request.chat_id, now)
+                chat_delay = bucket.delay(now, reserve)
+                if chat_delay:
+                    # Later requests to this chat wait behind this one
+                    blocked.add(request.chat_id)
+                    wait = chat_delay if wait is None else min(wait, chat_delay)
+                    i += 1
+                    continue
+                del queue[i]
+                self._global.take()
+                bucket.take()
+                request.granted.set_result(None)
+        return wait
+
+    async def _dispatch(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if wait <= 0:
+                wait = self._grant(now)
+            if wait is None:
+                await self._wake.wait()
+            else:
+                # A new request may be for a chat that can send right away
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
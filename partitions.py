@@ -0,0 +1,318 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from operator import itemgetter
+
+from config import DATA_FILE, JOURNAL_FILE, PARTITION_DIR, SPENDING_CATEGORIES
+from metrics import METRICS
+from storage import (
+    JournalStorage, default_data, new_category, rebuild_spending_periods, update_balances_batch,
+    write_snapshot,
+)
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("settled", "pending")
+MONTH_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+PARTITION_FILE_PATTERN = re.compile(r"^\d{4}-\d{2}\.(\d+\.jsonl\.gz|jsonl)$")
+
+_id = itemgetter("id")
+
+
+def month_of(date):
+    """The partition (YYYY-MM) a transaction dated `date` belongs to."""
+    return date[:7]
+
+
+def current_month():
+    return datetime.now().strftime("%Y-%m")
+
+
+def add_months(month, n):
+    year, m = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + n, 12)
+    return f"{year:04d}-{m + 1:02d}"
+
+
+def parse_month(value):
+    if not MONTH_PATTERN.match(value):
+        raise ValueError(f"months must be YYYY-MM, not {value!r}")
+    return value
+
+
+def _plus(balances, delta, sign=1):
+    """A new balances dict holding `balances` plus (or minus) `delta`."""
+    result = {name: {kind: dict(b.get(kind, {})) for kind in KINDS} for name, b in balances.items()}
+    for name, b in delta.items():
+        target = result.setdefault(name, {"settled": {}, "pending": {}})
+        for kind in KINDS:
+            for currency, amount in b.get(kind, {}).items():
+                target[kind][currency] = target[kind].get(currency, 0) + sign * amount
+    return result
+
+
+class MonthIndex:
+    """The ledger's transactions grouped by month, with what each month changed.
+
+    A month's balance and spending delta is computed once and kept until a
+    transaction is added to it. Period reports only touch the months they
+    cover and the deltas of the months after them, so a report on the
+    current month costs the same however much history there is.
+    """
+
+    def __init__(self, transactions=()):
+        self.months = {}
+        self.order = []
+        self._deltas = {}
+        self.extend(transactions)
+
+    def add(self, trans):
+        month = month_of(trans["date"])
+        rows = self.months.get(month)
+        if rows is None:
+            rows = self.months[month] = []
+            insort(self.order, month)
+        rows.append(trans)
+        self._deltas.pop(month, None)
+
+    def extend(self, transactions):
+        for trans in transactions:
+            self.add(trans)
+
+    def delta(self, month):
+        """Balances and spending categories made by the month's transactions alone."""
+        delta = self._deltas.get(month)
+        if delta is None:
+            delta = {"balances": {}, "spending_categories": {}}
+            update_balances_batch(delta, self.months.get(month, ()))
+            self._deltas[month] = delta
+        return delta
+
+    def months_between(self, start, end):
+        return self.order[bisect_left(self.order, start):bisect_right(self.order, end)]
+
+    def closing_balances(self, balances, month):
+        """The current `balances` less everything dated after `month`: the balances carried out of it."""
+        closing = _plus(balances, {})
+        for later in self.order[bisect_right(self.order, month):]:
+            closing = _plus(closing, self.delta(later)["balances"], -1)
+        return closing
+
+
+def period_data(data, index, start, end):
+    """A ledger-shaped view of the months `start` to `end`, for build_report() and the renderers.
+
+    It holds the period's transactions, the spending within it and the
+    balances at its end.
+    """
+    months = index.months_between(start, end)
+    spending = {}
+    for month in months:
+        for cat_name, cat in index.delta(month)["spending_categories"].items():
+            target = spending.setdefault(cat_name, {"ids": [], "total": {}})
+            target["ids"].extend(cat["ids"])
+            for currency, amount in cat["total"].items():
+                target["total"][currency] = target["total"].get(currency, 0) + amount
+    return {
+        "transactions": [t for month in months for t in index.months[month]],
+        "accounts": list(data["accounts"]),
+        "balances": index.closing_balances(data["balances"], end),
+        "spending_categories": spending,
+        "next_id": data["next_id"],
+    }
+
+
+def month_over_month(spending_categories, month):
+    """[(category, currency, spent in `month`, spent the month before)] from the per-month totals.
+
+    Two dict lookups per category, so it costs the same however long the ledger is.
+    """
+    previous = add_months(month, -1)
+    rows = []
+    for cat_name, cat in sorted(spending_categories.items()):
+        this, last = cat["months"].get(month, {}), cat["months"].get(previous, {})
+        for currency in sorted(this.keys() | last.keys()):
+            rows.append((cat_name, currency, this.get(currency, 0), last.get(currency, 0)))
+    return rows
+
+
+def _empty_manifest():
+    return {"last_id": 0, "head": None, "partitions": {}}
+
+
+class PartitionedStorage(JournalStorage):
+    """The transaction log in one file per month, plus a small manifest.
+
+    Changes are journaled as with JournalStorage. checkpoint() moves new
+    transactions into the partition of their month: the current month (and
+    any later one) is a plain YYYY-MM.jsonl file, rewritten as it grows.
+    Earlier months are sealed into gzip segments that are never rewritten; a
+    transaction backdated into a sealed month goes into a new segment. A
+    checkpoint only writes the months it touches, so its cost doesn't grow
+    with the history.
+
+    manifest.json holds the accounts, current balances and spending totals,
+    per month its files and transaction count, and the number of the last
+    journal record it covers: records left in .compacting by a checkpoint
+    interrupted after the manifest was written are not replayed again.
+    """
+
+    def __init__(self, directory=PARTITION_DIR, json_path=DATA_FILE, json_journal_path=JOURNAL_FILE):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(os.path.join(directory, "manifest.json"), os.path.join(directory, "journal.log"))
+        self.directory = directory
+        self.json_path = json_path
+        self.json_journal_path = json_journal_path
+        self.manifest = _empty_manifest()
+        # Transactions in the open partitions, which are rewritten whole
+        self.open_rows = {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            data = self._read_partitions()
+        else:
+            data = self._migrate()
+        covered = self.seq
+        self._replay(data, self.compacting_path, covered)
+        self._replay(data, self.journal_path, covered)
+        return data
+
+    def _migrate(self):
+        if not os.path.exists(self.json_path):
+            data = default_data()
+        else:
+            data = JournalStorage(self.json_path, self.json_journal_path).load()
+            logger.info(f"Migrating {len(data['transactions'])} transactions from {self.json_path} to {self.directory}")
+        self.save(data)
+        return data
+
+    def _read_partitions(self):
+        try:
+            with open(self.path, "r") as file:
+                METRICS.inc("storage_bytes_total", os.fstat(file.fileno()).st_size, direction="read", file=os.path.basename(self.path))
+                manifest = json.load(file)
+        except json.JSONDecodeError as e:
+            raise RuntimeError(f"{self.path} is corrupt ({e}); refusing to start with an empty ledger") from e
+        self.seq = manifest.get("journal_seq", 0)
+        head = manifest["head"]
+        data = default_data()
+        data["accounts"] = head["accounts"]
+        data["balances"] = head["balances"]
+        data["next_id"] = head["next_id"]
+        last_id = manifest["last_id"]
+        self.open_rows = {}
+        transactions = []
+        for month, part in sorted(manifest["partitions"].items()):
+            for name in part["files"]:
+                # An interrupted checkpoint may have written rows the manifest doesn't cover yet;
+                # they are still in the journal
+                rows = [t for t in self._read_partition(name) if t["id"] <= last_id]
+                if not name.endswith(".gz"):
+                    self.open_rows[month] = rows
+                transactions.extend(rows)
+        # Backdated transactions make the months' ID ranges overlap
+        transactions.sort(key=_id)
+        data["transactions"] = transactions
+        for cat_name, total in head["spending_totals"].items():
+            data["spending_categories"][cat_name] = dict(new_category(), total=total)
+        for t in transactions:
+            if t["type"] in SPENDING_CATEGORIES:
+                data["spending_categories"].setdefault(t["type"], new_category())["ids"].append(t["id"])
+        rebuild_spending_periods(data)
+        self.manifest = manifest
+        return data
+
+    def _read_partition(self, name):
+        path = os.path.join(self.directory, name)
+        METRICS.inc("storage_bytes_total", os.path.getsize(path), direction="read", file=name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "rt") as file:
+            return [json.loads(line) for line in file]
+
+    def _plan(self, data):
+        """What a checkpoint of `data` writes: partition files, the new manifest and the open rows.
+
+        Runs on the event loop, so it sees the same changes as the journal rotation.
+        """
+        last_id = self.manifest["last_id"]
+        transactions = data["transactions"]
+        new = transactions[bisect_right(transactions, last_id, key=_id):]
+        by_month = {}
+        for t in new:
+            by_month.setdefault(month_of(t["date"]), []).append(t)
+        current = current_month()
+        partitions = {
+            month: {"files": part["files"], "count": part["count"]} for month, part in self.manifest["partitions"].items()
+        }
+        open_rows = dict(self.open_rows)
+        writes = []
+        # Open partitions of months that have ended are sealed, with or without new rows
+        for month in sorted(set(by_month) | {m for m in open_rows if m < current}):
+            rows = by_month.get(month, [])
+            part = partitions.setdefault(month, {"files": [], "count": 0})
+            segments = [name for name in part["files"] if name.endswith(".gz")]
+            if month >= current:
+                name = f"{month}.jsonl"
+                open_rows[month] = open_rows.get(month, []) + rows
+                writes.append((name, open_rows[month]))
+            else:
+                name = f"{month}.{len(segments)}.jsonl.gz"
+                writes.append((name, open_rows.pop(month, []) + rows))
+            part["files"] = segments + [name]
+            part["count"] += len(rows)
+
+        manifest = {
+            "last_id": transactions[-1]["id"] if transactions else 0,
+            "head": {
+                "accounts": data["accounts"],
+                "balances": data["balances"],
+                "spending_totals": {name: cat["total"] for name, cat in data["spending_categories"].items()},
+                "next_id": data["next_id"],
+            },
+            "partitions": partitions,
+            "journal_seq": self.seq,
+        }
+        # Serialized now; the partition rows never change, so they can be serialized in a thread
+        return writes, json.dumps(manifest), manifest, open_rows
+
+    def _write(self, writes, manifest_snapshot):
+        for name, rows in writes:
+            text = "".join(json.dumps(t, separators=(",", ":")) + "\n" for t in rows)
+            if name.endswith(".gz"):
+                # mtime=0 keeps a segment's bytes identical if an interrupted checkpoint rewrites it
+                write_snapshot(gzip.compress(text.encode(), mtime=0), os.path.join(self.directory, name))
+            else:
+                write_snapshot(text, os.path.join(self.directory, name))
+        # Last: until the manifest lists them, new files are ignored
+        write_snapshot(manifest_snapshot, self.path)
+
+    def _remove_unlisted(self):
+        """Remove partition files the manifest no longer lists (sealed open files, anything left by save())."""
+        listed = {name for part in self.manifest["partitions"].values() for name in part["files"]}
+        for name in os.listdir(self.directory):
+            if PARTITION_FILE_PATTERN.match(name) and name not in listed:
+                os.remove(os.path.join(self.directory, name))
+
+    def save(self, data):
+        self.manifest = _empty_manifest()
+        self.open_rows = {}
+        writes, snapshot, manifest, open_rows = self._plan(data)
+        self._write(writes, snapshot)
+        self.manifest, self.open_rows = manifest, open_rows
+        self._remove_unlisted()
+        for path in (self.compacting_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def checkpoint(self, data):
+        self._rotate_journal()
+        writes, snapshot, manifest, open_rows = self._plan(data)
+        await asyncio.to_thread(self._write, writes, snapshot)
+        self.manifest, self.open_rows = manifest, open_rows
+        self._remove_unlisted()
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
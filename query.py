@@ -0,0 +1,175 @@
+import math
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+
+from exporter import is_iso_date
+
+QUERY_KEYS = ("type", "account", "status", "from", "to", "min", "max")
+
+
+@dataclass(frozen=True)
+class Query:
+    types: frozenset = None
+    account: str = None
+    statuses: frozenset = None
+    start: str = None
+    end: str = None
+    min_amount: float = None
+    max_amount: float = None
+
+    def matches(self, t):
+        return (
+            (self.types is None or t["type"] in self.types)
+            and (self.account is None or self.account in (t["from"], t["to"]))
+            and (self.statuses is None or t["status"] in self.statuses)
+            and (self.start is None or t["date"] >= self.start)
+            and (self.end is None or t["date"] <= self.end)
+            and (self.min_amount is None or t["amount_sent"] >= self.min_amount)
+            and (self.max_amount is None or t["amount_sent"] <= self.max_amount)
+        )
+
+
+def parse_query(tokens):
+    """A Query and its canonical text from `key=value` command arguments.
+
+    Keys are type and status (comma separated), account, from/to (ISO dates,
+    inclusive) and min/max (amount sent). Raises ValueError for anything
+    else, and for ranges whose ends are the wrong way round.
+    """
+    values = {}
+    for token in tokens:
+        key, sep, value = token.partition("=")
+        key = key.lower()
+        if not sep or key not in QUERY_KEYS or not value:
+            raise ValueError(f"can't use {token!r}")
+        values[key] = value
+    if not values:
+        raise ValueError("give at least one filter")
+    for key in ("from", "to"):
+        if key in values and not is_iso_date(values[key]):
+            raise ValueError(f"dates must be YYYY-MM-DD, not {values[key]!r}")
+    amounts = {}
+    for key in ("min", "max"):
+        if key in values:
+            try:
+                amounts[key] = float(values[key].replace(",", "."))
+            except ValueError:
+                raise ValueError(f"{key} must be a number, not {values[key]!r}") from None
+    # Either range the wrong way round would match nothing
+    if "from" in values and "to" in values and values["from"] > values["to"]:
+        raise ValueError(f"from={values['from']} is after to={values['to']}")
+    if len(amounts) == 2 and amounts["min"] > amounts["max"]:
+        raise ValueError(f"min={values['min']} is more than max={values['max']}")
+    query = Query(
+        types=frozenset(values["type"].lower().split(",")) if "type" in values else None,
+        account=values.get("account"),
+        statuses=frozenset(values["status"].lower().split(",")) if "status" in values else None,
+        start=values.get("from"),
+        end=values.get("to"),
+        min_amount=amounts.get("min"),
+        max_amount=amounts.get("max"),
+    )
+    # The same query always reads the same, so repeats are counted together
+    text = " ".join(f"{key}={values[key]}" for key in QUERY_KEYS if key in values)
+    return query, text
+
+
+class SortedIndex:
+    """(key, position) pairs of the transactions ordered by one field, for range lookups."""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, key, position):
+        entry = (key, position)
+        if not self.entries or entry >= self.entries[-1]:
+            # The usual case: new transactions come in order
+            self.entries.append(entry)
+        else:
+            insort(self.entries, entry)
+
+    def extend(self, entries):
+        # The new entries are one sorted run after the existing one, which sort() merges in linear time
+        self.entries.extend(sorted(entries))
+        self.entries.sort()
+
+    def positions(self, low=None, high=None):
+        """How many positions have a key in [low, high], and a function listing them in ledger order."""
+        lo = 0 if low is None else bisect_left(self.entries, (low,))
+        hi = len(self.entries) if high is None else bisect_right(self.entries, (high, math.inf))
+        return max(0, hi - lo), lambda: sorted(position for _, position in self.entries[lo:hi])
+
+
+class TransactionIndex:
+    """Secondary indexes over the ledger's transactions, by position in data["transactions"].
+
+    Accounts, types and statuses map to ascending position lists; dates and
+    amounts sent are kept sorted. A query starts from whichever of its
+    filters matches the fewest transactions and checks the rest on those
+    rows only, so it never scans the whole ledger.
+    """
+
+    def __init__(self, transactions=()):
+        self.count = 0
+        self.by_account = {}
+        self.by_type = {}
+        self.by_status = {}
+        self.by_date = SortedIndex()
+        self.by_amount = SortedIndex()
+        self.extend(transactions)
+
+    def _add_keys(self, trans, position):
+        self.by_account.setdefault(trans["from"], []).append(position)
+        # A transfer within one account is indexed once
+        if trans["to"] and trans["to"] != trans["from"]:
+            self.by_account.setdefault(trans["to"], []).append(position)
+        self.by_type.setdefault(trans["type"], []).append(position)
+        self.by_status.setdefault(trans["status"], []).append(position)
+
+    def add(self, trans):
+        position = self.count
+        self.count += 1
+        self._add_keys(trans, position)
+        self.by_date.add(trans["date"], position)
+        self.by_amount.add(trans["amount_sent"], position)
+
+    def extend(self, transactions):
+        """add() for a batch (an import, or the whole ledger at load), sorting it once per sorted index."""
+        start = self.count
+        for position, trans in enumerate(transactions, start):
+            self._add_keys(trans, position)
+        self.count = start + len(transactions)
+        self.by_date.extend((t["date"], p) for p, t in enumerate(transactions, start))
+        self.by_amount.extend((t["amount_sent"], p) for p, t in enumerate(transactions, start))
+
+    def _candidates(self, query):
+        """(size, positions) for each indexed filter of `query`."""
+        if query.types is not None:
+            lists = [self.by_type.get(t, []) for t in query.types]
+            yield sum(map(len, lists)), lambda lists=lists: sorted(p for positions in lists for p in positions)
+        if query.account is not None:
+            positions = self.by_account.get(query.account, [])
+            yield len(positions), lambda positions=positions: positions
+        if query.statuses is not None:
+            lists = [self.by_status.get(s, []) for s in query.statuses]
+            yield sum(map(len, lists)), lambda lists=lists: sorted(p for positions in lists for p in positions)
+        if query.start is not None or query.end is not None:
+            yield self.by_date.positions(query.start, query.end)
+        if query.min_amount is not None or query.max_amount is not None:
+            yield self.by_amount.positions(query.min_amount, query.max_amount)
+
+    def search(self, transactions, query):
+        """The transactions matching `query`, in ledger order."""
+        candidates = min(self._candidates(query), key=lambda candidate: candidate[0], default=None)
+        if candidates is None:
+            return list(transactions)
+        return [t for t in map(transactions.__getitem__, candidates[1]()) if query.matches(t)]
+
+
+def totals_by_currency(transactions):
+    """{currency: (count, total sent)} over `transactions`."""
+    totals = {}
+    for t in transactions:
+        count, total = totals.get(t["currency_sent"], (0, 0))
+        totals[t["currency_sent"]] = (count + 1, total + t["amount_sent"])
+    return totals
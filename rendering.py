@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import METRICS
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def render_png(html_content):
+    """Render an HTML page to PNG bytes. Runs in a worker process."""
+    # WeasyPrint and its native libraries are only ever loaded in the workers
+    from weasyprint import HTML
+    return HTML(string=html_content).write_png()
+
+
+def load_renderer():
+    """Import WeasyPrint ahead of the first render. Runs in a worker process."""
+    import weasyprint  # noqa: F401
+
+
+class RenderService:
+    """Renders HTML to PNG in a bounded pool of worker processes.
+
+    WeasyPrint is CPU-bound and would otherwise block the event loop for every
+    chat. At most `max_workers` pages render at once; up to `queue_limit`
+    renders may be waiting or running before new ones are refused. Identical
+    pages requested while one is in flight share that render, and the PNGs of
+    recent pages are kept by content hash, up to `cache_max_bytes`, so a
+    page that hasn't changed since it was last sent isn't rendered again.
+    """
+
+    def __init__(self, max_workers, queue_limit, cache_max_bytes=0):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.cache_max_bytes = cache_max_bytes
+        self._executor = None
+        self._in_flight = {}
+        # sha256 of a page -> its PNG, least recently used first
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self.stats = {"renders": 0, "shared": 0, "cached": 0, "rejected": 0, "failed": 0, "max_queue_depth": 0}
+
+    @property
+    def queue_depth(self):
+        """Renders waiting for or running in a worker."""
+        return len(self._in_flight)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking a process that runs an event loop and threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def render_png(self, html_content):
+        return (await self.render_pages([html_content]))[0]
+
+    async def render_pages(self, pages):
+        """The PNGs of the HTML `pages`, rendered concurrently across the workers.
+
+        Cached pages and pages already in flight cost no new render. Raises
+        RenderQueueFull if the new renders don't fit in the queue; a report
+        with more pages than `queue_limit` is only let through when the queue
+        is empty, so it can still be rendered at all.
+        """
+        keys = [hashlib.sha256(html.encode()).digest() for html in pages]
+        new = {key for key in keys if key not in self._cache and key not in self._in_flight}
+        if new and self.queue_depth and self.queue_depth + len(new) > self.queue_limit:
+            self.stats["rejected"] += 1
+            raise RenderQueueFull(f"{self.queue_depth} renders already queued")
+        pngs = [None] * len(pages)
+        renders = {}
+        for i, (key, html) in enumerate(zip(keys, pages)):
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                self.stats["cached"] += 1
+                METRICS.inc("report_image_cache_total", result="hit")
+                pngs[i] = png
+                continue
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.stats["shared"] += 1
+            else:
+                METRICS.inc("report_image_cache_total", result="miss")
+                future = self._submit(key, html)
+            # Shield the shared render from a single waiter being cancelled
+            renders[i] = asyncio.shield(future)
+        for i, png in zip(renders, await asyncio.gather(*renders.values())):
+            pngs[i] = png
+        return pngs
+
+    def _submit(self, key, html_content):
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self._get_executor(), render_png, html_content)
+        except BrokenProcessPool:
+            # A worker died since the last render; start a fresh pool
+            self._executor = None
+            future = loop.run_in_executor(self._get_executor(), render_png, html_content)
+        self._in_flight[key] = future
+        started = time.perf_counter()
+        future.add_done_callback(lambda f: self._finish(key, f, started))
+        self.stats["renders"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+        return future
+
+    def _finish(self, key, future, started):
+        self._in_flight.pop(key, None)
+        # Includes the wait for a free worker
+        METRICS.observe("report_image_render_seconds", time.perf_counter() - started)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.stats["failed"] += 1
+            METRICS.inc("report_image_errors_total")
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._executor = None
+            return
+        self._remember(key, future.result())
+
+    def _remember(self, key, png):
+        if len(png) > self.cache_max_bytes:
+            return
+        self._cache[key] = png
+        self._cache_bytes += len(png)
+        while self._cache_bytes > self.cache_max_bytes:
+            _, dropped = self._cache.popitem(last=False)
+            self._cache_bytes -= len(dropped)
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    async def warm_up(self):
+        """Start every worker and load WeasyPrint in it."""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        with METRICS.timer("startup_seconds", phase="render warm-up"):
+            await asyncio.gather(*(loop.run_in_executor(executor, load_renderer) for _ in range(self.max_workers)))
+
+    def shutdown(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
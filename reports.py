@@ -0,0 +1,739 @@
+import math
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from html import escape
+
+from config import (
+    SPENDING_CATEGORIES, REPORT_HEADER_LOG, REPORT_HEADER_ACCOUNTS, REPORT_HEADER_SPENDING,
+    REPORT_BALANCE_SETTLED, REPORT_BALANCE_PENDING, TABLE_HEADER, TABLE_SEPARATOR, TABLE_HEADER_FULL,
+    REPORT_HEADER_NET_WORTH, REPORT_HEADER_SPENDING_BASE, REPORT_NET_WORTH_TOTAL,
+)
+from fx import format_value
+from metrics import METRICS
+
+LOG_COLUMNS = ["date", "type", "amount_sent", "currency_sent", "from", "amount_received", "currency_received", "to", "status", "info"]
+
+REPORT_STYLE = """
+            body { font-family: monospace; font-size: 14px; }
+            h1, h2 { margin-top: 20px; }
+            table { border-collapse: collapse; }
+            th, td { border: 1px solid black; padding: 5px; }
+"""
+# Pages of the image report are all the same size, so they line up in a media group
+PAGE_STYLE = """
+            @page { size: 1400px 1800px; margin: 20px; }
+"""
+
+
+@dataclass(slots=True)
+class AccountEntry:
+    trans: dict
+    direction: str  # "Sent" or "Received"
+    counterparty: str
+
+
+@dataclass
+class AccountSection:
+    name: str
+    entries: list = field(default_factory=list)
+    settled: dict = field(default_factory=dict)
+    pending: dict = field(default_factory=dict)
+
+
+@dataclass
+class CategorySection:
+    name: str
+    transactions: list = field(default_factory=list)
+    total: dict = field(default_factory=dict)
+
+
+@dataclass
+class ValuationSection:
+    base: str
+    accounts: dict  # account -> net worth in base
+    total: float
+    spending: dict  # category -> spending in base, at the rates of the transaction dates
+
+
+@dataclass
+class Report:
+    transactions: list
+    accounts: list
+    categories: list
+    valuation: ValuationSection = None
+
+
+def build_valuation(data, categories, fx, base):
+    per_account, total = fx.net_worth(data["balances"], data.get("accounts", []), base)
+    spending = {cat.name: math.fsum(fx.spending_values(cat.transactions, base).tolist()) for cat in categories}
+    return ValuationSection(base, per_account, total, spending)
+
+
+def build_report(data, fx=None, base=None):
+    """Build the report model in one pass over the transactions.
+
+    With FX rates, the report also values the accounts and spending in `base`.
+    """
+    accounts = {
+        name: AccountSection(
+            name,
+            settled=data["balances"].get(name, {}).get("settled", {}),
+            pending=data["balances"].get(name, {}).get("pending", {}),
+        )
+        for name in data.get("accounts", [])
+    }
+    categories = {}
+    category_of = {}
+    for cat_name, cat in data.get("spending_categories", {}).items():
+        if cat_name in SPENDING_CATEGORIES:  # Only show configured spending categories
+            categories[cat_name] = CategorySection(cat_name, total=cat.get("total", {}))
+            for trans_id in cat.get("ids", []):
+                category_of[trans_id] = cat_name
+
+    # A copy of the list (not the rows), so transactions added while the report is sent don't show up half-way
+    transactions = list(data.get("transactions", []))
+    for t in transactions:
+        from_section = accounts.get(t["from"])
+        if from_section is not None:
+            from_section.entries.append(AccountEntry(t, "Sent", t["to"]))
+        # A transfer within one account is listed once, as sent
+        if t["to"] != t["from"]:
+            to_section = accounts.get(t["to"])
+            if to_section is not None:
+                to_section.entries.append(AccountEntry(t, "Received", t["from"]))
+        cat_name = category_of.get(t["id"])
+        if cat_name is not None:
+            categories[cat_name].transactions.append(t)
+
+    categories = list(categories.values())
+    valuation = build_valuation(data, categories, fx, base) if fx is not None else None
+    return Report(transactions, list(accounts.values()), categories, valuation)
+
+
+def format_amounts(amounts, sep=", ", skip_zero=True):
+    return sep.join(f"{curr}: {amt}" for curr, amt in amounts.items() if amt != 0 or not skip_zero)
+
+
+def _heading(text):
+    # The config headers are Markdown ("# Account Summary")
+    return escape(text.lstrip("#").strip())
+
+
+class TextRenderer:
+    """The plain text message the bot has always sent."""
+
+    name = "text"
+
+    def document_start(self):
+        return ""
+
+    def document_end(self):
+        return ""
+
+    def log_header(self):
+        return f"{REPORT_HEADER_LOG}\n\n{TABLE_HEADER_FULL}\n"
+
+    def log_row(self, t):
+        return f"| {t['date']} | {t['type']} | {t['amount_sent']} | {t['currency_sent']} | {t['from']} | {t['amount_received']} | {t['currency_received']} | {t['to']} | {t['status']} | {t['info']} |\n"
+
+    def log_footer(self):
+        return ""
+
+    def accounts_header(self):
+        return f"\n---\n{REPORT_HEADER_ACCOUNTS}\n"
+
+    def account_header(self, name):
+        return f"## {name}\n"
+
+    def account_entry(self, t, direction, counterparty):
+        return f"- {t['date']} | {t['type']} | {direction} {t['amount_sent']} {t['currency_sent']} → {counterparty} | {t['status']}  \n"
+
+    def account_footer(self, settled, pending):
+        return (
+            f"**Balance:**  \n- {REPORT_BALANCE_SETTLED}: {format_amounts(settled) or 'None'}  \n"
+            f"- {REPORT_BALANCE_PENDING}: {format_amounts(pending) or 'None'}\n---\n"
+        )
+
+    def spending_header(self):
+        return f"\n{REPORT_HEADER_SPENDING}\n"
+
+    def category_header(self, name):
+        return f"## {name.capitalize()}\n"
+
+    def category_row(self, t):
+        return f"{t['date']} | {t['amount_sent']} {t['currency_sent']} | {t['info']}\n"
+
+    def category_footer(self, total):
+        return f"Total | {format_amounts(total, sep=' ', skip_zero=False)}\n"
+
+    def net_worth_header(self, base):
+        return f"\n{REPORT_HEADER_NET_WORTH.format(base=base)}\n"
+
+    def value_row(self, label, value):
+        return f"{label}: {format_value(value)}\n"
+
+    def net_worth_footer(self, total):
+        return f"**{REPORT_NET_WORTH_TOTAL}: {format_value(total)}**\n"
+
+    def base_spending_header(self, base):
+        return f"\n{REPORT_HEADER_SPENDING_BASE.format(base=base)}\n"
+
+    def base_spending_footer(self):
+        return ""
+
+
+class MarkdownRenderer(TextRenderer):
+    """A Markdown document with proper tables."""
+
+    name = "markdown"
+
+    def log_header(self):
+        return f"{REPORT_HEADER_LOG}\n\n{TABLE_HEADER}\n{TABLE_SEPARATOR}\n"
+
+    def log_row(self, t):
+        return "| " + " | ".join(str(t[col]) for col in LOG_COLUMNS) + " |\n"
+
+    def accounts_header(self):
+        return f"\n{REPORT_HEADER_ACCOUNTS}\n"
+
+    def account_header(self, name):
+        return f"\n## {name}\n\n"
+
+    def account_entry(self, t, direction, counterparty):
+        return f"- {t['date']} | {t['type']} | {direction} {t['amount_sent']} {t['currency_sent']} → {counterparty} | {t['status']}\n"
+
+    def account_footer(self, settled, pending):
+        return (
+            f"\n**Balance:**\n\n- {REPORT_BALANCE_SETTLED}: {format_amounts(settled) or 'None'}\n"
+            f"- {REPORT_BALANCE_PENDING}: {format_amounts(pending) or 'None'}\n"
+        )
+
+    def category_header(self, name):
+        return f"\n## {name.capitalize()}\n\n| Date | Amount | Info |\n|---|---|---|\n"
+
+    def category_row(self, t):
+        return f"| {t['date']} | {t['amount_sent']} {t['currency_sent']} | {t['info']} |\n"
+
+    def category_footer(self, total):
+        return f"\n**Total:** {format_amounts(total, skip_zero=False)}\n"
+
+    def net_worth_header(self, base):
+        return f"\n{REPORT_HEADER_NET_WORTH.format(base=base)}\n\n"
+
+    def value_row(self, label, value):
+        return f"- {label}: {format_value(value)}\n"
+
+    def net_worth_footer(self, total):
+        return f"\n**{REPORT_NET_WORTH_TOTAL}: {format_value(total)}**\n"
+
+    def base_spending_header(self, base):
+        return f"\n{REPORT_HEADER_SPENDING_BASE.format(base=base)}\n\n"
+
+
+class HtmlRenderer:
+    """A standalone HTML page, as used for the image report."""
+
+    name = "html"
+
+    def document_start(self):
+        return f"<!DOCTYPE html>\n<html>\n<head>\n<title>Finance Report</title>\n<style>{REPORT_STYLE}</style>\n</head>\n<body>\n"
+
+    def document_end(self):
+        return "</body>\n</html>\n"
+
+    def log_header(self):
+        columns = "".join(f"<th>{escape(col.replace('_', ' ').capitalize())}</th>" for col in LOG_COLUMNS)
+        return f"<h1>{_heading(REPORT_HEADER_LOG)}</h1>\n<table>\n<tr>{columns}</tr>\n"
+
+    def log_row(self, t):
+        return "<tr>" + "".join(f"<td>{escape(str(t[col]))}</td>" for col in LOG_COLUMNS) + "</tr>\n"
+
+    def log_footer(self):
+        return "</table>\n"
+
+    def accounts_header(self):
+        return f"<h1>{_heading(REPORT_HEADER_ACCOUNTS)}</h1>\n"
+
+    def account_header(self, name):
+        return f"<h2>{escape(name)}</h2>\n<ul>\n"
+
+    def account_entry(self, t, direction, counterparty):
+        return (
+            f"<li>{escape(t['date'])} | {escape(t['type'])} | {direction} {t['amount_sent']} "
+            f"{escape(t['currency_sent'])} → {escape(counterparty)} | {escape(t['status'])}</li>\n"
+        )
+
+    def account_footer(self, settled, pending):
+        return (
+            f"</ul>\n<p><b>Balance:</b><br>{REPORT_BALANCE_SETTLED}: {escape(format_amounts(settled) or 'None')}<br>"
+            f"{REPORT_BALANCE_PENDING}: {escape(format_amounts(pending) or 'None')}</p>\n"
+        )
+
+    def spending_header(self):
+        return f"<h1>{_heading(REPORT_HEADER_SPENDING)}</h1>\n"
+
+    def category_header(self, name):
+        return f"<h2>{escape(name.capitalize())}</h2>\n<table>\n<tr><th>Date</th><th>Amount</th><th>Info</th></tr>\n"
+
+    def category_row(self, t):
+        return f"<tr><td>{escape(t['date'])}</td><td>{t['amount_sent']} {escape(t['currency_sent'])}</td><td>{escape(t['info'])}</td></tr>\n"
+
+    def category_footer(self, total):
+        return f"</table>\n<p><b>Total:</b> {escape(format_amounts(total, skip_zero=False))}</p>\n"
+
+    def net_worth_header(self, base):
+        return f"<h1>{_heading(REPORT_HEADER_NET_WORTH.format(base=base))}</h1>\n<table>\n"
+
+    def value_row(self, label, value):
+        return f"<tr><td>{escape(label)}</td><td>{format_value(value)}</td></tr>\n"
+
+    def net_worth_footer(self, total):
+        return f"</table>\n<p><b>{REPORT_NET_WORTH_TOTAL}:</b> {format_value(total)}</p>\n"
+
+    def base_spending_header(self, base):
+        return f"<h1>{_heading(REPORT_HEADER_SPENDING_BASE.format(base=base))}</h1>\n<table>\n"
+
+    def base_spending_footer(self):
+        return "</table>\n"
+
+    def page_start(self):
+        return f"<!DOCTYPE html>\n<html>\n<head>\n<title>Finance Report</title>\n<style>{REPORT_STYLE}{PAGE_STYLE}</style>\n</head>\n<body>\n"
+
+    def page_note(self, text):
+        return f"<p><i>{escape(text)}</i></p>\n"
+
+    def spending_summary_start(self):
+        return "<table>\n<tr><th>Category</th><th>Total</th></tr>\n"
+
+    def spending_summary_row(self, name, total):
+        return f"<tr><td>{escape(name.capitalize())}</td><td>{escape(format_amounts(total, skip_zero=False))}</td></tr>\n"
+
+    def spending_summary_end(self):
+        return "</table>\n"
+
+
+TEXT_RENDERER = TextRenderer()
+MARKDOWN_RENDERER = MarkdownRenderer()
+HTML_RENDERER = HtmlRenderer()
+
+
+def iter_parts(report, renderer):
+    """Render the report lazily, one row or section header/footer at a time."""
+    yield renderer.document_start()
+    yield renderer.log_header()
+    for t in report.transactions:
+        yield renderer.log_row(t)
+    yield renderer.log_footer()
+
+    yield renderer.accounts_header()
+    for acc in report.accounts:
+        yield renderer.account_header(acc.name)
+        for e in acc.entries:
+            yield renderer.account_entry(e.trans, e.direction, e.counterparty)
+        yield renderer.account_footer(acc.settled, acc.pending)
+
+    yield renderer.spending_header()
+    for cat in report.categories:
+        yield renderer.category_header(cat.name)
+        for t in cat.transactions:
+            yield renderer.category_row(t)
+        yield renderer.category_footer(cat.total)
+    if report.valuation is not None:
+        yield from valuation_parts(report.valuation, renderer)
+    yield renderer.document_end()
+
+
+def valuation_parts(valuation, renderer):
+    yield renderer.net_worth_header(valuation.base)
+    for name, value in valuation.accounts.items():
+        yield renderer.value_row(name, value)
+    yield renderer.net_worth_footer(valuation.total)
+    yield renderer.base_spending_header(valuation.base)
+    for cat_name, value in valuation.spending.items():
+        yield renderer.value_row(cat_name.capitalize(), value)
+    yield renderer.base_spending_footer()
+
+
+def render(report, renderer):
+    return "".join(iter_parts(report, renderer))
+
+
+def render_text(report):
+    return render(report, TEXT_RENDERER)
+
+
+def render_markdown(report):
+    return render(report, MARKDOWN_RENDERER)
+
+
+def render_html(report):
+    return render(report, HTML_RENDERER)
+
+
+def chunk_parts(parts, limit):
+    """Group rendered parts into chunks of at most `limit` characters.
+
+    Chunks break between rows; only a single row longer than `limit` is split.
+    Chunks are yielded as soon as they are full, so the first one is ready
+    before the rest of the report has been rendered.
+    """
+    chunk = []
+    size = 0
+    for part in parts:
+        if not part:
+            continue
+        if size + len(part) > limit and chunk:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+        while len(part) > limit:
+            yield part[:limit]
+            part = part[limit:]
+        chunk.append(part)
+        size += len(part)
+    if chunk:
+        yield "".join(chunk)
+
+
+class SectionCache:
+    """Rendered report sections for one renderer, kept in step with the ledger.
+
+    The ledger only ever appends transactions and spending category IDs, so an
+    update renders just the rows added since the last one and re-renders the
+    balance and total footers of the accounts and categories they touched.
+    With FX rates, new spending rows are valued once each and added to running
+    per-category totals; the small valuation section is re-rendered every time.
+
+    With a `source` (the SQLite storage), a report rendered from scratch
+    takes its account and category sections from the source's indexed
+    queries, when it has committed every transaction of the ledger.
+    """
+
+    def __init__(self, renderer, fx=None, base=None, source=None):
+        self.renderer = renderer
+        self.fx = fx
+        self.base = base
+        self.source = source
+        self.clear()
+
+    def clear(self):
+        self.data = None
+        self.version = None
+        self.accounts = ()
+        self.n_seen = 0
+        self.ids_seen = {}
+        self.category_of = {}
+        self.log_rows = []
+        self.account_entries = {}
+        self.account_footers = {}
+        self.category_rows = {}
+        self.category_footers = {}
+        self.base_spending = {}
+        self.valuation_parts = []
+        # Approximate size of the cached text in characters
+        self.size = 0
+        # The ledger this renderer's report was found too big to cache for
+        self.oversized_for = None
+
+    def is_current(self, data, version):
+        return self.data is data and self.version == version
+
+    def update(self, data, version):
+        if self.is_current(data, version):
+            return
+        accounts = tuple(data.get("accounts", []))
+        if self.data is not data or self.accounts != accounts:
+            # The ledger was reset or accounts were added/removed; start over
+            self.clear()
+            self.data = data
+            self.accounts = accounts
+            for name in accounts:
+                self.account_entries[name] = []
+        r = self.renderer
+
+        touched_categories = set()
+        for cat_name, cat in data.get("spending_categories", {}).items():
+            if cat_name not in SPENDING_CATEGORIES:  # Only show configured spending categories
+                continue
+            ids = cat.get("ids", [])
+            seen = self.ids_seen.get(cat_name, 0)
+            for trans_id in ids[seen:]:
+                self.category_of[trans_id] = cat_name
+            self.ids_seen[cat_name] = len(ids)
+            self.category_rows.setdefault(cat_name, [])
+            self.base_spending.setdefault(cat_name, 0.0)
+
+        touched_accounts = set()
+        transactions = data.get("transactions", [])
+        if self.n_seen == 0 and self._indexed_sections(transactions):
+            for t in transactions:
+                row = r.log_row(t)
+                self.log_rows.append(row)
+                self.size += len(row)
+            self.n_seen = len(transactions)
+            self.category_of.clear()
+            touched_accounts.update(accounts)
+            touched_categories.update(self.category_rows)
+        for t in transactions[self.n_seen:]:
+            row = r.log_row(t)
+            self.log_rows.append(row)
+            self.size += len(row)
+            entries = self.account_entries.get(t["from"])
+            if entries is not None:
+                row = r.account_entry(t, "Sent", t["to"])
+                entries.append(row)
+                self.size += len(row)
+                touched_accounts.add(t["from"])
+            # A transfer within one account is listed once, as sent
+            if t["to"] != t["from"]:
+                entries = self.account_entries.get(t["to"])
+                if entries is not None:
+                    row = r.account_entry(t, "Received", t["from"])
+                    entries.append(row)
+                    self.size += len(row)
+                    touched_accounts.add(t["to"])
+            cat_name = self.category_of.pop(t["id"], None)
+            if cat_name is not None:
+                row = r.category_row(t)
+                self.category_rows[cat_name].append(row)
+                self.size += len(row)
+                touched_categories.add(cat_name)
+                if self.fx is not None:
+                    self.base_spending[cat_name] += t["amount_sent"] * self.fx.rate(t["date"], t["currency_sent"], self.base)
+        self.n_seen = len(transactions)
+
+        for name in accounts:
+            if name in touched_accounts or name not in self.account_footers:
+                balances = data["balances"].get(name, {})
+                self.account_footers[name] = r.account_footer(balances.get("settled", {}), balances.get("pending", {}))
+        for cat_name in self.category_rows:
+            if cat_name in touched_categories or cat_name not in self.category_footers:
+                self.category_footers[cat_name] = r.category_footer(data["spending_categories"][cat_name].get("total", {}))
+        if self.fx is not None:
+            per_account, total = self.fx.net_worth(data["balances"], accounts, self.base)
+            valuation = ValuationSection(self.base, per_account, total, dict(self.base_spending))
+            self.size -= sum(map(len, self.valuation_parts))
+            self.valuation_parts = list(valuation_parts(valuation, r))
+            self.size += sum(map(len, self.valuation_parts))
+        self.version = version
+
+    def _indexed_sections(self, transactions):
+        """Render every account and category section from the source's queries; False if it can't."""
+        if self.source is None or not transactions or self.source.last_transaction_id() != transactions[-1]["id"]:
+            # Changes still waiting for their group commit aren't in the source yet
+            return False
+        r = self.renderer
+        for name, entries in self.account_entries.items():
+            for t in self.source.account_transactions(name):
+                # A transfer within one account is listed once, as sent
+                if t["from"] == name:
+                    row = r.account_entry(t, "Sent", t["to"])
+                else:
+                    row = r.account_entry(t, "Received", t["from"])
+                entries.append(row)
+                self.size += len(row)
+        for cat_name, rows in self.category_rows.items():
+            for t in self.source.category_transactions(cat_name):
+                row = r.category_row(t)
+                rows.append(row)
+                self.size += len(row)
+                if self.fx is not None:
+                    self.base_spending[cat_name] += t["amount_sent"] * self.fx.rate(t["date"], t["currency_sent"], self.base)
+        return True
+
+    def parts(self):
+        """The cached report as a list of parts.
+
+        The list only references the cached strings, and later updates don't
+        change it, so it can be sent at leisure.
+        """
+        r = self.renderer
+        parts = [r.document_start(), r.log_header()]
+        parts.extend(self.log_rows)
+        parts.append(r.log_footer())
+        parts.append(r.accounts_header())
+        for name in self.accounts:
+            parts.append(r.account_header(name))
+            parts.extend(self.account_entries[name])
+            parts.append(self.account_footers[name])
+        parts.append(r.spending_header())
+        for cat_name in self.category_rows:
+            parts.append(r.category_header(cat_name))
+            parts.extend(self.category_rows[cat_name])
+            parts.append(self.category_footers[cat_name])
+        parts.extend(self.valuation_parts)
+        parts.append(r.document_end())
+        return parts
+
+    def pages(self, rows_per_page, log_pages):
+        """The report as standalone pages of at most `rows_per_page` rows (HtmlRenderer only).
+
+        The latest `log_pages` pages of the transaction log, a page per
+        account with its latest entries and balance, and a spending summary.
+        Log pages start at fixed row numbers, so a full page reads the same
+        in every later report. Returns the pages and whether older
+        transactions or entries were left out.
+        """
+        r = self.renderer
+        first = _first_log_row(len(self.log_rows), rows_per_page, log_pages)
+        pages = _log_pages(r, self.log_rows[first:], first, rows_per_page)
+        truncated = first > 0
+        for name in self.accounts:
+            entries = self.account_entries[name]
+            page, cut = _account_page(r, name, entries[-rows_per_page:], len(entries), self.account_footers[name])
+            pages.append(page)
+            truncated = truncated or cut
+        pages.append(_summary_page(r, self.data["spending_categories"], self.category_rows, self.valuation_parts))
+        return pages, truncated
+
+
+def _first_log_row(n, rows_per_page, log_pages):
+    """The first of `n` log rows on the latest `log_pages` pages; pages start at multiples of `rows_per_page`."""
+    return max(0, (n - 1) // rows_per_page - log_pages + 1) * rows_per_page
+
+
+def _log_pages(r, rows, first, rows_per_page):
+    """Pages of the rendered log `rows`, which start at row `first` of the log."""
+    pages = []
+    for offset in range(0, max(len(rows), 1), rows_per_page):
+        page_rows = rows[offset:offset + rows_per_page]
+        start = first + offset
+        note = r.page_note(f"Transactions {start + 1}-{start + len(page_rows)}") if page_rows else ""
+        pages.append(r.page_start() + r.log_header() + "".join(page_rows) + r.log_footer() + note + r.document_end())
+    return pages
+
+
+def _account_page(r, name, shown, n_entries, footer):
+    """An account's page with its latest entries `shown` of `n_entries`, and whether it leaves any out."""
+    note = r.page_note(f"Latest {len(shown)} of {n_entries} entries") if len(shown) < n_entries else ""
+    return r.page_start() + r.account_header(name) + "".join(shown) + footer + note + r.document_end(), bool(note)
+
+
+def _summary_page(r, spending_categories, category_names, valuation):
+    summary = [r.page_start(), r.spending_header(), r.spending_summary_start()]
+    for cat_name in category_names:
+        summary.append(r.spending_summary_row(cat_name, spending_categories[cat_name].get("total", {})))
+    summary.append(r.spending_summary_end())
+    summary.extend(valuation)
+    summary.append(r.document_end())
+    return "".join(summary)
+
+
+def stream_pages(data, renderer, rows_per_page, log_pages, fx=None, base=None):
+    """SectionCache.pages() for a report too big to cache, rendering only the rows the pages show.
+
+    One pass over the transactions keeps each account's latest entries (the
+    transactions, not rendered rows) and counts the rest, and adds up the
+    spending values; nothing else is rendered or kept.
+    """
+    r = renderer
+    accounts = list(data.get("accounts", []))
+    latest = {name: deque(maxlen=rows_per_page) for name in accounts}
+    counts = dict.fromkeys(accounts, 0)
+    categories = [name for name in data.get("spending_categories", {}) if name in SPENDING_CATEGORIES]
+    category_of = {}
+    base_spending = dict.fromkeys(categories, 0.0)
+    if fx is not None:
+        for cat_name in categories:
+            category_of.update(dict.fromkeys(data["spending_categories"][cat_name].get("ids", []), cat_name))
+
+    # A copy of the list, as in build_report()
+    transactions = list(data.get("transactions", []))
+    for t in transactions:
+        if t["from"] in latest:
+            latest[t["from"]].append((t, "Sent", t["to"]))
+            counts[t["from"]] += 1
+        # A transfer within one account is listed once, as sent
+        if t["to"] != t["from"] and t["to"] in latest:
+            latest[t["to"]].append((t, "Received", t["from"]))
+            counts[t["to"]] += 1
+        cat_name = category_of.get(t["id"])
+        if cat_name is not None:
+            base_spending[cat_name] += t["amount_sent"] * fx.rate(t["date"], t["currency_sent"], base)
+
+    first = _first_log_row(len(transactions), rows_per_page, log_pages)
+    pages = _log_pages(r, [r.log_row(t) for t in transactions[first:]], first, rows_per_page)
+    truncated = first > 0
+    for name in accounts:
+        balances = data["balances"].get(name, {})
+        footer = r.account_footer(balances.get("settled", {}), balances.get("pending", {}))
+        shown = [r.account_entry(*entry) for entry in latest[name]]
+        page, cut = _account_page(r, name, shown, counts[name], footer)
+        pages.append(page)
+        truncated = truncated or cut
+    valuation = []
+    if fx is not None:
+        per_account, total = fx.net_worth(data["balances"], accounts, base)
+        valuation = list(valuation_parts(ValuationSection(base, per_account, total, base_spending), r))
+    pages.append(_summary_page(r, data.get("spending_categories", {}), categories, valuation))
+    return pages, truncated
+
+
+class ReportCache:
+    """Per-renderer section caches, evicted least recently used first to stay under `max_bytes`.
+
+    `source` is passed on to the section caches (see SectionCache).
+    """
+
+    def __init__(self, max_bytes, fx=None, base=None, source=None):
+        self.max_bytes = max_bytes
+        self.fx = fx
+        self.base = base
+        self.source = source
+        self.sections = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Drop every cached section, for changes the incremental update can't see."""
+        self.sections.clear()
+
+    def _current(self, data, version, renderer):
+        """The renderer's section cache brought up to date, or None if the report is too big for the budget."""
+        cache = self.sections.get(renderer.name)
+        if cache is None:
+            cache = self.sections[renderer.name] = SectionCache(renderer, self.fx, self.base, self.source)
+        self.sections.move_to_end(renderer.name)
+        if cache.is_current(data, version):
+            self.hits += 1
+            return cache
+        self.misses += 1
+        if cache.oversized_for is data:
+            # Ledgers only grow, so it still won't fit
+            METRICS.inc("report_uncached_total", renderer=renderer.name)
+            return None
+
+        with METRICS.timer("report_render_seconds", renderer=renderer.name):
+            cache.update(data, version)
+        while self.size() > self.max_bytes and len(self.sections) > 1:
+            self.sections.popitem(last=False)
+        if self.size() > self.max_bytes:
+            cache.clear()
+            cache.oversized_for = data
+            return None
+        return cache
+
+    def parts(self, data, version, renderer):
+        """The report's rendered parts, from the cache where possible.
+
+        A report too big for the budget is not cached; it is rendered lazily
+        instead, so memory use doesn't grow with it.
+        """
+        cache = self._current(data, version, renderer)
+        if cache is None:
+            return iter_parts(build_report(data, self.fx, self.base), renderer)
+        return cache.parts()
+
+    def pages(self, data, version, renderer, rows_per_page, log_pages):
+        """SectionCache.pages() for the current version, from the cache where possible."""
+        cache = self._current(data, version, renderer)
+        if cache is None:
+            # Too big to keep: only the rows on the pages are rendered
+            return stream_pages(data, renderer, rows_per_page, log_pages, self.fx, self.base)
+        return cache.pages(rows_per_page, log_pages)
+
+    def render(self, data, version, renderer):
+        return "".join(self.parts(data, version, renderer))
+
+    def size(self):
+        return sum(cache.size for cache in self.sections.values())
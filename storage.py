@@ -0,0 +1,589 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+
+from config import DATA_FILE, STORAGE_MODE, JOURNAL_FILE, SQLITE_FILE, PARTITION_DIR, LEDGER_DIR, SPENDING_CATEGORIES
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_FIELDS = [
+    "date", "type", "amount_sent", "currency_sent", "from",
+    "amount_received", "currency_received", "to", "status", "info", "description",
+]
+
+
+def default_data():
+    return {"transactions": [], "accounts": [], "balances": {}, "spending_categories": {}, "next_id": 1}
+
+
+def new_category():
+    # days and months: {YYYY-MM-DD / YYYY-MM: {currency: amount}}, the spending per period
+    return {"ids": [], "total": {}, "days": {}, "months": {}}
+
+
+def upgrade_data(data):
+    """Migrate a ledger from an older format, in place.
+
+    Older files stored a full copy of every spending transaction under
+    spending_categories; those copies become lists of IDs into the transaction
+    table. Files from before the per-period spending totals get them rebuilt
+    from the log. Returns True if anything was changed.
+    """
+    changed = _add_ids(data)
+    if any("months" not in cat for cat in data["spending_categories"].values()):
+        rebuild_spending_periods(data)
+        changed = True
+    return changed
+
+
+def _add_ids(data):
+    if "next_id" in data:
+        return False
+    for trans_id, trans in enumerate(data["transactions"], 1):
+        trans["id"] = trans_id
+    data["next_id"] = len(data["transactions"]) + 1
+
+    for cat_name, cat in data["spending_categories"].items():
+        # The copies are in ledger order, so match each one to the next equal transaction
+        by_type = (t for t in data["transactions"] if t["type"] == cat_name)
+        ids = []
+        for copy in cat.pop("transactions", []):
+            for trans in by_type:
+                if all(trans.get(field) == copy.get(field) for field in TRANSACTION_FIELDS):
+                    ids.append(trans["id"])
+                    break
+        cat["ids"] = ids
+    return True
+
+
+def _add_to_periods(cat, trans):
+    date = trans["date"]
+    currency = trans["currency_sent"]
+    for amounts in (cat["days"].setdefault(date, {}), cat["months"].setdefault(date[:7], {})):
+        amounts[currency] = amounts.get(currency, 0) + trans["amount_sent"]
+
+
+def rebuild_spending_periods(data):
+    """Recompute the per-day and per-month spending totals from the transaction log, in place."""
+    for cat in data["spending_categories"].values():
+        cat["days"] = {}
+        cat["months"] = {}
+    for trans in data["transactions"]:
+        if trans["type"] in SPENDING_CATEGORIES:
+            cat = data["spending_categories"].setdefault(trans["type"], new_category())
+            _add_to_periods(cat, trans)
+
+
+def update_balances(data, trans):
+    status = trans["status"]
+    from_acc = trans["from"]
+    to_acc = trans["to"]
+    sent_curr = trans["currency_sent"]
+    recv_curr = trans["currency_received"]
+    sent_amt = trans["amount_sent"]
+    recv_amt = trans["amount_received"]
+    trans_type = trans["type"]
+
+    if from_acc not in data["balances"]:
+        data["balances"][from_acc] = {"settled": {}, "pending": {}}
+    if to_acc and to_acc not in data["balances"]:
+        data["balances"][to_acc] = {"settled": {}, "pending": {}}
+
+    if status == "closed":
+        # Subtract sent from from_acc settled
+        data["balances"][from_acc]["settled"][sent_curr] = data["balances"][from_acc]["settled"].get(sent_curr, 0) - sent_amt
+        # Add received to to_acc settled (if there's a destination account)
+        if to_acc and recv_amt > 0:
+            data["balances"][to_acc]["settled"][recv_curr] = data["balances"][to_acc]["settled"].get(recv_curr, 0) + recv_amt
+    else:
+        # Pending
+        data["balances"][from_acc]["pending"][sent_curr] = data["balances"][from_acc]["pending"].get(sent_curr, 0) - sent_amt
+        if to_acc and recv_amt > 0:
+            data["balances"][to_acc]["pending"][recv_curr] = data["balances"][to_acc]["pending"].get(recv_curr, 0) + recv_amt
+
+    # Update spending categories using config
+    if trans_type in SPENDING_CATEGORIES:
+        cat = data["spending_categories"].get(trans_type) or new_category()
+        cat["ids"].append(trans["id"])
+        cat["total"][sent_curr] = cat["total"].get(sent_curr, 0) + sent_amt
+        _add_to_periods(cat, trans)
+        data["spending_categories"][trans_type] = cat
+
+
+def update_balances_batch(data, transactions):
+    """update_balances() for a batch: the batch is summed on its own first, so each
+    touched balance and category of `data` is updated once rather than once per row."""
+    batch = {"balances": {}, "spending_categories": {}}
+    for trans in transactions:
+        update_balances(batch, trans)
+    for account, delta in batch["balances"].items():
+        balances = data["balances"].setdefault(account, {"settled": {}, "pending": {}})
+        for kind in ("settled", "pending"):
+            for curr, amt in delta[kind].items():
+                balances[kind][curr] = balances[kind].get(curr, 0) + amt
+    for cat_name, delta in batch["spending_categories"].items():
+        cat = data["spending_categories"].setdefault(cat_name, new_category())
+        cat["ids"].extend(delta["ids"])
+        for curr, amt in delta["total"].items():
+            cat["total"][curr] = cat["total"].get(curr, 0) + amt
+        for period in ("days", "months"):
+            for key, amounts in delta[period].items():
+                target = cat[period].setdefault(key, {})
+                for curr, amt in amounts.items():
+                    target[curr] = target.get(curr, 0) + amt
+
+
+def apply_record(data, record):
+    op = record["op"]
+    if op == "transaction":
+        trans = record["trans"]
+        # New transactions get the next ID; replayed ones keep the ID they were journaled with
+        if "id" not in trans:
+            trans["id"] = data["next_id"]
+        data["next_id"] = max(data["next_id"], trans["id"] + 1)
+        data["transactions"].append(trans)
+        update_balances(data, trans)
+    elif op == "transactions":
+        # A bulk import, stored and applied as one record
+        for trans in record["trans"]:
+            if "id" not in trans:
+                trans["id"] = data["next_id"]
+                data["next_id"] += 1
+            data["next_id"] = max(data["next_id"], trans["id"] + 1)
+        data["transactions"].extend(record["trans"])
+        update_balances_batch(data, record["trans"])
+    elif op == "add_account":
+        data["accounts"].append(record["account"])
+        data["balances"][record["account"]] = {"settled": {}, "pending": {}}
+    elif op == "remove_account":
+        if record["account"] in data["accounts"]:
+            data["accounts"].remove(record["account"])
+        data["balances"].pop(record["account"], None)
+    elif op == "set_balances":
+        # Copied, so later updates to the ledger don't change the record before it is written
+        data["balances"] = {
+            account: {kind: dict(amounts) for kind, amounts in balances.items()}
+            for account, balances in record["balances"].items()
+        }
+    else:
+        logger.warning(f"Unknown journal op: {op}")
+
+
+def fsync_dir(path):
+    """Make a rename in the directory of `path` durable (no-op where directories can't be opened)."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(snapshot, path):
+    """Atomically replace `path` with `snapshot` (str or bytes): a crash leaves either the old or the
+    new file, never a truncated one."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb" if isinstance(snapshot, bytes) else "w") as file:
+        file.write(snapshot)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+    METRICS.inc("storage_bytes_total", len(snapshot), direction="write", file=os.path.basename(path))
+
+
+class JsonStorage:
+    """The whole ledger in one JSON file, rewritten on every commit."""
+
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        # Sequence number of the last journal record written (JournalStorage), kept in the snapshot
+        self.seq = 0
+
+    def load(self):
+        data = self._read()
+        if upgrade_data(data):
+            self.save(data)
+        return data
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as file:
+                METRICS.inc("storage_bytes_total", os.fstat(file.fileno()).st_size, direction="read", file=os.path.basename(self.path))
+                data = json.load(file)
+        except FileNotFoundError:
+            data = default_data()
+            self.save(data)
+            return data
+        except json.JSONDecodeError as e:
+            # Never replace an unreadable ledger with an empty one; it needs a human to look at it
+            raise RuntimeError(f"{self.path} is corrupt ({e}); refusing to start with an empty ledger") from e
+        # Journal records up to this one are already in the snapshot
+        self.seq = data.pop("journal_seq", 0)
+        return data
+
+    def _snapshot(self, data):
+        return json.dumps(data, indent=4)
+
+    def save(self, data):
+        """Replace everything stored with `data`."""
+        write_snapshot(self._snapshot(data), self.path)
+
+    async def commit(self, records, data):
+        """Durably store `records`, which have already been applied to `data`."""
+        # Serialize on the event loop so the snapshot can't change while it is written
+        snapshot = self._snapshot(data)
+        await asyncio.to_thread(write_snapshot, snapshot, self.path)
+
+    async def checkpoint(self, data):
+        # Every commit already rewrites the whole file
+        pass
+
+
+class JournalStorage(JsonStorage):
+    """A JSON checkpoint plus an append-only journal of the changes made since.
+
+    Each change costs one short line in the journal, whatever the size of the
+    ledger. checkpoint() folds the journal into the JSON file.
+
+    Journal records are numbered, and the checkpoint stores the number of the
+    last one it covers. A crash after the checkpoint is written but before the
+    old journal is removed leaves records that are already in the snapshot;
+    replay skips them rather than applying them twice.
+    """
+
+    def __init__(self, path=DATA_FILE, journal_path=JOURNAL_FILE):
+        super().__init__(path)
+        self.journal_path = journal_path
+        self.compacting_path = journal_path + ".compacting"
+
+    def load(self):
+        data = self._read()
+        # Upgrade the checkpoint before replaying records on top of it
+        migrated = upgrade_data(data)
+        # A leftover .compacting file means a checkpoint was interrupted
+        covered = self.seq
+        self._replay(data, self.compacting_path, covered)
+        self._replay(data, self.journal_path, covered)
+        if migrated:
+            self.save(data)
+        return data
+
+    def _snapshot(self, data):
+        return json.dumps(dict(data, journal_seq=self.seq), indent=4)
+
+    def _replay(self, data, path, covered=0):
+        """Apply every complete record in the journal at `path` numbered after `covered` to `data`."""
+        try:
+            with open(path, "r") as file:
+                METRICS.inc("storage_bytes_total", os.fstat(file.fileno()).st_size, direction="read", file=os.path.basename(path))
+                for line_no, line in enumerate(file, 1):
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-append leaves a partial last line; skip it
+                        logger.warning(f"Skipping corrupt journal record {path}:{line_no}")
+                        continue
+                    # Records from before the numbering have none, and are always applied
+                    seq = record.pop("seq", None)
+                    if seq is not None:
+                        if seq <= covered:
+                            continue
+                        self.seq = max(self.seq, seq)
+                    apply_record(data, record)
+        except FileNotFoundError:
+            pass
+
+    def save(self, data):
+        super().save(data)
+        # The checkpoint now holds everything, so older records must not be replayed on top of it
+        for path in (self.compacting_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append(self, lines):
+        with open(self.journal_path, "a") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        METRICS.inc("storage_bytes_total", len(lines), direction="write", file=os.path.basename(self.journal_path))
+
+    async def commit(self, records, data):
+        # One write and one fsync for the whole batch
+        lines = []
+        for record in records:
+            self.seq += 1
+            lines.append(json.dumps(dict(record, seq=self.seq), separators=(",", ":")) + "\n")
+        await asyncio.to_thread(self._append, "".join(lines))
+
+    async def checkpoint(self, data):
+        # Serialize and rotate the journal before yielding, so the snapshot
+        # and the rotated records cover exactly the same changes
+        snapshot = self._snapshot(data)
+        self._rotate_journal()
+        await asyncio.to_thread(write_snapshot, snapshot, self.path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+
+    def _rotate_journal(self):
+        """Move the journal aside, so records committed during a checkpoint go to a fresh one."""
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.compacting_path):
+                # Left over from an interrupted checkpoint; the snapshot covers it as well
+                with open(self.compacting_path, "a") as dst, open(self.journal_path, "r") as src:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.compacting_path)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    amount_sent REAL NOT NULL,
+    currency_sent TEXT NOT NULL,
+    "from" TEXT NOT NULL,
+    amount_received REAL NOT NULL,
+    currency_received TEXT NOT NULL,
+    "to" TEXT NOT NULL,
+    status TEXT NOT NULL,
+    info TEXT NOT NULL,
+    description TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS idx_transactions_from ON transactions ("from");
+CREATE INDEX IF NOT EXISTS idx_transactions_to ON transactions ("to");
+CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions (type);
+CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status);
+
+CREATE TABLE IF NOT EXISTS accounts (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS balances (
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL CHECK (kind IN ('settled', 'pending')),
+    currency TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (account, kind, currency)
+);
+
+CREATE TABLE IF NOT EXISTS spending_totals (
+    category TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (category, currency)
+);
+"""
+
+TRANSACTION_COLUMNS = ", ".join(f'"{field}"' for field in ["id"] + TRANSACTION_FIELDS)
+TRANSACTION_PLACEHOLDERS = ", ".join("?" for _ in ["id"] + TRANSACTION_FIELDS)
+INSERT_TRANSACTION = f"INSERT INTO transactions ({TRANSACTION_COLUMNS}) VALUES ({TRANSACTION_PLACEHOLDERS})"
+
+
+def _transaction_row(trans):
+    return [trans["id"]] + [trans[field] for field in TRANSACTION_FIELDS]
+
+
+class SqliteStorage:
+    """Transactions, accounts and balances in indexed SQLite tables (WAL mode).
+
+    Each batch of changes is committed as one transaction, in a worker
+    thread. The statements are built on the event loop first, from the
+    ledger as it is then, since the loop goes on changing it meanwhile. The
+    connection is only used by one thread at a time: the ledger's write lock
+    serializes commits, checkpoints and saves.
+
+    The report's account and category sections are read through the
+    indexes, on a second connection used from the event loop only; in WAL
+    mode it sees what was committed, while a commit may be running.
+    """
+
+    def __init__(self, path=SQLITE_FILE, json_path=DATA_FILE):
+        self.path = path
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        if is_new and os.path.exists(json_path):
+            migrate_json_to_sqlite(json_path, self)
+        self.reader = sqlite3.connect(path)
+        self.reader.row_factory = sqlite3.Row
+
+    def _transaction_rows(self, where="", params=()):
+        rows = self.conn.execute(
+            f"SELECT {TRANSACTION_COLUMNS} FROM transactions {where} ORDER BY id", params
+        )
+        return [dict(row) for row in rows]
+
+    def last_transaction_id(self):
+        """The id of the latest committed transaction, 0 if there are none."""
+        return self.reader.execute("SELECT max(id) FROM transactions").fetchone()[0] or 0
+
+    def _indexed_rows(self, where, params):
+        # Rows are read by column name like the ledger's dicts, without copying them into dicts
+        return self.reader.execute(f"SELECT {TRANSACTION_COLUMNS} FROM transactions {where} ORDER BY id", params).fetchall()
+
+    def account_transactions(self, account):
+        """The transactions from or to `account`, oldest first, through the from and to indexes."""
+        return self._indexed_rows('WHERE "from" = ? OR "to" = ?', (account, account))
+
+    def category_transactions(self, category):
+        """The transactions of type `category`, oldest first, through the type index."""
+        return self._indexed_rows("WHERE type = ?", (category,))
+
+    def load(self):
+        data = default_data()
+        data["transactions"] = self._transaction_rows()
+        data["accounts"] = [row["name"] for row in self.conn.execute("SELECT name FROM accounts ORDER BY position")]
+        for account in data["accounts"]:
+            data["balances"][account] = {"settled": {}, "pending": {}}
+        for row in self.conn.execute("SELECT account, kind, currency, amount FROM balances ORDER BY rowid"):
+            data["balances"].setdefault(row["account"], {"settled": {}, "pending": {}})[row["kind"]][row["currency"]] = row["amount"]
+        data["next_id"] = data["transactions"][-1]["id"] + 1 if data["transactions"] else 1
+        for row in self.conn.execute("SELECT category, currency, amount FROM spending_totals ORDER BY rowid"):
+            if row["category"] not in data["spending_categories"]:
+                data["spending_categories"][row["category"]] = dict(
+                    new_category(), ids=[t["id"] for t in data["transactions"] if t["type"] == row["category"]]
+                )
+            data["spending_categories"][row["category"]]["total"][row["currency"]] = row["amount"]
+        rebuild_spending_periods(data)
+        return data
+
+    def save(self, data):
+        statements = [(f"DELETE FROM {table}", [()]) for table in ("transactions", "accounts", "balances", "spending_totals")]
+        # Run right away, so the transactions needn't be copied first
+        statements.append((INSERT_TRANSACTION, map(_transaction_row, data["transactions"])))
+        statements.append(("INSERT INTO accounts (name) VALUES (?)", [(a,) for a in data["accounts"]]))
+        for account in data["balances"]:
+            statements += self._balance_statements(data, account)
+        for category in data["spending_categories"]:
+            statements += self._spending_total_statements(data, category)
+        self._execute(statements)
+
+    def _execute(self, statements):
+        """Run (sql, parameter rows) statements as one transaction."""
+        with self.conn:
+            for sql, rows in statements:
+                self.conn.executemany(sql, rows)
+
+    def _balance_statements(self, data, account):
+        balances = data["balances"].get(account, {})
+        rows = [
+            (account, kind, currency, amount)
+            for kind in ("settled", "pending")
+            for currency, amount in balances.get(kind, {}).items()
+        ]
+        return [
+            ("DELETE FROM balances WHERE account = ?", [(account,)]),
+            ("INSERT INTO balances (account, kind, currency, amount) VALUES (?, ?, ?, ?)", rows),
+        ]
+
+    def _spending_total_statements(self, data, category):
+        totals = data["spending_categories"].get(category, {}).get("total", {})
+        return [(
+            "INSERT INTO spending_totals (category, currency, amount) VALUES (?, ?, ?) "
+            "ON CONFLICT (category, currency) DO UPDATE SET amount = excluded.amount",
+            [(category, currency, amount) for currency, amount in totals.items()],
+        )]
+
+    async def commit(self, records, data):
+        statements = []
+        for record in records:
+            statements += self._statements(record, data)
+        await asyncio.to_thread(self._execute, statements)
+
+    def _statements(self, record, data):
+        # Balances and totals are copied from `data`, which already includes the whole batch
+        op = record["op"]
+        statements = []
+        if op == "transaction":
+            trans = record["trans"]
+            statements.append((INSERT_TRANSACTION, [_transaction_row(trans)]))
+            for account in {trans["from"], trans["to"]} - {""}:
+                statements += self._balance_statements(data, account)
+            if trans["type"] in SPENDING_CATEGORIES:
+                statements += self._spending_total_statements(data, trans["type"])
+        elif op == "transactions":
+            statements.append((INSERT_TRANSACTION, [_transaction_row(t) for t in record["trans"]]))
+            for account in ({t["from"] for t in record["trans"]} | {t["to"] for t in record["trans"]}) - {""}:
+                statements += self._balance_statements(data, account)
+            for category in {t["type"] for t in record["trans"]} & set(SPENDING_CATEGORIES):
+                statements += self._spending_total_statements(data, category)
+        elif op == "add_account":
+            statements.append(("INSERT OR IGNORE INTO accounts (name) VALUES (?)", [(record["account"],)]))
+            statements += self._balance_statements(data, record["account"])
+        elif op == "remove_account":
+            statements.append(("DELETE FROM accounts WHERE name = ?", [(record["account"],)]))
+            statements.append(("DELETE FROM balances WHERE account = ?", [(record["account"],)]))
+        elif op == "set_balances":
+            statements.append(("DELETE FROM balances", [()]))
+            for account in data["balances"]:
+                statements += self._balance_statements(data, account)
+        return statements
+
+    async def checkpoint(self, data):
+        # Every change is already committed; just fold the WAL back into the database
+        await asyncio.to_thread(self.conn.execute, "PRAGMA wal_checkpoint(PASSIVE)")
+
+
+def migrate_json_to_sqlite(json_path, storage):
+    """One-shot import of a finance_data.json ledger into an SQLite storage."""
+    with open(json_path, "r") as file:
+        data = json.load(file)
+    upgrade_data(data)
+    storage.save(data)
+    logger.info(f"Migrated {len(data['transactions'])} transactions from {json_path} to {storage.path}")
+
+
+def chat_directory(chat_id):
+    return os.path.join(LEDGER_DIR, str(chat_id))
+
+
+# Written once a chat has taken over the shared ledger from before per-chat ledgers
+LEGACY_MIGRATED_MARKER = os.path.join(LEDGER_DIR, "legacy_migrated")
+
+
+def open_storage(mode=STORAGE_MODE, directory=None):
+    """The storage for `mode`, on the configured files, or on files of the same names in `directory`."""
+    def path(name):
+        return name if directory is None else os.path.join(directory, os.path.basename(name))
+
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    if mode == "journal":
+        return JournalStorage(path(DATA_FILE), path(JOURNAL_FILE))
+    if mode == "sqlite":
+        return SqliteStorage(path(SQLITE_FILE), path(DATA_FILE))
+    if mode == "partitioned":
+        # Imported here: partitions builds on this module
+        from partitions import PartitionedStorage
+        return PartitionedStorage(path(PARTITION_DIR), path(DATA_FILE), path(JOURNAL_FILE))
+    return JsonStorage(path(DATA_FILE))
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = open_storage()
+    return _storage
+
+
+def load_data():
+    return get_storage().load()
+
+
+def save_data(data):
+    get_storage().save(data)
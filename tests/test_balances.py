@@ -0,0 +1,88 @@
+import json
+
+from balances import LegColumns, aggregate_balances, compare_balances, rebuild_balances, save_checkpoint, load_checkpoint
+from storage import default_data, apply_record
+
+
+def trans(amount_sent, source, destination="", amount_received=0.0, status="closed", currency="CHF"):
+    return {
+        "date": "2025-01-02", "type": "transfer" if destination else "snack", "amount_sent": amount_sent,
+        "currency_sent": currency, "from": source, "amount_received": amount_received,
+        "currency_received": currency if destination else "", "to": destination, "status": status, "info": "",
+        "description": "",
+    }
+
+
+def ledger(transactions):
+    data = default_data()
+    for account in ("Cash", "Bank"):
+        apply_record(data, {"op": "add_account", "account": account})
+    for t in transactions:
+        apply_record(data, {"op": "transaction", "trans": t})
+    # As loaded from disk, where equal strings are distinct objects
+    return json.loads(json.dumps(data))
+
+
+TRANSACTIONS = [
+    trans(5.0, "Cash"),
+    trans(100.0, "Bank", "Cash", 100.0),
+    trans(20.0, "Cash", "Bank", 20.0, status="pending"),
+    trans(7.5, "Bank", currency="EUR"),
+    trans(3.0, "Cash", "Bank", 0.0),
+]
+
+
+def test_columns_match_update_balances():
+    data = ledger(TRANSACTIONS)
+    assert aggregate_balances(data["transactions"]) == {
+        "Cash": {"settled": {"CHF": 92.0}, "pending": {"CHF": -20.0}},
+        "Bank": {"settled": {"CHF": -100.0, "EUR": -7.5}, "pending": {"CHF": 20.0}},
+    }
+    assert compare_balances(data["balances"], aggregate_balances(data["transactions"])) == []
+
+
+def test_columns_sum_any_slice():
+    data = ledger(TRANSACTIONS)
+    columns = LegColumns(data["transactions"][:2])
+    columns.extend(data["transactions"][2:4])
+    columns.add(data["transactions"][4])
+    assert len(columns) == 5
+    assert columns.balances(3) == aggregate_balances(data["transactions"][3:])
+    # Groups with no rows in the slice leave no entries
+    assert columns.balances(0, 1) == {"Cash": {"settled": {"CHF": -5.0}, "pending": {}}}
+    assert columns.balances(5) == {}
+
+
+def test_rebuild_from_matching_checkpoint_replays_the_rest(tmp_path):
+    data = ledger(TRANSACTIONS)
+    path = str(tmp_path / "checkpoint.json")
+    save_checkpoint(data["transactions"][:3], aggregate_balances(data["transactions"][:3]), path)
+
+    rebuilt, replayed = rebuild_balances(data, load_checkpoint(path), LegColumns(data["transactions"]))
+    assert replayed == 2
+    assert compare_balances(data["balances"], rebuilt) == []
+
+
+def test_rebuild_ignores_stale_checkpoint(tmp_path):
+    data = ledger(TRANSACTIONS)
+    path = str(tmp_path / "checkpoint.json")
+    # Taken before the ledger was reset and refilled with different transactions
+    old = ledger([trans(1000.0, "Cash"), trans(1.0, "Bank")])
+    save_checkpoint(old["transactions"], old["balances"], path)
+
+    rebuilt, replayed = rebuild_balances(data, load_checkpoint(path))
+    assert replayed == 5
+    assert compare_balances(data["balances"], rebuilt) == []
+
+
+def test_compare_balances():
+    stored = {"Cash": {"settled": {"CHF": 0.1 + 0.2, "EUR": 5.0}, "pending": {}}}
+    rebuilt = {
+        "Cash": {"settled": {"CHF": 0.3}, "pending": {"CHF": 0.0}},
+        "Bank": {"settled": {"USD": -2.0}, "pending": {}},
+    }
+    # Rounding and missing zero amounts match; everything else is listed by account, kind and currency
+    assert compare_balances(stored, rebuilt) == [
+        ("Bank", "settled", "USD", 0, -2.0),
+        ("Cash", "settled", "EUR", 5.0, 0),
+    ]
@@ -0,0 +1,181 @@
+import asyncio
+import json
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import Forbidden, NetworkError
+
+import digests
+from digests import DigestService, digest_period, spending_between
+from storage import apply_record, default_data
+
+
+def spend(day, amount, currency="CHF", trans_type="snack"):
+    return {
+        "date": day, "type": trans_type, "amount_sent": amount, "currency_sent": currency, "from": "Cash",
+        "amount_received": 0.0, "currency_received": "", "to": "", "status": "closed", "info": "", "description": "",
+    }
+
+
+def ledger(transactions):
+    data = default_data()
+    apply_record(data, {"op": "add_account", "account": "Cash"})
+    for t in transactions:
+        apply_record(data, {"op": "transaction", "trans": t})
+    return SimpleNamespace(data=data)
+
+
+@pytest.mark.parametrize("frequency, today, expected", [
+    ("daily", date(2025, 3, 1), (date(2025, 2, 28), date(2025, 2, 28))),
+    # Sent on Mondays, for the week up to Sunday
+    ("weekly", date(2025, 1, 6), (date(2024, 12, 30), date(2025, 1, 5))),
+    ("weekly", date(2025, 3, 3), (date(2025, 2, 24), date(2025, 3, 2))),
+    ("monthly", date(2025, 3, 1), (date(2025, 2, 1), date(2025, 2, 28))),
+    ("monthly", date(2024, 3, 1), (date(2024, 2, 1), date(2024, 2, 29))),
+    ("monthly", date(2025, 1, 1), (date(2024, 12, 1), date(2024, 12, 31))),
+    # However late in the month it runs, it covers the month before
+    ("monthly", date(2025, 5, 17), (date(2025, 4, 1), date(2025, 4, 30))),
+])
+def test_digest_period(frequency, today, expected):
+    assert digest_period(frequency, today) == expected
+
+
+def test_spending_between():
+    spending = ledger([
+        spend("2025-02-23", 1.0), spend("2025-02-24", 2.0), spend("2025-02-28", 4.0, "EUR"),
+        spend("2025-03-02", 8.0), spend("2025-03-03", 16.0), spend("2025-03-01", 32.0, trans_type="admin"),
+    ]).data["spending_categories"]
+    week = digest_period("weekly", date(2025, 3, 3))
+    assert spending_between(spending, "weekly", *week) == {"admin": {"CHF": 32.0}, "snack": {"CHF": 10.0, "EUR": 4.0}}
+    assert spending_between(spending, "daily", date(2025, 3, 2), date(2025, 3, 2)) == {"snack": {"CHF": 8.0}}
+    assert spending_between(spending, "monthly", date(2025, 2, 1), date(2025, 2, 28)) == {
+        "snack": {"CHF": 3.0, "EUR": 4.0},
+    }
+    # Categories with nothing spent in the period are left out
+    assert spending_between(spending, "daily", date(2025, 2, 25), date(2025, 2, 25)) == {}
+
+
+class FakeBot:
+    """Records the digests sent; `failures` lists what each chat's next sends raise."""
+
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}
+
+    async def send_message(self, chat_id, text):
+        errors = self.failures.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data, name):
+        self.jobs.append((callback, when, data))
+
+
+class FakeApp:
+    def __init__(self, ledgers, bot):
+        self.ledgers = ledgers
+        self.bot = bot
+        self.bot_data = {"ledgers": self}
+        self.job_queue = FakeJobQueue()
+        self.tasks = []
+        self.loaded = []
+
+    def get(self, chat_id):
+        self.loaded.append(chat_id)
+        return self.ledgers[chat_id]
+
+    def create_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def run(self, coroutine):
+        await coroutine
+        await asyncio.gather(*self.tasks)
+        self.tasks.clear()
+
+    async def run_due_jobs(self):
+        """Run the retries queued so far, as the job queue would once their delay is up."""
+        jobs, self.job_queue.jobs = self.job_queue.jobs, []
+        for callback, _, data in jobs:
+            await self.run(callback(SimpleNamespace(job=SimpleNamespace(data=data), application=self)))
+
+
+def service(tmp_path, **kwargs):
+    return DigestService(str(tmp_path / "digests.json"), stagger_seconds=0, **kwargs)
+
+
+def test_digests_are_built_once_per_chat_and_period(tmp_path, monkeypatch):
+    built = []
+    build_digest = digests.build_digest
+    monkeypatch.setattr(digests, "build_digest", lambda data, *args: built.append(args) or build_digest(data, *args))
+    digest_service = service(tmp_path)
+    digest_service.subscribe(1, ["weekly"])
+    digest_service.subscribe(2, ["weekly", "daily"])
+    app = FakeApp({1: ledger([spend("2025-03-02", 8.0)]), 2: ledger([])}, FakeBot())
+
+    async def main():
+        monday, next_monday = date(2025, 3, 3), date(2025, 3, 10)
+        await app.run(digest_service.send_due(app, "weekly", monday))
+        # The same run again (say, after a restart of the job) reuses the texts
+        await app.run(digest_service.send_due(app, "weekly", monday))
+        assert built == [("weekly", date(2025, 2, 24), date(2025, 3, 2))] * 2
+        await app.run(digest_service.send_due(app, "daily", monday))
+        await app.run(digest_service.send_due(app, "weekly", next_monday))
+        assert len(built) == 5
+        # Only the period just run is kept for its frequency
+        assert sorted(key[1:] for key in digest_service._digests) == [
+            ("daily", date(2025, 3, 2)), ("weekly", date(2025, 3, 3)), ("weekly", date(2025, 3, 3)),
+        ]
+
+    asyncio.run(main())
+    first, again = app.bot.sent[0], app.bot.sent[2]
+    assert first == again
+    assert first[0] == 1
+    assert "Snack: CHF: 8.0" in first[1]
+
+
+def test_failed_sends_are_retried_with_backoff(tmp_path):
+    digest_service = service(tmp_path, retry_seconds=10, max_attempts=3)
+    digest_service.subscribe(1, ["daily"])
+    digest_service.subscribe(2, ["daily"])
+    errors = {1: [NetworkError("timed out"), NetworkError("timed out")], 2: [NetworkError("down")] * 3}
+    app = FakeApp({1: ledger([]), 2: ledger([])}, FakeBot(errors))
+
+    async def main():
+        await app.run(digest_service.send_due(app, "daily", date(2025, 3, 3)))
+        delays = [sorted((data[0], when) for _, when, data in app.job_queue.jobs)]
+        await app.run_due_jobs()
+        delays.append(sorted((data[0], when) for _, when, data in app.job_queue.jobs))
+        await app.run_due_jobs()
+        return delays
+
+    delays = asyncio.run(main())
+    assert delays == [[(1, 10), (2, 10)], [(1, 20), (2, 20)]]
+    # Chat 1 got through on the third attempt; chat 2 was given up on without another retry
+    assert [chat_id for chat_id, _ in app.bot.sent] == [1]
+    assert app.job_queue.jobs == []
+    # Retries send the text built the first time, without loading the ledger again
+    assert app.loaded == [1, 2]
+    assert 2 in digest_service.subscriptions
+
+
+def test_chats_that_blocked_the_bot_are_unsubscribed(tmp_path):
+    digest_service = service(tmp_path)
+    digest_service.subscribe(1, ["daily", "weekly"])
+    digest_service.subscribe(2, ["daily"])
+    app = FakeApp({1: ledger([]), 2: ledger([])}, FakeBot({1: [Forbidden("bot was blocked by the user")]}))
+
+    asyncio.run(app.run(digest_service.send_due(app, "daily", date(2025, 3, 3))))
+    assert [chat_id for chat_id, _ in app.bot.sent] == [2]
+    assert app.job_queue.jobs == []
+    assert digest_service.subscriptions == {2: {"daily"}}
+    with open(tmp_path / "digests.json") as file:
+        assert json.load(file) == {"2": ["daily"]}
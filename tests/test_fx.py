@@ -0,0 +1,91 @@
+import math
+
+import pytest
+
+from fx import FxRates, format_value
+
+RATES = FxRates.from_json({"quote": "USD", "rates": {
+    "2025-01-01": {"CHF": 1.10, "EUR": 1.00},
+    # EUR is carried forward from the day before
+    "2025-01-10": {"CHF": 1.20},
+    # BTC is known from here on, and back-filled to the earlier dates
+    "2025-01-20": {"EUR": 1.05, "BTC": 100000},
+}})
+
+
+def column(currency):
+    return RATES.values[:, RATES.index[currency]].tolist()
+
+
+def test_rates_are_filled_forward_and_back():
+    assert RATES.currencies == ["BTC", "CHF", "EUR", "USD"]
+    assert column("CHF") == [1.10, 1.20, 1.20]
+    assert column("EUR") == [1.00, 1.00, 1.05]
+    assert column("BTC") == [100000, 100000, 100000]
+    assert column("USD") == [1.0, 1.0, 1.0]
+
+
+@pytest.mark.parametrize("date, pair, expected", [
+    ("2025-01-15", ("CHF", "EUR"), 1.20),
+    ("2025-01-20", ("CHF", "EUR"), 1.20 / 1.05),
+    ("2025-01-10", ("EUR", "CHF"), 1 / 1.20),
+    # Before the first date the earliest rates apply, after the last the latest
+    ("2024-12-01", ("CHF", "USD"), 1.10),
+    ("2026-01-01", ("BTC", "EUR"), 100000 / 1.05),
+    (None, ("EUR", "USD"), 1.05),
+])
+def test_rate(date, pair, expected):
+    assert RATES.rate(date, *pair) == pytest.approx(expected)
+
+
+def test_unknown_currency_has_no_rate():
+    assert math.isnan(RATES.rate("2025-01-15", "XYZ", "USD"))
+    assert math.isnan(RATES.rate("2025-01-15", "USD", "XYZ"))
+
+
+def test_convert_totals():
+    totals = {"Cash": {"CHF": 10, "EUR": 5}, "Wallet": {"BTC": 0.001}, "Odd": {"XYZ": 3}, "Empty": {"XYZ": 0}}
+    converted = RATES.convert_totals(totals, "EUR", "2025-01-20")
+    assert converted["Cash"] == pytest.approx(10 * 1.20 / 1.05 + 5)
+    assert converted["Wallet"] == pytest.approx(100 / 1.05)
+    # An amount in a currency without rates can't be valued; a zero one doesn't matter
+    assert math.isnan(converted["Odd"])
+    assert converted["Empty"] == 0
+
+
+def test_net_worth_adds_settled_and_pending():
+    balances = {
+        "Cash": {"settled": {"CHF": 10}, "pending": {"CHF": -5, "USD": 2}},
+        "Bank": {"settled": {"EUR": 100}, "pending": {}},
+    }
+    per_account, total = RATES.net_worth(balances, ["Cash", "Bank", "New"], "USD", "2025-01-01")
+    assert per_account == pytest.approx({"Cash": 5 * 1.10 + 2, "Bank": 100.0, "New": 0.0})
+    assert total == pytest.approx(107.5)
+
+
+def test_historical_values_use_each_rows_date():
+    values = RATES.historical_values(
+        [10, 10, 1, 4, 7],
+        ["CHF", "CHF", "BTC", "EUR", "XYZ"],
+        ["2025-01-05", "2025-01-25", "2024-06-30", "2025-01-20", "2025-01-20"],
+        "CHF",
+    )
+    assert values[:4].tolist() == pytest.approx([10, 10, 100000 / 1.10, 4 * 1.05 / 1.20])
+    assert math.isnan(values[4])
+    assert all(map(math.isnan, RATES.historical_values([1, 2], ["CHF", "EUR"], ["2025-01-05"] * 2, "XYZ")))
+
+
+def test_spending_values():
+    transactions = [
+        {"amount_sent": 11.0, "currency_sent": "CHF", "date": "2025-01-01"},
+        {"amount_sent": 12.0, "currency_sent": "CHF", "date": "2025-01-10"},
+    ]
+    assert RATES.spending_values(transactions, "USD").tolist() == pytest.approx([12.1, 14.4])
+    assert len(RATES.spending_values([], "USD")) == 0
+
+
+def test_format_value():
+    assert format_value(1234.5) == "1,234.50"
+    assert format_value(-0.004) == "-0.00"
+    assert format_value(math.nan) == "n/a"
+    assert format_value(RATES.rate(None, "XYZ", "USD")) == "n/a"
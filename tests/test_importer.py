@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+from importer import read_rows, validate_batch
+
+HEADER = "date,type,amount_sent,currency_sent,from,amount_received,currency_received,to,status,info\n"
+
+
+def import_csv(rows):
+    stream = io.BytesIO((HEADER + "".join(row + "\n" for row in rows)).encode())
+    return validate_batch(list(read_rows(stream)), ["Cash", "Bank"])
+
+
+@pytest.mark.parametrize("amount, expected", [("12.50", 12.5), ('"12,50"', 12.5), ("12", 12.0)])
+def test_decimal_point_and_decimal_comma(amount, expected):
+    transactions, errors = import_csv([f"2025-01-02,snack,{amount},CHF,Cash,,,,,"])
+    assert errors == []
+    assert transactions[0]["amount_sent"] == expected
+
+
+def test_decimal_comma_in_amount_received():
+    transactions, errors = import_csv(['2025-01-02,trade,100,CHF,Cash,"93,40",EUR,Bank,closed,'])
+    assert errors == []
+    assert transactions[0]["amount_received"] == 93.4
+
+
+@pytest.mark.parametrize("amount", ['"1,234.50"', '"1.234,50"', '"1,234,567"', "1.234.567"])
+def test_ambiguous_amounts_are_skipped(amount):
+    transactions, errors = import_csv([f"2025-01-02,snack,{amount},CHF,Cash,,,,,"])
+    assert transactions == []
+    [(line, reason)] = errors
+    assert line == 2
+    assert reason.startswith("ambiguous amount")
+
+
+def test_non_numeric_amount_is_skipped():
+    transactions, errors = import_csv(["2025-01-02,snack,twelve,CHF,Cash,,,,,"])
+    assert transactions == []
+    assert errors == [(2, "amount must be a number, not 'twelve'")]
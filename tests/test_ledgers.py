@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+import pytest
+
+import maBot
+import storage
+from maBot import LedgerCache, check_legacy_ledger, open_chat_ledger
+from storage import LEGACY_MIGRATED_MARKER, JournalStorage, apply_record, default_data
+
+
+def spend(amount):
+    return {
+        "date": "2025-01-02", "type": "snack", "amount_sent": amount, "currency_sent": "CHF", "from": "Cash",
+        "amount_received": 0.0, "currency_received": "", "to": "", "status": "closed", "info": "",
+        "description": f"Snack - {amount} CHF",
+    }
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Ledger files go to a fresh directory, through the shipped journal storage."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(maBot, "STORAGE_MODE", "journal")
+    monkeypatch.setattr(maBot, "LEGACY_LEDGER_CHAT_ID", None)
+    monkeypatch.setattr(storage, "_storage", None)
+    return tmp_path
+
+
+class CountingOpener:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self, chat_id):
+        self.opened.append(chat_id)
+        return open_chat_ledger(chat_id)
+
+
+def test_evicted_ledger_is_flushed(workdir):
+    async def main():
+        cache = LedgerCache(1, open_chat_ledger)
+        ledger = cache.get(1)
+        await ledger.commit({"op": "add_account", "account": "Cash"})
+        assert ledger.dirty
+        cache.get(2)
+        await cache.flush_all()
+        return ledger
+
+    ledger = asyncio.run(main())
+    assert not ledger.dirty
+    # Checkpointed into the snapshot, not just journaled
+    assert JournalStorage(os.path.join("ledgers", "1", "finance_data.json"), os.devnull).load()["accounts"] == ["Cash"]
+
+
+def test_failed_flush_keeps_the_evicted_ledger(workdir):
+    async def main():
+        opener = CountingOpener()
+        cache = LedgerCache(1, opener)
+        ledger = cache.get(1)
+        await ledger.commit({"op": "add_account", "account": "Cash"})
+
+        async def fail(data):
+            raise OSError("disk full")
+
+        ledger.storage.checkpoint = fail
+        cache.get(2)
+        await asyncio.gather(*cache._flushing)
+        assert cache.unflushed == {1: ledger}
+        del ledger.storage.checkpoint
+        del ledger
+        # Not reloaded from storage, which lacks the unflushed change
+        revived = cache.get(1)
+        assert revived.data["accounts"] == ["Cash"]
+        assert opener.opened == [1, 2]
+        assert await cache.flush_all() >= 1
+        assert not revived.dirty
+
+    asyncio.run(main())
+
+
+def test_ledger_held_by_a_handler_is_revived(workdir):
+    async def main():
+        opener = CountingOpener()
+        cache = LedgerCache(1, opener)
+        held = cache.get(1)
+        cache.get(2)
+        await cache.flush_all()
+        # Evicted and flushed, but a running handler still has it
+        assert cache.get(1) is held
+        assert opener.opened == [1, 2]
+        await cache.flush_all()
+        cache.get(2)
+        await cache.flush_all()
+        del held
+        cache.get(1)
+        assert opener.opened == [1, 2, 2, 1]
+
+    asyncio.run(main())
+
+
+def write_shared_ledger():
+    data = default_data()
+    apply_record(data, {"op": "add_account", "account": "Cash"})
+    apply_record(data, {"op": "transaction", "trans": spend(5.0)})
+    storage.get_storage().save(data)
+
+
+def test_legacy_ledger_moves_to_its_chat(workdir, monkeypatch):
+    write_shared_ledger()
+    with pytest.raises(RuntimeError, match="LEGACY_LEDGER_CHAT_ID"):
+        check_legacy_ledger()
+
+    monkeypatch.setattr(maBot, "LEGACY_LEDGER_CHAT_ID", 42)
+    check_legacy_ledger()
+    assert open_chat_ledger(7).data["transactions"] == []
+    assert not os.path.exists(LEGACY_MIGRATED_MARKER)
+    ledger = open_chat_ledger(42)
+    assert ledger.data["accounts"] == ["Cash"]
+    assert [t["amount_sent"] for t in ledger.data["transactions"]] == [5.0]
+    # Opened again, the chat keeps its own ledger
+    assert open_chat_ledger(42).data["accounts"] == ["Cash"]
+
+    # Once taken over, the shared files are only a backup
+    monkeypatch.setattr(maBot, "LEGACY_LEDGER_CHAT_ID", None)
+    check_legacy_ledger()
+
+
+def test_no_shared_ledger_starts(workdir):
+    check_legacy_ledger()
+    assert not os.path.exists("finance_data.json")
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from telegram.ext import ExtBot
+
+import outbound
+from outbound import OutboundQueue, priority, BULK
+from webhook import OfflineBotApi
+
+
+class RecordingBotApi(OfflineBotApi):
+    """OfflineBotApi noting each message that got through, with the time it did."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = []
+
+    def _answer(self, api_method, parameters):
+        if api_method == "sendMessage":
+            self.sent.append((parameters["chat_id"], parameters["text"], time.monotonic()))
+        return super()._answer(api_method, parameters)
+
+
+def run_bot(queue, scenario, **api_args):
+    """Run `scenario(bot, api)` against a RecordingBotApi with `queue` as the bot's rate limiter."""
+    api = RecordingBotApi(**api_args)
+
+    async def main():
+        async with ExtBot("123:abc", request=api, get_updates_request=OfflineBotApi(), rate_limiter=queue) as bot:
+            await scenario(bot, api)
+
+    asyncio.run(main())
+    return api
+
+
+async def send_bulk(bot, chat_id, text):
+    with priority(BULK):
+        await bot.send_message(chat_id, text)
+
+
+def texts(api):
+    return [text for _, text, _ in api.sent]
+
+
+def test_interactive_reply_goes_before_queued_report_chunks():
+    async def scenario(bot, api):
+        chunks = [asyncio.create_task(send_bulk(bot, 1, f"chunk {i}")) for i in range(4)]
+        # The first chunk takes the chat's only token, the rest queue behind it
+        await asyncio.sleep(0.01)
+        await bot.send_message(1, "reply")
+        await asyncio.gather(*chunks)
+
+    api = run_bot(OutboundQueue(global_rate=1000, chat_rate=20, chat_burst=1), scenario)
+    assert texts(api) == ["chunk 0", "reply", "chunk 1", "chunk 2", "chunk 3"]
+
+
+def test_busy_chat_does_not_hold_up_other_chats():
+    async def scenario(bot, api):
+        backlog = [asyncio.create_task(send_bulk(bot, 1, f"report {i}")) for i in range(5)]
+        await asyncio.sleep(0.01)
+        await send_bulk(bot, 2, "other chat")
+        await asyncio.gather(*backlog)
+
+    api = run_bot(OutboundQueue(global_rate=1000, chat_rate=10, chat_burst=1), scenario)
+    assert texts(api)[:2] == ["report 0", "other chat"]
+    # Only the chat's own bucket paces its backlog
+    (_, _, other_at), (_, _, last_at) = api.sent[1], api.sent[-1]
+    assert last_at - other_at >= 0.3
+
+
+def test_retry_after_pauses_all_sends_and_retries():
+    async def scenario(bot, api):
+        await bot.send_message(1, "first")
+        # Telegram allows one message to chat 1 a second and answers this one with a retry after 1s
+        flooded = asyncio.create_task(bot.send_message(1, "second"))
+        while not api.flooded:
+            await asyncio.sleep(0.01)
+        await bot.send_message(2, "other chat")
+        await flooded
+
+    api = run_bot(OutboundQueue(global_rate=1000, chat_rate=100, chat_burst=5), scenario,
+                  flood_limits=((1000, 1000), (1, 1)))
+    assert api.flooded == 1
+    assert sorted(texts(api)) == ["first", "other chat", "second"]
+    sent_at = {text: at for _, text, at in api.sent}
+    # Chat 2 was never flooded but still waited out the pause
+    assert sent_at["other chat"] - sent_at["first"] >= 0.9
+    assert sent_at["second"] - sent_at["first"] >= 0.9
+
+
+def test_idle_buckets_are_dropped(monkeypatch):
+    monkeypatch.setattr(outbound, "MAX_IDLE_BUCKETS", 3)
+    queue = OutboundQueue(global_rate=1000, chat_rate=1, chat_burst=2)
+    now = 100.0
+    for chat_id in (1, 2, 3):
+        queue._bucket(chat_id, now)
+    # Chat 2 has just sent, so its bucket isn't full
+    queue._bucket(2, now).take()
+    busy = queue._bucket(2, now)
+    queue._bucket(4, now + 0.5)
+    assert set(queue._chats) == {2, 4}
+    assert queue._chats[2] is busy
+    # Under the limit nothing is dropped
+    queue._bucket(5, now + 10)
+    assert set(queue._chats) == {2, 4, 5}
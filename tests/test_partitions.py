@@ -0,0 +1,82 @@
+import pytest
+
+from partitions import MonthIndex, add_months, month_over_month
+from storage import apply_record, default_data
+
+
+def trans(date, amount, source="Cash", destination="", currency="CHF", trans_type="snack"):
+    return {
+        "date": date, "type": trans_type if not destination else "transfer", "amount_sent": amount,
+        "currency_sent": currency, "from": source, "amount_received": amount if destination else 0.0,
+        "currency_received": currency if destination else "", "to": destination, "status": "closed", "info": "",
+        "description": "",
+    }
+
+
+def ledger(transactions):
+    data = default_data()
+    for account in ("Cash", "Bank"):
+        apply_record(data, {"op": "add_account", "account": account})
+    for t in transactions:
+        apply_record(data, {"op": "transaction", "trans": t})
+    return data
+
+
+def nonzero(balances):
+    """`balances` without the zero amounts that subtracting later months leaves behind."""
+    return {
+        name: {kind: {c: a for c, a in amounts.items() if a} for kind, amounts in b.items()}
+        for name, b in balances.items()
+    }
+
+
+# Nothing in February 2025
+TRANSACTIONS = [
+    trans("2024-12-31", 1.0),
+    trans("2025-01-01", 2.0),
+    trans("2025-01-31", 4.0),
+    trans("2025-01-31", 50.0, "Bank", "Cash"),
+    trans("2025-03-01", 8.0),
+    trans("2025-03-31", 16.0, currency="EUR"),
+]
+
+
+@pytest.mark.parametrize("month, n, expected", [
+    ("2025-01", -1, "2024-12"), ("2024-12", 1, "2025-01"), ("2025-03", -14, "2024-01"), ("2025-06", 0, "2025-06"),
+])
+def test_add_months(month, n, expected):
+    assert add_months(month, n) == expected
+
+
+def test_month_over_month_across_month_and_year_ends():
+    spending = ledger(TRANSACTIONS)["spending_categories"]
+    assert month_over_month(spending, "2025-01") == [("snack", "CHF", 6.0, 1.0)]
+    # A month without transactions against the one before it, and the one after it
+    assert month_over_month(spending, "2025-02") == [("snack", "CHF", 0, 6.0)]
+    assert month_over_month(spending, "2025-03") == [("snack", "CHF", 8.0, 0), ("snack", "EUR", 16.0, 0)]
+    assert month_over_month(spending, "2030-01") == []
+
+
+@pytest.mark.parametrize("month, upto", [
+    ("2024-11", 0), ("2024-12", 1), ("2025-01", 4), ("2025-02", 4), ("2025-03", 6), ("2025-04", 6),
+])
+def test_closing_balances_match_the_ledger_up_to_the_month(month, upto):
+    data = ledger(TRANSACTIONS)
+    index = MonthIndex(data["transactions"])
+    assert nonzero(index.closing_balances(data["balances"], month)) == ledger(TRANSACTIONS[:upto])["balances"]
+
+
+def test_deltas_are_recomputed_once_their_month_changes():
+    data = ledger(TRANSACTIONS)
+    index = MonthIndex(data["transactions"])
+    assert index.closing_balances(data["balances"], "2025-01")["Cash"]["settled"] == {"CHF": 43.0, "EUR": 0.0}
+    january = index.delta("2025-01")
+
+    # A commit backdated into March, then one into February, which had no transactions yet
+    for t in (trans("2025-03-15", 100.0), trans("2025-02-14", 32.0)):
+        apply_record(data, {"op": "transaction", "trans": t})
+        index.add(t)
+    assert index.closing_balances(data["balances"], "2025-01")["Cash"]["settled"] == {"CHF": 43.0, "EUR": 0.0}
+    assert index.closing_balances(data["balances"], "2025-02")["Cash"]["settled"] == {"CHF": 11.0, "EUR": 0.0}
+    assert index.delta("2025-01") is january
+    assert index.delta("2025-03")["balances"]["Cash"]["settled"] == {"CHF": -108.0, "EUR": -16.0}
@@ -0,0 +1,84 @@
+import asyncio
+import random
+
+import pytest
+
+from maBot import Ledger
+from query import Query, parse_query
+from storage import JournalStorage
+
+
+def test_canonical_text():
+    query, text = parse_query(["MAX=20,5", "type=snack,Admin", "account=Cash", "from=2025-01-01"])
+    assert text == "type=snack,Admin account=Cash from=2025-01-01 max=20,5"
+    assert query == Query(types=frozenset({"snack", "admin"}), account="Cash", start="2025-01-01", max_amount=20.5)
+    # The same filters in another order are the same query
+    assert parse_query(["from=2025-01-01", "account=Cash", "max=20,5", "type=snack,Admin"])[1] == text
+
+
+@pytest.mark.parametrize("tokens, error", [
+    ([], "at least one filter"),
+    (["colour=red"], "can't use"),
+    (["type"], "can't use"),
+    (["account="], "can't use"),
+    (["from=01.02.2025"], "YYYY-MM-DD"),
+    (["min=ten"], "must be a number"),
+    (["min=20", "max=5"], "more than max"),
+    (["from=2025-02-01", "to=2025-01-01"], "after to"),
+])
+def test_invalid_queries(tokens, error):
+    with pytest.raises(ValueError, match=error):
+        parse_query(tokens)
+
+
+def test_equal_ends_are_allowed():
+    query, _ = parse_query(["min=5", "max=5", "from=2025-01-01", "to=2025-01-01"])
+    assert query.matches({"type": "snack", "from": "Cash", "to": "", "status": "closed", "date": "2025-01-01",
+                          "amount_sent": 5.0})
+
+
+def random_transactions(rng, n):
+    accounts = ["Cash", "Bank", "Card"]
+    for _ in range(n):
+        transfer = rng.random() < 0.3
+        yield {
+            "date": f"2025-{rng.randint(1, 3):02d}-{rng.randint(1, 28):02d}",
+            "type": "transfer" if transfer else rng.choice(["snack", "admin", "subscription"]),
+            "amount_sent": float(rng.randint(1, 50)), "currency_sent": "CHF", "from": rng.choice(accounts),
+            "amount_received": 0.0, "currency_received": "", "to": rng.choice(accounts) if transfer else "",
+            "status": rng.choice(["closed", "pending"]), "info": "", "description": "",
+        }
+
+
+QUERIES = [
+    ["type=snack"], ["type=snack,transfer", "status=pending"], ["account=Bank"], ["account=Card", "min=25"],
+    ["from=2025-02-01"], ["from=2025-01-10", "to=2025-02-20", "type=admin"], ["max=10"], ["min=10", "max=12"],
+    ["status=closed", "account=Cash", "to=2025-01-31"], ["account=Nowhere"],
+]
+
+
+def test_index_agrees_with_matches_after_commits_and_resets(tmp_path):
+    rng = random.Random(1)
+    ledger = Ledger(JournalStorage(str(tmp_path / "data.json"), str(tmp_path / "journal.log")))
+
+    def check():
+        transactions = ledger.data["transactions"]
+        for tokens in QUERIES:
+            query, _ = parse_query(tokens)
+            assert ledger.index.search(transactions, query) == [t for t in transactions if query.matches(t)]
+
+    async def main():
+        # Committed together, in one group commit
+        await asyncio.gather(*(ledger.commit({"op": "transaction", "trans": t}) for t in random_transactions(rng, 50)))
+        # An import, with dates older than what's already indexed
+        await ledger.commit({"op": "transactions", "trans": list(random_transactions(rng, 200))})
+        check()
+        # Deleting all data starts the index over
+        await ledger.reset()
+        check()
+        await asyncio.gather(*(ledger.commit({"op": "transaction", "trans": t}) for t in random_transactions(rng, 30)))
+        check()
+        await ledger.flush()
+
+    asyncio.run(main())
+    assert len(ledger.data["transactions"]) == 30
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import reports
+from fx import FxRates
+from reports import HTML_RENDERER, ReportCache, SectionCache, stream_pages
+from storage import apply_record, default_data
+
+RATES = FxRates.from_json({"quote": "USD", "rates": {
+    "2025-01-01": {"CHF": 1.10, "EUR": 1.00},
+    "2025-02-01": {"CHF": 1.20, "EUR": 1.05},
+}})
+
+
+def ledger(n, seed=0):
+    rng = random.Random(seed)
+    data = default_data()
+    accounts = ["Cash", "Bank", "Card"]
+    for account in accounts:
+        apply_record(data, {"op": "add_account", "account": account})
+    for i in range(n):
+        source = rng.choice(accounts)
+        # Transfers, some within one account, and spending
+        destination = rng.choice(accounts) if rng.random() < 0.3 else ""
+        currency = rng.choice(["CHF", "EUR"])
+        apply_record(data, {"op": "transaction", "trans": {
+            "date": f"2025-{rng.randint(1, 2):02d}-{rng.randint(1, 28):02d}",
+            "type": "transfer" if destination else rng.choice(["snack", "admin", "subscription"]),
+            "amount_sent": float(rng.randint(1, 500)), "currency_sent": currency, "from": source,
+            "amount_received": float(rng.randint(1, 500)) if destination else 0.0,
+            "currency_received": currency if destination else "", "to": destination,
+            "status": rng.choice(["closed", "pending"]), "info": f"note {i}", "description": "",
+        }})
+    return data
+
+
+@pytest.mark.parametrize("n", [0, 7, 40, 300])
+@pytest.mark.parametrize("fx", [None, RATES])
+def test_streamed_pages_match_the_cached_ones(n, fx):
+    data = ledger(n)
+    cache = SectionCache(HTML_RENDERER, fx, "EUR")
+    cache.update(data, 1)
+    expected = cache.pages(10, 3)
+    assert stream_pages(data, HTML_RENDERER, 10, 3, fx, "EUR") == expected
+    # 300 transactions leave out older log pages and account entries
+    assert expected[1] == (n > 30)
+
+
+def test_oversized_report_pages_are_streamed(monkeypatch):
+    data = ledger(300)
+    report_cache = ReportCache(max_bytes=1000, fx=RATES, base="EUR")
+    expected = stream_pages(data, HTML_RENDERER, 10, 3, RATES, "EUR")
+    assert report_cache.pages(data, 1, HTML_RENDERER, 10, 3) == expected
+    assert report_cache.size() == 0
+
+    # From then on the report isn't rendered whole again, cached or not
+    def no_section_cache(*args, **kwargs):
+        raise AssertionError("rendered the whole report")
+
+    monkeypatch.setattr(reports, "SectionCache", no_section_cache)
+    monkeypatch.setattr(SectionCache, "update", no_section_cache)
+    apply_record(data, {"op": "add_account", "account": "Savings"})
+    assert report_cache.pages(data, 2, HTML_RENDERER, 10, 3) == stream_pages(data, HTML_RENDERER, 10, 3, RATES, "EUR")
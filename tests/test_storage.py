@@ -0,0 +1,167 @@
+import asyncio
+import os
+
+import pytest
+
+from partitions import PartitionedStorage
+from reports import TEXT_RENDERER, SectionCache
+from storage import JournalStorage, SqliteStorage, apply_record
+
+
+def spend(amount):
+    return {
+        "date": "2025-01-02", "type": "snack", "amount_sent": amount, "currency_sent": "CHF", "from": "Cash",
+        "amount_received": 0.0, "currency_received": "", "to": "", "status": "closed", "info": "",
+        "description": f"Snack - {amount} CHF",
+    }
+
+
+def commit(storage, data, records):
+    for record in records:
+        apply_record(data, record)
+    asyncio.run(storage.commit(records, data))
+
+
+def crash_on_remove(monkeypatch, suffix):
+    real_remove = os.remove
+
+    def remove(path):
+        if str(path).endswith(suffix):
+            raise KeyboardInterrupt("crashed")
+        real_remove(path)
+
+    monkeypatch.setattr(os, "remove", remove)
+
+
+def test_replay_skips_records_in_snapshot_after_crash(tmp_path, monkeypatch):
+    storage = JournalStorage(str(tmp_path / "data.json"), str(tmp_path / "journal.log"))
+    data = storage.load()
+    commit(storage, data, [{"op": "add_account", "account": "Cash"}, {"op": "transaction", "trans": spend(5)}])
+
+    # The snapshot is renamed into place, then the process dies before .compacting is removed
+    crash_on_remove(monkeypatch, ".compacting")
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(storage.checkpoint(data))
+    monkeypatch.undo()
+    assert os.path.exists(storage.compacting_path)
+
+    reloaded = JournalStorage(storage.path, storage.journal_path)
+    data = reloaded.load()
+    assert [t["id"] for t in data["transactions"]] == [1]
+    assert data["balances"]["Cash"]["settled"]["CHF"] == -5
+
+    # Records written after the restart are numbered past the snapshot and replayed
+    commit(reloaded, data, [{"op": "transaction", "trans": spend(2)}])
+    data = JournalStorage(storage.path, storage.journal_path).load()
+    assert [t["id"] for t in data["transactions"]] == [1, 2]
+    assert data["balances"]["Cash"]["settled"]["CHF"] == -7
+
+
+def test_unnumbered_journal_records_are_replayed(tmp_path):
+    storage = JournalStorage(str(tmp_path / "data.json"), str(tmp_path / "journal.log"))
+    storage.load()
+    with open(storage.journal_path, "w") as file:
+        file.write('{"op":"add_account","account":"Cash"}\n')
+    assert JournalStorage(storage.path, storage.journal_path).load()["accounts"] == ["Cash"]
+
+
+def test_partitioned_replay_skips_records_in_manifest_after_crash(tmp_path, monkeypatch):
+    def open_storage():
+        return PartitionedStorage(str(tmp_path / "parts"), str(tmp_path / "data.json"), str(tmp_path / "journal.log"))
+
+    storage = open_storage()
+    data = storage.load()
+    commit(storage, data, [{"op": "add_account", "account": "Cash"}, {"op": "transaction", "trans": spend(5)}])
+
+    # The manifest is written, then the process dies before .compacting is removed
+    crash_on_remove(monkeypatch, ".compacting")
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(storage.checkpoint(data))
+    monkeypatch.undo()
+
+    data = open_storage().load()
+    assert [t["id"] for t in data["transactions"]] == [1]
+    assert data["balances"]["Cash"]["settled"]["CHF"] == -5
+
+
+def test_sqlite_commit_round_trip(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "data.db"), str(tmp_path / "data.json"))
+    data = storage.load()
+    commit(storage, data, [
+        {"op": "add_account", "account": "Cash"},
+        {"op": "transaction", "trans": spend(5)},
+        {"op": "transactions", "trans": [spend(2), spend(3)]},
+    ])
+
+    reloaded = SqliteStorage(storage.path, str(tmp_path / "data.json")).load()
+    assert reloaded["transactions"] == data["transactions"]
+    assert reloaded["balances"] == data["balances"]
+    assert reloaded["spending_categories"]["snack"]["total"] == {"CHF": 10}
+
+
+def trade(amount, source, destination):
+    trans = dict(spend(amount), type="trade", to=destination, amount_received=amount, currency_received="EUR")
+    trans["from"] = source
+    return trans
+
+
+def test_sqlite_report_sections_come_from_the_indexes(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "data.db"), str(tmp_path / "data.json"))
+    data = storage.load()
+    commit(storage, data, [
+        {"op": "add_account", "account": "Cash"},
+        {"op": "add_account", "account": "Bank"},
+        {"op": "transactions", "trans": [spend(5.0), trade(20.0, "Cash", "Bank"), trade(3.0, "Cash", "Cash"), spend(2.5)]},
+    ])
+    names = {row["name"] for row in storage.reader.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_transactions_from", "idx_transactions_to", "idx_transactions_type"} <= names
+
+    queries = []
+    for method in ("account_transactions", "category_transactions"):
+        query = getattr(storage, method)
+        setattr(storage, method, lambda key, query=query: queries.append(key) or query(key))
+    indexed = SectionCache(TEXT_RENDERER, source=storage)
+    indexed.update(data, 1)
+    scanned = SectionCache(TEXT_RENDERER)
+    scanned.update(data, 1)
+    assert sorted(queries) == ["Bank", "Cash", "snack"]
+    assert indexed.parts() == scanned.parts()
+
+
+def test_report_scans_the_ledger_while_changes_are_uncommitted(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "data.db"), str(tmp_path / "data.json"))
+    data = storage.load()
+    commit(storage, data, [{"op": "add_account", "account": "Cash"}, {"op": "transaction", "trans": spend(5.0)}])
+    # Applied in memory, still waiting for its group commit
+    apply_record(data, {"op": "transaction", "trans": spend(2.5)})
+
+    indexed = SectionCache(TEXT_RENDERER, source=storage)
+    indexed.update(data, 1)
+    scanned = SectionCache(TEXT_RENDERER)
+    scanned.update(data, 1)
+    assert indexed.parts() == scanned.parts()
+    assert any("2.5 CHF" in part for part in indexed.account_entries["Cash"])
+
+
+def test_flush_after_failed_sqlite_commit_saves_the_ledger(tmp_path, monkeypatch):
+    from maBot import Ledger
+
+    storage = SqliteStorage(str(tmp_path / "data.db"), str(tmp_path / "data.json"))
+    ledger = Ledger(storage, balance_checkpoint_file=str(tmp_path / "balances.json"))
+
+    def fail(statements):
+        raise OSError("disk full")
+
+    async def main():
+        await ledger.commit({"op": "add_account", "account": "Cash"})
+        monkeypatch.setattr(storage, "_execute", fail)
+        with pytest.raises(OSError):
+            await ledger.commit({"op": "transaction", "trans": spend(5)})
+        monkeypatch.undo()
+        # Nothing else is committed; the flush alone has to write the failed change
+        assert await ledger.flush()
+
+    asyncio.run(main())
+    data = SqliteStorage(storage.path, str(tmp_path / "data.json")).load()
+    assert [t["id"] for t in data["transactions"]] == [1]
+    assert data["balances"]["Cash"]["settled"]["CHF"] == -5
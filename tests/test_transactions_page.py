@@ -0,0 +1,57 @@
+import pytest
+
+import maBot
+from maBot import CB_PAGE_PREFIX, transactions_page
+
+
+@pytest.fixture(autouse=True)
+def page_size(monkeypatch):
+    monkeypatch.setattr(maBot, "TRANSACTION_LIST_LIMIT", 5)
+
+
+def ledger(ids):
+    return {"transactions": [
+        {"id": i, "date": "2025-01-02", "type": "snack", "amount_sent": 1.0, "currency_sent": "CHF", "from": "Cash",
+         "amount_received": 0.0, "currency_received": "", "to": "", "status": "closed", "info": f"t{i}"}
+        for i in ids
+    ]}
+
+
+def page(data, cursor=None):
+    """The ids on the page, newest first, and the cursors of its (older, newer) buttons."""
+    text, keyboard = transactions_page(data, cursor)
+    ids = [int(line.rsplit("| t", 1)[1].rstrip(" |")) for line in text.splitlines() if "| t" in line]
+    buttons = {}
+    if keyboard is not None:
+        for button in keyboard.inline_keyboard[0]:
+            assert button.callback_data.startswith(CB_PAGE_PREFIX)
+            buttons[button.text] = int(button.callback_data[len(CB_PAGE_PREFIX):])
+    return ids, buttons.get(maBot.BTN_OLDER), buttons.get(maBot.BTN_NEWER)
+
+
+def test_latest_page_by_default():
+    assert page(ledger(range(1, 13))) == ([12, 11, 10, 9, 8], 7, None)
+
+
+def test_following_the_buttons_walks_every_page():
+    data = ledger(range(1, 13))
+    assert page(data, 7) == ([7, 6, 5, 4, 3], 2, 12)
+    # The first page is always full, so it overlaps the one after it
+    assert page(data, 2) == ([5, 4, 3, 2, 1], None, 10)
+    assert page(data, 12) == page(data)
+
+
+def test_cursor_of_a_missing_id_ends_at_the_one_before():
+    data = ledger([1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 12])
+    assert page(data, 7) == ([6, 5, 4, 3, 2], 1, 12)
+    # Past the newest id, e.g. from a message sent before a reset
+    assert page(data, 99) == page(data)
+    # Older than every id: the first page
+    assert page(data, 0) == ([5, 4, 3, 2, 1], None, 11)
+
+
+def test_short_and_empty_ledgers():
+    assert page(ledger([1, 2, 3])) == ([3, 2, 1], None, None)
+    text, keyboard = transactions_page(ledger([]))
+    assert keyboard is None
+    assert text == maBot.REPORT_HEADER_TRANSACTIONS + "\n" + maBot.TABLE_HEADER + "\n" + maBot.TABLE_SEPARATOR
@@ -0,0 +1,171 @@
+import asyncio
+import json
+
+import pytest
+from telegram import Update
+
+from webhook import ChatOrderedUpdateProcessor, WebhookServer, MAX_BODY_BYTES, SECRET_HEADER
+
+SECRET = "s3cret"
+
+
+def update_json(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hi"},
+    }
+
+
+def chat_update(update_id, chat_id):
+    return Update.de_json(update_json(update_id, chat_id), None)
+
+
+def test_chat_updates_run_in_order_one_at_a_time():
+    handled = []
+
+    async def handle(update_id, chat_id):
+        handled.append(("start", update_id))
+        await asyncio.sleep(0.01 if update_id == 1 else 0)
+        handled.append(("end", update_id))
+
+    async def main():
+        processor = ChatOrderedUpdateProcessor(8)
+        await asyncio.gather(*(processor.process_update(chat_update(i, 5), handle(i, 5)) for i in range(1, 5)))
+        assert processor._chats == {}
+
+    asyncio.run(main())
+    assert handled == [(step, i) for i in range(1, 5) for step in ("start", "end")]
+
+
+def test_bursting_chat_leaves_slots_for_other_chats():
+    release = None
+    handled = []
+
+    async def handle(update_id):
+        if update_id == 1:
+            await release.wait()
+        handled.append(update_id)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        processor = ChatOrderedUpdateProcessor(2)
+        burst = [asyncio.create_task(processor.process_update(chat_update(i, 5), handle(i))) for i in range(1, 11)]
+        await asyncio.sleep(0)
+        # The burst's first update is stuck; the rest of it waits without a slot
+        assert processor.current_concurrent_updates == 1
+        await asyncio.wait_for(processor.process_update(chat_update(11, 6), handle(11)), 1)
+        assert handled == [11]
+        release.set()
+        await asyncio.gather(*burst)
+
+    asyncio.run(main())
+    assert handled == [11] + list(range(1, 11))
+
+
+def test_handler_error_reaches_its_own_update_only():
+    async def fail():
+        raise RuntimeError("boom")
+
+    async def ok():
+        pass
+
+    async def main():
+        processor = ChatOrderedUpdateProcessor(4)
+        return await asyncio.gather(
+            processor.process_update(chat_update(1, 5), fail()),
+            processor.process_update(chat_update(2, 5), ok()),
+            return_exceptions=True,
+        )
+
+    first, second = asyncio.run(main())
+    assert isinstance(first, RuntimeError)
+    assert second is None
+
+
+class FakeApp:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+
+def request(body, path="/hook", method="POST", secret=SECRET, headers=()):
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost", f"Content-Length: {len(body)}"]
+    if secret is not None:
+        lines.append(f"{SECRET_HEADER}: {secret}")
+    lines.extend(headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, *header_lines = head.decode().rstrip("\r\n").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in header_lines)
+    return int(status_line.split(" ")[1]), headers
+
+
+def run_server(scenario):
+    """Run `scenario(app, port)` against a WebhookServer on a free local port."""
+    async def main():
+        app = FakeApp()
+        server = WebhookServer(app, "/hook", SECRET)
+        port = await server.start("127.0.0.1", 0)
+        try:
+            return await scenario(app, port)
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_updates_are_queued_over_a_kept_alive_connection():
+    async def scenario(app, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        for update_id in (1, 2):
+            writer.write(request(json.dumps(update_json(update_id, 5)).encode()))
+            responses.append(await read_response(reader))
+        writer.close()
+        return responses, [app.update_queue.get_nowait().update_id for _ in range(app.update_queue.qsize())]
+
+    responses, queued = run_server(scenario)
+    assert responses == [(200, {"Content-Length": "0", "Connection": "keep-alive"})] * 2
+    assert queued == [1, 2]
+
+
+@pytest.mark.parametrize("raw, status", [
+    (request(b"{}", secret="wrong"), 403),
+    (request(b"{}", secret=None), 403),
+    (request(b"{}", path="/other"), 404),
+    (request(b"", method="GET"), 405),
+    (request(b"not json"), 400),
+    (request(b"{}", headers=["Transfer-Encoding: chunked"]), 411),
+    (request(b"").replace(b"Content-Length: 0", f"Content-Length: {MAX_BODY_BYTES + 1}".encode()), 413),
+    (request(b"").replace(b"Content-Length: 0", b"Content-Length: twelve"), 400),
+])
+def test_refused_requests(raw, status):
+    async def scenario(app, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        response = await read_response(reader)
+        writer.close()
+        return response, app.update_queue.qsize()
+
+    (got, headers), queued = run_server(scenario)
+    assert got == status
+    assert queued == 0
+
+
+def test_connection_closes_after_a_bad_content_length():
+    async def scenario(app, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request(b"").replace(b"Content-Length: 0", b"Content-Length: -"))
+        response = await read_response(reader)
+        rest = await reader.read()
+        writer.close()
+        return response, rest
+
+    (status, headers), rest = run_server(scenario)
+    assert status == 400
+    assert headers["Connection"] == "close"
+    assert rest == b""
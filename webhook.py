@@ -0,0 +1,323 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import time
+from collections import Counter, deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import BaseRequest
+
+from metrics import METRICS
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+# Updates are a few KB at most; anything much bigger isn't from Telegram
+MAX_BODY_BYTES = 1 << 20
+REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large",
+}
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handles up to `max_concurrent_updates` updates at once, but those of one chat one after another.
+
+    Conversations, keyboards and ledger changes of a chat depend on the
+    order its messages came in, so each chat's updates are queued and run
+    in arrival order by whichever of them arrived first while the chat was
+    idle (its drain). Only the update at the head of a chat's queue takes a
+    concurrency slot, so a chat sending a long burst holds one slot at a time
+    and never keeps other chats waiting. Updates without a chat are never
+    held back.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat id -> deque of (update, coroutine, future) waiting their turn; dropped when the chat goes idle
+        self._chats = {}
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        done = asyncio.get_running_loop().create_future()
+        queue = self._chats.get(chat.id)
+        if queue is not None:
+            # The chat's drain runs it after the updates before it, without a slot held meanwhile
+            queue.append((update, coroutine, done))
+            await done
+            return
+        queue = self._chats[chat.id] = deque([(update, coroutine, done)])
+        try:
+            while queue:
+                next_update, next_coroutine, future = queue[0]
+                try:
+                    if future.cancelled():
+                        next_coroutine.close()
+                        continue
+                    async with self._semaphore:
+                        await self.do_process_update(next_update, next_coroutine)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(None)
+                finally:
+                    queue.popleft()
+        finally:
+            del self._chats[chat.id]
+            # Only left over if the drain itself was cancelled
+            for _, next_coroutine, future in queue:
+                next_coroutine.close()
+                future.cancel()
+        await done
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def _response(status, keep_alive):
+    connection = "keep-alive" if keep_alive else "close"
+    return f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode()
+
+
+class WebhookServer:
+    """A minimal HTTP/1.1 endpoint receiving updates from Telegram for `app`.
+
+    Only POSTs to `path` carrying `secret_token` in the
+    X-Telegram-Bot-Api-Secret-Token header are accepted; each is parsed and
+    put on the application's update queue, and answered once queued, not
+    once handled, so Telegram can send the next one right away. TLS is left
+    to a reverse proxy in front of it.
+    """
+
+    def __init__(self, app, path, secret_token):
+        self.app = app
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.server = None
+        # Open connections; Telegram keeps them alive, so stop() has to close them
+        self.writers = set()
+
+    async def start(self, listen, port):
+        self.server = await asyncio.start_server(self._serve, listen, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.split(" ")
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    METRICS.inc("webhook_requests_total", status=400)
+                    writer.write(_response(400, False))
+                    break
+                if "transfer-encoding" in headers or length > MAX_BODY_BYTES:
+                    # The body can't be skipped safely, so the connection ends here
+                    status = 411 if "transfer-encoding" in headers else 413
+                    METRICS.inc("webhook_requests_total", status=status)
+                    writer.write(_response(status, False))
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                status = self._accept(method, target, headers, body)
+                METRICS.inc("webhook_requests_total", status=status)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(_response(status, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def _accept(self, method, target, headers, body):
+        """The HTTP status for one request, queueing its update if it is accepted."""
+        if target.partition("?")[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret_token):
+            logger.warning("Webhook request with a wrong secret token refused")
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400
+        self.app.update_queue.put_nowait(update)
+        return 200
+
+
+async def serve_webhook(app, listen, port, path, url, secret_token):
+    """Run `app` on a webhook until SIGINT or SIGTERM, with the lifecycle of Application.run_polling()."""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    server = WebhookServer(app, path, secret_token)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        bound = await server.start(listen, port)
+        # Registered once the server is listening, so the first update finds it
+        await app.bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Bot running on a webhook, listening on {listen}:{bound}{path}")
+        await stopping.wait()
+    finally:
+        await server.stop()
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def run_webhook(app, listen, port, path, url, secret_token):
+    asyncio.run(serve_webhook(app, listen, port, path, url, secret_token))
+
+
+class OfflineBotApi(BaseRequest):
+    """A local stand-in for the Bot API, so the bot can run and be benchmarked without a network.
+
+    Every call succeeds after `latency` seconds (the simulated round trip);
+    messages sent come back as minimal Message objects and getUpdates hands
+    out `updates`, recorded update dicts, in batches like Telegram does.
+    `calls` counts the requests per Bot API method.
+
+    With `flood_limits`, ((rate, burst) overall, (rate, burst) per chat),
+    requests to chats beyond those token buckets are refused with a 429
+    and a retry-after of a second, modelling Telegram's flood control (whose
+    exact rules aren't published); `flooded` counts them.
+    """
+
+    def __init__(self, updates=(), latency=0.0, flood_limits=None):
+        self.updates = list(updates)
+        self.latency = latency
+        self.flood_limits = flood_limits
+        self.calls = Counter()
+        self.flooded = 0
+        self._buckets = {}
+        # Index of the first update not yet confirmed by a getUpdates offset
+        self.confirmed = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def pending(self):
+        """Updates not yet fetched and confirmed through getUpdates."""
+        return len(self.updates) - self.confirmed
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        parameters = request_data.parameters if request_data is not None else {}
+        if self.flood_limits and "chat_id" in parameters and self._is_flooded(parameters["chat_id"]):
+            self.flooded += 1
+            error = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                     "parameters": {"retry_after": 1}}
+            return 429, json.dumps(error).encode()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api_method == "getUpdates":
+            result = await self._get_updates(parameters)
+        else:
+            result = self._answer(api_method, parameters)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _is_flooded(self, chat_id):
+        now = time.monotonic()
+        buckets = []
+        for key, (rate, burst) in ((None, self.flood_limits[0]), (chat_id, self.flood_limits[1])):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+            buckets.append(bucket)
+        if any(bucket.delay(now) for bucket in buckets):
+            return True
+        for bucket in buckets:
+            bucket.take()
+        return False
+
+    async def _get_updates(self, parameters):
+        offset = parameters.get("offset") or 0
+        while self.confirmed < len(self.updates) and self.updates[self.confirmed]["update_id"] < offset:
+            self.confirmed += 1
+        batch = self.updates[self.confirmed:self.confirmed + (parameters.get("limit") or 100)]
+        if not batch:
+            # Telegram would hold the request open for `timeout`; this only keeps polling from spinning
+            await asyncio.sleep(0.05)
+        return batch
+
+    def _message(self, parameters):
+        self._message_id += 1
+        chat_id = parameters.get("chat_id", 0)
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+        }
+        if "text" in parameters:
+            message["text"] = parameters["text"]
+        return message
+
+    def _answer(self, api_method, parameters):
+        if api_method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Offline", "username": "offline_bot"}
+        if api_method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": self.pending}
+        if api_method == "sendMediaGroup":
+            return [self._message(parameters) for _ in parameters.get("media", ())]
+        if api_method.startswith(("send", "edit", "copy", "forward")) and api_method != "sendChatAction":
+            return self._message(parameters)
+        return True